@@ -0,0 +1,359 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from libs.device import PPKDevice
+from libs.deframer import Deframer
+from libs.measurement import SAMPLE_INTERVAL
+from libs import protocol
+from libs.protocol import Calibration, is_average
+from libs.pyramid import MinMaxPyramid
+from libs.recording import Recorder
+from libs.rtt import DECODE_BATCH
+from libs.stats import PrefixSumRingBuffer, StatsRingBuffer
+from libs import simulator
+
+RESULT_VERSION  = 2
+CHUNK_SIZE      = 10000         # Bytes per read when replaying a stream, the poller's start size
+AVG_SAMPLES     = 10
+TRIGGER_LEVEL   = 1000          # uA
+TRIGGER_WINDOW  = 512           # Samples
+AVG_BUFFER      = 30.0          # Seconds of averages kept, as the GUI default
+GUI_FPS         = 30
+LATENCY_LIMIT   = 0.5           # p99 above this [s] means the decoders are falling behind
+WAVEFORM        = 'square:10,5000,0.01,0.1'
+
+
+def cpu_time():
+    # User + system time of the whole process, all threads
+    t = os.times()
+    return t[0] + t[1]
+
+
+def children_cpu_time():
+    # Of the child processes that were waited for
+    t = os.times()
+    return t[2] + t[3]
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None     # Windows
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 if sys.platform != 'darwin' else rss / 1048576.0
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else None
+
+
+def synthetic_stream(seconds, waveform):
+    ''' Bytes the simulated PPK sends over seconds of its time, and its banner '''
+    ppk = simulator.SimulatedPPK(simulator.parse_waveform(waveform), realtime=False, noise_uA=0.1)
+    banner = ppk.read(len(ppk.banner())).decode('ascii')
+    ppk.execute(protocol.TRIGGER_SET, (TRIGGER_LEVEL,))
+    ppk.execute(protocol.TRIG_WINDOW_SET, (TRIGGER_WINDOW,))
+    ppk.execute(protocol.AVG_NUM_SET, (AVG_SAMPLES // 10,))
+    ppk.execute(protocol.RUN, ())
+    chunks = []
+    while ppk.sample_index - ppk.run_sample < seconds / SAMPLE_INTERVAL:
+        chunks.append(ppk.read(CHUNK_SIZE))
+    return b''.join(chunks), banner
+
+
+def make_device(banner):
+    device = PPKDevice()
+    device.calibration = Calibration(banner)
+    device.res_lo = device.calibration.res_lo
+    device.res_mid = device.calibration.res_mid
+    device.res_hi = device.calibration.res_hi
+    device.avg_samples = AVG_SAMPLES
+    device.avg_interval = SAMPLE_INTERVAL * AVG_SAMPLES
+    return device
+
+
+class Stage(object):
+    ''' Wall and CPU time of a with block '''
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.time() - self.wall
+        self.cpu = cpu_time() - self.cpu
+
+    def result(self, **rates):
+        ''' rates: name=count, reported per CPU second '''
+        result = {'wall_s': self.wall, 'cpu_s': self.cpu}
+        for name, count in rates.items():
+            result[name + '_per_s'] = count / self.cpu if self.cpu > 0 else None
+        return result
+
+
+def bench_stages(stream, banner):
+    ''' Each stage of the pipeline on its own over the whole stream '''
+    chunks = [stream[i:i + CHUNK_SIZE] for i in range(0, len(stream), CHUNK_SIZE)]
+    stages = {}
+
+    deframer = Deframer()
+    frames = []
+    with Stage() as stage:
+        for chunk in chunks:
+            frames.extend(deframer.feed(chunk))
+    stages['deframe'] = stage.result(bytes=len(stream), frames=len(frames))
+    batches = [frames[i:i + DECODE_BATCH] for i in range(0, len(frames), DECODE_BATCH)]
+    raw_trigger = [frame for frame in frames if not is_average(frame)]
+
+    device = make_device(banner)
+    with Stage() as stage:
+        for batch in batches:
+            device.handle_frames(batch)
+    averages = device.charge.read().samples
+    trigger_samples = sum(len(frame) // 2 for frame in raw_trigger)
+    stages['decode'] = stage.result(frames=len(frames), samples=averages + trigger_samples)
+
+    # What the decoders hand on, for the stages after them
+    device = make_device(banner)
+    avg_blocks = []
+    trig_blocks = []
+    device.on_averages(avg_blocks.append)
+    device.on_trigger(lambda amps, ranges: trig_blocks.append(amps))
+    for batch in batches:
+        device.handle_frames(batch)
+
+    avg_y = StatsRingBuffer(int(AVG_BUFFER / device.avg_interval))
+    pyramid = MinMaxPyramid(avg_y)
+    trig_y = PrefixSumRingBuffer(TRIGGER_WINDOW)
+    sync_every = max(int(1.0 / GUI_FPS / device.avg_interval), 1)
+    with Stage() as stage:
+        unsynced = 0
+        for block in avg_blocks:
+            avg_y.extend(block)
+            unsynced += len(block)
+            if unsynced >= sync_every:
+                pyramid.sync()
+                avg_y.stats()
+                unsynced = 0
+        for amps in trig_blocks:
+            trig_y.extend(amps)
+    stages['stats'] = stage.result(samples=averages + trigger_samples)
+
+    directory = tempfile.mkdtemp(prefix='bench_ppk')
+    try:
+        recorder = Recorder(device, os.path.join(directory, 'bench'))
+        with Stage() as stage:
+            recorder.start()
+            for block in avg_blocks:
+                recorder.average_handler(block)
+            for frame in raw_trigger:
+                recorder.trigger_handler(frame)
+            recorder.close()
+        stages['record'] = stage.result(samples=averages + trigger_samples,
+                                        bytes=sum(os.path.getsize(p) for p in recorder.paths))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    stream_info = {'bytes': len(stream), 'frames': len(frames),
+                   'average_samples': averages, 'trigger_samples': trigger_samples}
+    return stream_info, stages
+
+
+def pipeline_result(stream_info, stages):
+    ''' All the stages together, on one core '''
+    cpu = sum(stage['cpu_s'] for stage in stages.values())
+    samples = stream_info['average_samples'] + stream_info['trigger_samples']
+    return {'cpu_s': cpu,
+            'cpu_per_ppk_second': cpu / stream_info['ppk_seconds'],
+            'realtime_factor': stream_info['ppk_seconds'] / cpu if cpu > 0 else None,
+            'samples_per_s': samples / cpu if cpu > 0 else None}
+
+
+def bench_live(speed, seconds, waveform, offload=False):
+    ''' The real reader and decoder threads against a simulated PPK running
+        speed times faster than the real one, with the GUI buffers fed as
+        in ppk.py. Latency is from the PPK completing an average to the
+        sample being in the ring buffer. The simulator shares the process
+        and its CPU time is counted in cpu_load, so the real PPK leaves the
+        host somewhat more headroom than the sweep shows.
+        The main thread stands in for the GUI, waking GUI_FPS times a
+        second; gui_late is how much later than asked it got to run.
+        With offload the decoding is done by a DecoderProcess, whose CPU
+        time is added to cpu_load, from its start up on.
+    '''
+    children_cpu = children_cpu_time()
+    api = simulator.api_factory(waveform=simulator.parse_waveform(waveform), noise_uA=0.1, speed=speed)
+    ppk = api.ppk
+    device = PPKDevice(api=api, offload=offload)
+    device.connect()
+    device.start()
+
+    avg_y = StatsRingBuffer(int(AVG_BUFFER / (SAMPLE_INTERVAL * AVG_SAMPLES)))
+    pyramid = MinMaxPyramid(avg_y)
+    trig_y = PrefixSumRingBuffer(TRIGGER_WINDOW)
+    latencies = []
+    counts = {'averages': 0, 'trigger': 0}
+
+    def average_handler(samples):
+        avg_y.extend(samples)
+        now = time.time()
+        first = counts['averages']
+        counts['averages'] += len(samples)
+        latencies.append(now - ppk.average_times(first, counts['averages'] - 1))
+
+    def trigger_handler(amps, ranges):
+        trig_y.extend(amps)
+        counts['trigger'] += len(amps)
+
+    device.on_averages(average_handler)
+    device.on_trigger(trigger_handler)
+    with device.batch():
+        device.set_trigger(TRIGGER_LEVEL)
+        device.set_trigger_window(TRIGGER_WINDOW)
+        device.run()
+        device.set_average_samples(AVG_SAMPLES)
+
+    start = time.time()
+    cpu = cpu_time()
+    late = []
+    tick = start
+    while tick - start < seconds:
+        tick += 1.0 / GUI_FPS
+        time.sleep(max(tick - time.time(), 0))
+        late.append(time.time() - tick)
+        pyramid.sync()
+        avg_y.stats()
+        tick = max(tick, time.time())
+    elapsed = time.time() - start
+    cpu = cpu_time() - cpu
+    decoder = device.decoder.stats() if device.decoder else None
+    device.stop()
+    device.disconnect()
+    cpu += children_cpu_time() - children_cpu
+
+    latencies = np.concatenate(latencies) if latencies else np.zeros(0)
+    return {'speed': speed,
+            'offered_averages_per_s': ppk.averages_sent / elapsed,
+            'averages_per_s': counts['averages'] / elapsed,
+            'trigger_samples_per_s': counts['trigger'] / elapsed,
+            'samples_per_s': (counts['averages'] + counts['trigger']) / elapsed,
+            'dropped_frames': device.rtt.queue.dropped,
+            'dropped_bytes': ppk.bytes_dropped + (decoder['dropped_bytes'] if decoder else 0),
+            'queue_high_water': device.rtt.queue.high_water,
+            'latency_p50_ms': percentile(latencies, 50) * 1e3 if len(latencies) else None,
+            'latency_p99_ms': percentile(latencies, 99) * 1e3 if len(latencies) else None,
+            'gui_late_p50_ms': percentile(late, 50) * 1e3,
+            'gui_late_p99_ms': percentile(late, 99) * 1e3,
+            'offload': offload,
+            'cpu_load': cpu / elapsed}
+
+
+def sustainable(step):
+    return (not step['dropped_frames'] and not step['dropped_bytes'] and
+            step['latency_p99_ms'] is not None and step['latency_p99_ms'] < LATENCY_LIMIT * 1e3)
+
+
+def sweep(args, offload=False):
+    ''' Live runs at doubling speeds until one isn't sustainable, returns them and the fastest that was '''
+    steps = []
+    best = None
+    speed = 1.0
+    while speed <= args.max_speed:
+        step = bench_live(speed, args.step, args.waveform, offload)
+        step['sustainable'] = sustainable(step)
+        steps.append(step)
+        print("x%-5g %10.0f samples/s  dropped %d frames %d bytes  latency p50 %7.1f ms p99 %7.1f ms  "
+              "GUI late p50 %5.1f ms p99 %5.1f ms  cpu %3.0f%%"
+              % (speed, step['samples_per_s'], step['dropped_frames'], step['dropped_bytes'],
+                 step['latency_p50_ms'] or 0, step['latency_p99_ms'] or 0, step['gui_late_p50_ms'],
+                 step['gui_late_p99_ms'], step['cpu_load'] * 100))
+        sys.stdout.flush()
+        if not step['sustainable']:
+            break
+        best = step
+        speed *= 2
+    if best:
+        print("Max sustainable%s: x%g, %.0f samples/s"
+              % (" with a decoder process" if offload else "", best['speed'], best['samples_per_s']))
+    return steps, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency of the PPK host pipeline, "
+                                     "against a simulated PPK")
+    parser.add_argument('--stream', metavar='FILE',
+                        help="raw RTT byte stream to replay through the stages instead of a synthetic one")
+    parser.add_argument('--banner', metavar='TEXT',
+                        help="calibration banner for --stream (default: the simulator's)")
+    parser.add_argument('--seconds', type=float, default=60.0,
+                        help="PPK time in the synthetic stream (default 60)")
+    parser.add_argument('--waveform', default=WAVEFORM,
+                        help="simulated DUT current, see ppk_headless.py --simulate (default %s)" % WAVEFORM)
+    parser.add_argument('--step', type=float, default=3.0,
+                        help="seconds per speed of the live sweep (default 3)")
+    parser.add_argument('--max-speed', type=float, default=256,
+                        help="fastest simulated PPK in the sweep, as a multiple of the real one (default 256)")
+    parser.add_argument('--no-live', action='store_true', help="skip the live sweep")
+    parser.add_argument('--offload', action='store_true',
+                        help="repeat the live sweep with the decoding in a separate process")
+    parser.add_argument('--json', metavar='FILE', help="write the results to FILE")
+    args = parser.parse_args()
+
+    if args.stream:
+        with open(args.stream, 'rb') as f:
+            stream = f.read()
+        banner = args.banner or simulator.SimulatedPPK().banner()
+        ppk_seconds = None
+    else:
+        stream, banner = synthetic_stream(args.seconds, args.waveform)
+        ppk_seconds = args.seconds
+
+    stream_info, stages = bench_stages(stream, banner)
+    if ppk_seconds is None:
+        # Assume the stream was recorded with the default average of AVG_SAMPLES
+        ppk_seconds = max(stream_info['average_samples'] * SAMPLE_INTERVAL * AVG_SAMPLES, 1e-9)
+    stream_info['ppk_seconds'] = ppk_seconds
+    pipeline = pipeline_result(stream_info, stages)
+
+    print("Stream: %d bytes, %d frames, %.1f s of PPK time"
+          % (stream_info['bytes'], stream_info['frames'], stream_info['ppk_seconds']))
+    for name in ('deframe', 'decode', 'stats', 'record'):
+        stage = stages[name]
+        print("%-8s %8.3f s CPU  %8.3f s wall" % (name, stage['cpu_s'], stage['wall_s']))
+    print("Pipeline: %.3f s CPU per s of PPK time, %.0fx real time"
+          % (pipeline['cpu_per_ppk_second'], pipeline['realtime_factor'] or 0))
+
+    steps, best = sweep(args) if not args.no_live else ([], None)
+    offload_steps, offload_best = sweep(args, offload=True) if args.offload and not args.no_live else ([], None)
+
+    result = {'version': RESULT_VERSION,
+              'time': time.time(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'stream': stream_info,
+              'stages': stages,
+              'pipeline': pipeline,
+              'sweep': steps,
+              'max_sustainable': {'speed': best['speed'], 'samples_per_s': best['samples_per_s']} if best else None,
+              'sweep_offload': offload_steps,
+              'max_sustainable_offload': ({'speed': offload_best['speed'], 'samples_per_s': offload_best['samples_per_s']}
+                                          if offload_best else None),
+              'peak_rss_mb': peak_rss_mb()}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
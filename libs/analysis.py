@@ -0,0 +1,161 @@
+from __future__ import print_function
+import math
+import numpy as np
+from libs.recording import CaptureReader
+
+CHUNK_SAMPLES = 8 << 20         # Samples per task of a parallel analysis
+PERCENTILES   = (1, 5, 50, 95, 99)
+HIST_MIN      = 1e-7            # Lower edge of the histogram [A]
+HIST_DECADES  = 7               # Up to 1 A
+HIST_PER_DECADE = 10
+
+# Percentiles come from a histogram over the float32 value of every sample,
+# in buckets of the top 32 - _FINE_SHIFT bits of its bit pattern turned into
+# an ordered int: 2**-9 relative width, a bit under 0.1% from the midpoint.
+_FINE_SHIFT   = 14
+_FINE_OFFSET  = 1 << (31 - _FINE_SHIFT)
+FINE_BUCKETS  = 1 << (32 - _FINE_SHIFT)
+
+
+def histogram_edges(low=HIST_MIN, decades=HIST_DECADES, per_decade=HIST_PER_DECADE):
+    ''' Log spaced bin edges [A], the first bin also takes everything below low '''
+    return low * 10 ** (np.arange(decades * per_decade + 1) / float(per_decade))
+
+
+def _fine_keys(amps):
+    bits = np.asarray(amps, dtype=np.float32).view(np.int32)
+    ordered = np.where(bits < 0, bits ^ 0x7fffffff, bits)
+    return (ordered >> _FINE_SHIFT) + _FINE_OFFSET
+
+
+def _fine_value(bucket):
+    # Middle of the float32 values of a bucket
+    lo = (np.array([bucket, bucket + 1], dtype=np.int64) - _FINE_OFFSET) << _FINE_SHIFT
+    hi = lo[1] - 1
+    bits = np.array([lo[0], hi], dtype=np.int64)
+    bits = np.where(bits < 0, bits ^ 0x7fffffff, bits).astype(np.int32)
+    low, high = bits.view(np.float32).astype(np.float64)
+    return (low + high) / 2
+
+
+class PartialStats(object):
+    ''' Statistics of part of a capture that merge exactly with those of the
+        other parts: counts, minimum, maximum and histograms are added as
+        they are, and the sums are kept as one float64 per part and added
+        with math.fsum, so merging adds no rounding and the result doesn't
+        depend on the order the parts come in.
+        The fine histogram for the percentiles is kept as (buckets, counts)
+        of the buckets in use until merged into.
+    '''
+    def __init__(self, edges):
+        self.edges = edges
+        self.count = 0
+        self.sums = []
+        self.sumsqs = []
+        self.min = None
+        self.max = None
+        self.hist = np.zeros(len(edges) - 1, dtype=np.int64)
+        self.fine = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    @classmethod
+    def of(cls, amps, edges):
+        stats = cls(edges)
+        amps = np.asarray(amps, dtype=np.float64)
+        if not len(amps):
+            return stats
+        stats.count = len(amps)
+        stats.sums = [float(amps.sum())]
+        stats.sumsqs = [float(np.square(amps).sum())]
+        stats.min = float(amps.min())
+        stats.max = float(amps.max())
+        bins = np.clip(np.searchsorted(edges, amps, side='right') - 1, 0, len(edges) - 2)
+        stats.hist = np.bincount(bins, minlength=len(edges) - 1)
+        # Sparse, to keep what goes back to the pool small
+        fine = np.bincount(_fine_keys(amps), minlength=FINE_BUCKETS)
+        used = np.flatnonzero(fine)
+        stats.fine = (used, fine[used])
+        return stats
+
+    def merge(self, other):
+        if not other.count:
+            return self
+        self.count += other.count
+        self.sums.extend(other.sums)
+        self.sumsqs.extend(other.sumsqs)
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.hist = self.hist + other.hist
+        self.fine = self._dense()
+        used, counts = other._sparse()
+        self.fine[used] += counts
+        return self
+
+    def _dense(self):
+        if not isinstance(self.fine, tuple):
+            return self.fine
+        fine = np.zeros(FINE_BUCKETS, dtype=np.int64)
+        fine[self.fine[0]] = self.fine[1]
+        return fine
+
+    def _sparse(self):
+        if isinstance(self.fine, tuple):
+            return self.fine
+        used = np.flatnonzero(self.fine)
+        return used, self.fine[used]
+
+    def percentile(self, q):
+        ''' Nearest rank q percentile [A], to the fine bucket resolution '''
+        if not self.count:
+            return None
+        fine = self._dense()
+        rank = max(int(math.ceil(q / 100.0 * self.count)), 1)
+        bucket = int(np.searchsorted(np.cumsum(fine), rank))
+        return min(max(_fine_value(bucket), self.min), self.max)
+
+    @property
+    def mean(self):
+        return math.fsum(self.sums) / self.count if self.count else None
+
+    @property
+    def rms(self):
+        return math.sqrt(max(math.fsum(self.sumsqs) / self.count, 0.0)) if self.count else None
+
+    def charge(self, interval):
+        ''' [C] '''
+        return math.fsum(self.sums) * interval
+
+
+def _open(path, _readers={}):
+    # Readers kept per process, the tasks of one file share its mapping
+    reader = _readers.get(path)
+    if reader is None:
+        reader = _readers[path] = CaptureReader(path)
+    return reader
+
+
+def chunk_stats(task):
+    ''' PartialStats of samples start up to end of a capture, task being
+        (path, start, end, edges). Run by the process pool.
+    '''
+    path, start, end, edges = task
+    reader = _open(path)
+    return PartialStats.of(reader.decode(reader.samples[start:end]), edges)
+
+
+if __name__ == '__main__':
+    # python -m libs.analysis, merged chunks against the whole array
+    import time
+    rs = np.random.RandomState(0)
+    amps = np.concatenate((rs.exponential(5e-6, 4000000), rs.exponential(5e-3, 400000))).astype(np.float32)
+    edges = histogram_edges()
+    start = time.time()
+    whole = PartialStats.of(amps, edges)
+    elapsed = time.time() - start
+    merged = PartialStats(edges)
+    for i in range(0, len(amps), 1000003):
+        merged.merge(PartialStats.of(amps[i:i + 1000003], edges))
+    print("%.1f M samples/s" % (len(amps) / elapsed / 1e6))
+    print("mean %r %r, rms %r %r" % (whole.mean, merged.mean, whole.rms, merged.rms))
+    for q in PERCENTILES:
+        exact = np.sort(amps)[int(math.ceil(q / 100.0 * len(amps))) - 1]
+        print("p%d %.6g merged %.6g exact %.6g" % (q, whole.percentile(q), merged.percentile(q), exact))
@@ -0,0 +1,290 @@
+from __future__ import print_function
+import io
+import os
+import threading
+import numpy as np
+
+BURSTS_EXT     = '.bursts.npz'  # Added to the capture file name
+BURSTS_VERSION = 1
+CHUNK_SAMPLES  = 4 << 20        # Read at a time when indexing a capture file
+
+# One row per segment, start and end are sample numbers from the start of the stream
+SEGMENT = np.dtype([('start', '<i8'), ('end', '<i8'), ('peak', '<f8'), ('charge', '<f8'), ('burst', '?')])
+
+
+class BurstIndex(object):
+    ''' Splits a stream of average samples in A into bursts, where the DUT
+        is active, and the sleep periods between them, and keeps one SEGMENT
+        row for each: first and end sample, peak current and charge.
+        A burst starts at the first sample at or above high and lasts until
+        a sample falls below low; sleep periods shorter than min_gap seconds
+        are counted as part of the burst around them, so a radio event with
+        short gaps is one burst.
+        feed() takes a block at a time and works on the whole block with
+        numpy. Only the segment still going on and a burst waiting for the
+        end of a short sleep are carried over, both saved with the index,
+        so it can carry on from where it was saved. Queries only look at the
+        index, never at the samples.
+    '''
+    def __init__(self, high, low, interval, min_gap=0.0, start_time=0.0):
+        if low > high:
+            raise ValueError("Burst low threshold %g A above the high one %g A" % (low, high))
+        self.high = high
+        self.low = low
+        self.interval = interval
+        self.min_gap = min_gap
+        self.start_time = start_time
+        self.samples = 0                # Fed so far
+        self._gap = int(round(min_gap / interval))
+        self._rows = np.zeros(1024, dtype=SEGMENT)
+        self._count = 0
+        self._current = None            # [burst, start, peak, sum] of the segment going on
+        self._pending = []              # Burst, or burst and short sleep, that may still merge with the next burst
+        self._lock = threading.Lock()
+
+    def _params(self):
+        return np.array([self.high, self.low, self.interval, self.min_gap, self.start_time])
+
+    @property
+    def segments(self):
+        ''' The ended segments, in stream order '''
+        with self._lock:
+            return self._rows[:self._count].copy()
+
+    def __len__(self):
+        return self._count
+
+    def feed(self, samples):
+        samples = np.asarray(samples, dtype=np.float64)
+        n = len(samples)
+        if not n:
+            return
+        with self._lock:
+            state = self._states(samples)
+            carried = self._current[0] if self._current is not None else False
+            change = np.flatnonzero(np.concatenate(([carried], state[:-1])) != state)
+            edges = np.concatenate(([0], change, [n]))
+            keep = edges[1:] > edges[:-1]
+            starts, ends = edges[:-1][keep], edges[1:][keep]
+            sums = np.add.reduceat(samples, starts)
+            peaks = np.maximum.reduceat(samples, starts)
+            bursts = state[starts]
+
+            first = 0
+            if self._current is None:
+                self._current = [bool(bursts[0]), self.samples, peaks[0], sums[0]]
+                first = 1
+            elif starts[0] == 0 and not (len(change) and change[0] == 0):
+                # The block starts with more of the segment going on
+                self._current[2] = max(self._current[2], peaks[0])
+                self._current[3] += sums[0]
+                first = 1
+            ended = []
+            if first < len(starts):
+                burst, start, peak, total = self._current
+                ended.append((burst, start, self.samples + starts[first], peak, total))
+            for k in range(first, len(starts) - 1):
+                ended.append((bool(bursts[k]), self.samples + starts[k], self.samples + ends[k], peaks[k], sums[k]))
+            if first < len(starts):
+                k = len(starts) - 1
+                self._current = [bool(bursts[k]), self.samples + starts[k], peaks[k], sums[k]]
+            self.samples += n
+            for segment in ended:
+                self._end(*segment)
+
+    def _states(self, samples):
+        # True while in a burst: the last sample that was at or above high
+        # or below low decides, the ones in between keep the state
+        above = samples >= self.high
+        decisive = above | (samples < self.low)
+        last = np.where(decisive, np.arange(len(samples)), -1)
+        np.maximum.accumulate(last, out=last)
+        carried = self._current[0] if self._current is not None else False
+        return np.where(last >= 0, above[last], carried)
+
+    def _end(self, burst, start, end, peak, total):
+        # Lock must be held. A loop over segments, not samples.
+        if end <= start:
+            return
+        segment = (start, end, peak, total * self.interval, burst)
+        if burst:
+            if len(self._pending) == 2:
+                previous, gap = self._pending
+                segment = (previous[0], end, max(previous[2], gap[2], peak),
+                           previous[3] + gap[3] + segment[3], True)
+            self._pending = [segment]
+        elif self._pending and end - start < self._gap:
+            self._pending.append(segment)
+        else:
+            for row in self._pending:
+                self._append(row)
+            self._pending = []
+            self._append(segment)
+
+    def _append(self, row):
+        # Lock must be held
+        if self._count == len(self._rows):
+            rows = np.zeros(2 * len(self._rows), dtype=SEGMENT)
+            rows[:self._count] = self._rows
+            self._rows = rows
+        self._rows[self._count] = row
+        self._count += 1
+
+    def flush(self):
+        ''' End the segment going on, when the stream has ended '''
+        with self._lock:
+            if self._current is not None:
+                burst, start, peak, total = self._current
+                self._current = None
+                self._end(burst, start, self.samples, peak, total)
+            for row in self._pending:
+                self._append(row)
+            self._pending = []
+
+    # Queries
+    def bursts(self):
+        segments = self.segments
+        return segments[segments['burst']]
+
+    def sleeps(self):
+        segments = self.segments
+        return segments[~segments['burst']]
+
+    def durations(self, segments):
+        return (segments['end'] - segments['start']) * self.interval
+
+    def times(self, segments):
+        ''' Start time of the segments, from the start of the stream [s] '''
+        return segments['start'] * self.interval
+
+    def top(self, n=100, key='charge'):
+        ''' The n bursts with the highest key, 'charge', 'peak' or 'duration', highest first '''
+        bursts = self.bursts()
+        values = self.durations(bursts) if key == 'duration' else bursts[key]
+        if n < len(bursts):
+            best = np.argpartition(-values, n)[:n]
+            bursts, values = bursts[best], values[best]
+        return bursts[np.argsort(-values, kind='mergesort')]
+
+    def mean_current(self, burst=False):
+        ''' Mean current [A] over the sleep periods, or over the bursts '''
+        segments = self.bursts() if burst else self.sleeps()
+        seconds = self.durations(segments).sum()
+        return segments['charge'].sum() / seconds if seconds else 0.0
+
+    def summary(self):
+        segments = self.segments
+        bursts = segments[segments['burst']]
+        sleeps = segments[~segments['burst']]
+        burst_s = self.durations(bursts).sum()
+        sleep_s = self.durations(sleeps).sum()
+        return {'bursts': len(bursts),
+                'burst_charge': float(bursts['charge'].sum()),
+                'mean_burst_charge': float(bursts['charge'].mean()) if len(bursts) else 0.0,
+                'max_burst_charge': float(bursts['charge'].max()) if len(bursts) else 0.0,
+                'mean_burst_duration': burst_s / len(bursts) if len(bursts) else 0.0,
+                'peak': float(bursts['peak'].max()) if len(bursts) else 0.0,
+                'burst_current': float(bursts['charge'].sum() / burst_s) if burst_s else 0.0,
+                'sleep_current': float(sleeps['charge'].sum() / sleep_s) if sleep_s else 0.0,
+                'duty_cycle': burst_s / (burst_s + sleep_s) if burst_s + sleep_s else 0.0}
+
+    # Persistence
+    def save(self, path):
+        ''' Write the index to path, replacing it atomically '''
+        tmp = path + '.tmp'
+        with self._lock:
+            current = np.array(self._current if self._current is not None else [], dtype=np.float64)
+            with io.open(tmp, 'wb') as f:
+                np.savez(f, version=BURSTS_VERSION, params=self._params(), samples=self.samples,
+                         segments=self._rows[:self._count], current=current,
+                         pending=np.array(self._pending, dtype=SEGMENT))
+                f.flush()
+                os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)     # rename can't replace on Windows
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, high, low, interval, min_gap=0.0, start_time=0.0):
+        ''' The index saved at path if it was made with the same parameters,
+            otherwise a new one. Raises IOError if it can't be read.
+        '''
+        index = cls(high, low, interval, min_gap, start_time)
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != BURSTS_VERSION or \
+                        not np.allclose(data['params'], index._params(), rtol=1e-9, atol=0):
+                    return index
+                segments, current, pending = data['segments'], data['current'], data['pending']
+                samples = int(data['samples'])
+        except (IOError, OSError):
+            raise
+        except Exception as e:
+            # Whatever numpy and zipfile raise for a truncated or corrupted file
+            raise IOError("Bad burst index %s: %s" % (path, e))
+        index._rows = np.zeros(max(len(segments), 1024), dtype=SEGMENT)
+        index._rows[:len(segments)] = segments
+        index._count = len(segments)
+        index.samples = samples
+        if len(current):
+            index._current = [bool(current[0]), int(current[1]), float(current[2]), float(current[3])]
+        index._pending = [tuple(row) for row in pending.tolist()]
+        return index
+
+
+def capture_bursts(reader, high, low, min_gap=0.0, save=True):
+    ''' BurstIndex of an average capture, from the sidecar next to it if
+        there is one made with the same thresholds. Only the samples
+        recorded since it was saved are read, so it can be called again
+        while a recording grows.
+    '''
+    path = reader.path + BURSTS_EXT
+    header = reader.header
+    try:
+        index = BurstIndex.load(path, high, low, header.sample_interval, min_gap, header.start_time)
+    except (IOError, OSError):
+        index = BurstIndex(high, low, header.sample_interval, min_gap, header.start_time)
+    if index.samples > len(reader):
+        index = BurstIndex(high, low, header.sample_interval, min_gap, header.start_time)
+    if index.samples == len(reader):
+        return index
+    for first in range(index.samples, len(reader), CHUNK_SAMPLES):
+        index.feed(reader.decode(reader.samples[first:first + CHUNK_SAMPLES]))
+    if save:
+        try:
+            index.save(path)
+        except (IOError, OSError) as e:
+            print("Unable to write burst index %s: %s" % (path, e))
+    return index
+
+
+if __name__ == '__main__':
+    # python -m libs.bursts, indexing speed and query time against a rescan
+    import time
+    interval = 13e-6
+    period = 0.1                    # Advertising interval [s]
+    n = 20000000
+    rs = np.random.RandomState(0)
+    t = np.arange(n) * interval
+    phase = np.mod(t, period)
+    # Three 0.4 ms TX on 8 mA with 0.2 ms gaps at 2 mA, on 3 uA sleep
+    stream = np.where(phase < 0.0018, np.where(np.mod(phase, 0.0006) < 0.0004, 8e-3, 2e-3), 3e-6)
+    stream += rs.normal(0, 1e-6, n)
+    stream[rs.randint(0, n, 1000)] += 1e-3
+    index = BurstIndex(500e-6, 100e-6, interval, min_gap=0.001)
+    start = time.time()
+    for i in range(0, n, 16384):
+        index.feed(stream[i:i + 16384])
+    elapsed = time.time() - start
+    print("indexed %d samples (%.0f s) at %.1f M samples/s, %d segments"
+          % (n, n * interval, n / elapsed / 1e6, len(index)))
+    start = time.time()
+    top = index.top(100)
+    sleep = index.mean_current()
+    queried = time.time() - start
+    start = time.time()
+    rescan = stream[stream < 100e-6].mean()
+    rescanned = time.time() - start
+    print("top 100 and mean sleep current from the index: %.3f ms, rescan: %.1f ms"
+          % (queried * 1e3, rescanned * 1e3))
+    print(index.summary())
@@ -0,0 +1,144 @@
+from __future__ import print_function
+import math
+import threading
+import numpy as np
+
+LIFETIME = 'lifetime'   # Accumulator that runs from the creation of the integrator
+
+
+class ChargeReading(object):
+    ''' Totals of one accumulator '''
+    def __init__(self, charge=0.0, energy=0.0, seconds=0.0, samples=0):
+        self.charge = charge        # [C]
+        self.energy = energy        # [J]
+        self.seconds = seconds      # Time covered by the samples [s]
+        self.samples = samples
+
+    def __add__(self, other):
+        return ChargeReading(self.charge + other.charge, self.energy + other.energy,
+                             self.seconds + other.seconds, self.samples + other.samples)
+
+    def __sub__(self, other):
+        return ChargeReading(self.charge - other.charge, self.energy - other.energy,
+                             self.seconds - other.seconds, self.samples - other.samples)
+
+    def as_dict(self):
+        return {'charge': self.charge, 'energy': self.energy,
+                'seconds': self.seconds, 'samples': self.samples}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['charge'], d['energy'], d['seconds'], d['samples'])
+
+    @property
+    def mAh(self):
+        return self.charge / 3.6
+
+    @property
+    def mWh(self):
+        return self.energy / 3.6
+
+    @property
+    def current(self):
+        ''' Average current [A] '''
+        return self.charge / self.seconds if self.seconds else 0.0
+
+
+class ChargeIntegrator(object):
+    ''' Coulomb counter over the average samples.
+        Every sample adds current * interval to the charge and charge * vdd
+        to the energy, with the interval and vdd in effect when it was
+        measured. Only the lifetime totals are updated per sample; a named
+        accumulator remembers the totals at its start (and stop), so any
+        number of them cost nothing extra.
+        add() takes one sample or an array of them.
+    '''
+    def __init__(self):
+        # Lifetime totals as Kahan sums [value, compensation], so they stay
+        # exact to rounding over billions of samples
+        self._charge = [0.0, 0.0]
+        self._energy = [0.0, 0.0]
+        self._seconds = [0.0, 0.0]
+        self._samples = 0
+        self._started = {}      # name: totals at start
+        self._stopped = {}      # name: reading when stopped
+        self._lock = threading.Lock()
+
+    def add(self, amps, interval, vdd):
+        ''' Integrate samples [A] taken interval s apart at vdd [mV] '''
+        if isinstance(amps, float):
+            n = 1
+            charge = amps * interval
+        else:
+            amps = np.asarray(amps, dtype=np.float64).ravel()
+            n = len(amps)
+            charge = math.fsum(amps) * interval
+        with self._lock:
+            for total, x in ((self._charge, charge),
+                             (self._energy, charge * vdd / 1000.0),
+                             (self._seconds, n * interval)):
+                y = x - total[1]
+                t = total[0] + y
+                total[1] = (t - total[0]) - y
+                total[0] = t
+            self._samples += n
+
+    def _totals(self):
+        # Lock must be held
+        return ChargeReading(self._charge[0], self._energy[0], self._seconds[0], self._samples)
+
+    def start(self, name):
+        ''' Start, or restart from zero, the accumulator name '''
+        with self._lock:
+            self._started[name] = self._totals()
+            self._stopped.pop(name, None)
+
+    def stop(self, name):
+        ''' Freeze the accumulator name, returns its reading '''
+        with self._lock:
+            if name not in self._stopped:
+                self._stopped[name] = self._totals() - self._started.get(name, ChargeReading())
+            return self._stopped[name]
+
+    def remove(self, name):
+        with self._lock:
+            self._started.pop(name, None)
+            self._stopped.pop(name, None)
+
+    def read(self, name=LIFETIME):
+        ''' Reading of the accumulator name, zero if it was never started '''
+        with self._lock:
+            if name in self._stopped:
+                return self._stopped[name]
+            if name == LIFETIME:
+                return self._totals()
+            if name not in self._started:
+                return ChargeReading()
+            return self._totals() - self._started[name]
+
+    def names(self):
+        with self._lock:
+            return [LIFETIME] + sorted(self._started)
+
+
+if __name__ == '__main__':
+    # python -m libs.charge, integration cost per sample and per block
+    import time
+    integrator = ChargeIntegrator()
+    integrator.start('session')
+    samples = np.random.exponential(1e-3, 1000000)
+
+    start = time.time()
+    for sample in samples[:100000].tolist():
+        integrator.add(sample, 130e-6, 3000)
+    print("Sample by sample: %.2f us per sample" % ((time.time() - start) * 10))
+
+    start = time.time()
+    for block in np.split(samples, 1000):
+        integrator.add(block, 130e-6, 3000)
+    print("Blocks of 1000: %.0f M samples/s" % (1.0 / (time.time() - start)))
+
+    reading = integrator.read('session')
+    exact = math.fsum(samples[:100000]) * 130e-6 + math.fsum(samples) * 130e-6
+    print("%.6f mAh, %.6f mWh over %.1f s, error %.1e relative"
+          % (reading.mAh, reading.mWh, reading.seconds, abs(reading.charge - exact) / exact))
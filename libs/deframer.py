@@ -0,0 +1,156 @@
+from __future__ import print_function
+import re
+import sys
+import time
+
+STX = 0x02
+ETX = 0x03
+ESC = 0x1F
+
+MODE_IDLE = 0
+MODE_RECV = 1
+MODE_ESC_RECV = 2
+
+STX_B = b'\x02'
+ETX_B = b'\x03'
+ESC_B = b'\x1f'
+
+# A frame: STX, then plain bytes or ESC pairs, then ETX. A frame still being
+# received matches at the end of the data instead of the ETX.
+# Written as an unrolled loop so a frame that fails to match can't backtrack.
+_FRAME = re.compile(b'\x02([^\x02\x03\x1f]*(?:\x1f[\x00-\xff][^\x02\x03\x1f]*)*)(\x03|\x1f?\\Z)')
+_ESC_PAIR = re.compile(b'\x1f[\x00-\xff]')
+_UNESCAPED = dict((bytes(bytearray([ESC, b])), bytes(bytearray([b ^ 0x20]))) for b in range(256))
+
+
+_SPECIAL = re.compile(b'[\x02\x03\x1f]')
+_ESCAPED = dict((bytes(bytearray([b])), bytes(bytearray([ESC, b ^ 0x20]))) for b in (STX, ETX, ESC))
+
+
+def stuff(payload):
+    ''' Frame a payload with STX/ETX, escaping any STX, ETX and ESC bytes in it.
+        Returns a bytearray.
+    '''
+    if not isinstance(payload, bytes):
+        payload = bytes(bytearray(payload))
+    if _SPECIAL.search(payload):
+        payload = _SPECIAL.sub(lambda m: _ESCAPED[m.group()], payload)
+    return bytearray(STX_B + payload + ETX_B)
+
+
+def unescape(raw):
+    ''' Replace every ESC pair in a frame payload with the escaped byte '''
+    return _ESC_PAIR.sub(lambda m: _UNESCAPED[m.group()], raw)
+
+
+class Deframer(object):
+    ''' Splits the RTT byte stream into frames a whole chunk at a time.
+        All STX..ETX frames in a chunk are found in one regex pass, and only
+        the frames containing ESC are unescaped. An unescaped STX inside a
+        frame restarts it, as in the byte loop. A partial frame at the end
+        of a chunk is kept and completed by the next chunk.
+        Frames are returned as immutable bytes.
+    '''
+    def __init__(self):
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.reset()
+
+    def reset(self):
+        ''' Drop any partially received frame '''
+        self._partial = b''     # From the STX of the frame in progress
+
+    def feed(self, chunk):
+        ''' Deframe a chunk of bytes, returns a list with the completed frames '''
+        self.bytes_in += len(chunk)
+        found = _FRAME.findall(self._partial + bytes(chunk))
+
+        self._partial = b''
+        if found and found[-1][1] != ETX_B:
+            payload, end = found.pop()
+            self._partial = STX_B + payload + end
+
+        frames = [unescape(payload) if ESC_B in payload else payload for payload, end in found]
+        self.frames_out += len(frames)
+        return frames
+
+
+class ByteDeframer(object):
+    ''' Reference implementation, the STX/ETX/ESC state machine run one byte
+        at a time. Kept for verifying and benchmarking Deframer.
+    '''
+    def __init__(self):
+        self.read_mode = MODE_IDLE
+        self.data_buffer = []
+
+    def feed(self, chunk):
+        frames = []
+        for n in bytearray(chunk):
+            if self.read_mode == MODE_IDLE:
+                if n == STX:
+                    self.read_mode = MODE_RECV
+
+            elif self.read_mode == MODE_RECV:
+                if n == ESC:
+                    self.read_mode = MODE_ESC_RECV
+                elif n == ETX:
+                    frames.append(bytes(bytearray(self.data_buffer)))
+                    self.data_buffer[:] = []
+                    self.read_mode = MODE_IDLE
+                elif n == STX:
+                    self.data_buffer[:] = []
+                else:
+                    self.data_buffer.append(n)
+
+            elif self.read_mode == MODE_ESC_RECV:
+                self.data_buffer.append(n ^ 0x20)
+                self.read_mode = MODE_RECV
+        return frames
+
+
+def synthetic_stream(avg_frames=100000, trig_every=100, trig_samples=256):
+    ''' Byte stream of stuffed average frames with a trigger frame every
+        trig_every average frames, similar to what the PPK sends.
+    '''
+    import numpy as np
+    rnd = np.random.RandomState(0)
+    out = bytearray()
+    avg = (rnd.rand(avg_frames) * 1000).astype('<f4')
+    for i in range(avg_frames):
+        out += stuff(avg[i:i + 1].tobytes())
+        if trig_every and i % trig_every == 0:
+            out += stuff(rnd.randint(0, 0xFFFF, trig_samples).astype('<u2').tobytes())
+    return bytes(out)
+
+
+def benchmark(stream, chunk_size=10000, repeat=3):
+    ''' Deframe stream in chunk_size pieces with both implementations.
+        Returns a dict with the throughput in MB/s for each.
+    '''
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+    result = {}
+    for name, cls in (('byte_loop', ByteDeframer), ('deframer', Deframer)):
+        best = None
+        for _ in range(repeat):
+            deframer = cls()
+            t0 = time.time()
+            frames = 0
+            for chunk in chunks:
+                frames += len(deframer.feed(chunk))
+            t = time.time() - t0
+            best = t if best is None else min(best, t)
+        result[name] = {'mb_per_s': len(stream) / best / 1e6, 'frames': frames}
+    return result
+
+
+if __name__ == '__main__':
+    # python -m libs.deframer [recorded_stream.bin]
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthetic_stream()
+    result = benchmark(stream)
+    for name in ('byte_loop', 'deframer'):
+        print("%-10s %8.2f MB/s  %d frames" % (name, result[name]['mb_per_s'], result[name]['frames']))
+    print("speedup    %8.1fx" % (result['deframer']['mb_per_s'] / result['byte_loop']['mb_per_s']))
@@ -0,0 +1,359 @@
+from __future__ import print_function
+import numpy as np
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import libs.rtt as rtt
+from libs.measurement import SAMPLE_INTERVAL, MEAS_RANGE_NONE, decode_trigger
+from libs.charge import ChargeIntegrator
+from libs.metrics import REGISTRY
+from libs.offload import DecoderProcess
+import libs.protocol as protocol
+from libs.protocol import RTT_COMMANDS, Calibration     # Were defined here before protocol.py
+
+# Offset calibration, frames measured with the DUT off and the part averaged
+CALIBRATION_FRAMES = 10000
+CALIBRATION_SKIP   = 1000
+CALIBRATION_END    = 8000
+
+
+class PPKDevice(object):
+    ''' Power Profiler Kit acquisition without any GUI.
+        Owns the RTT connection, sends the commands and decodes the measurements.
+        Results are passed to the callbacks added with on_average, on_averages,
+        on_trigger and on_calibration, all called from the RTT decoder thread,
+        or can be iterated over with samples().
+        The average frames of each batch from the RTT are decoded together,
+        on_averages gets them as one array.
+        With offload the frames are deframed and decoded by a DecoderProcess,
+        and the arrays passed to the on_trigger callbacks are views of its
+        shared memory, only valid during the call.
+    '''
+    def __init__(self, api=rtt.API.API, registry=REGISTRY, snr=None, offload=False):
+        self.api = api
+        self.registry = registry
+        self.snr = snr                      # Serial number of the emulator, any one if None
+        self.offload = offload
+        self.decoder = None
+        self.rtt = None
+        self.calibration = None
+        self.res_lo  = None
+        self.res_mid = None
+        self.res_hi  = None
+        self.vdd = 3000
+        self.sample_interval = SAMPLE_INTERVAL
+        self.avg_samples = 10
+        self.avg_interval = SAMPLE_INTERVAL * self.avg_samples
+        self.global_offset = 0.0
+        self.current_meas_range = MEAS_RANGE_NONE
+        self.invalid_range_count = 0
+        self.charge = ChargeIntegrator()    # Every average sample outside calibration
+        self.dut_on = True                  # The PPK powers the DUT after reset
+
+        self.calibrating = False
+        self._calibration_counter = None
+        self._calibration_samples = []
+
+        self.average_callbacks = []
+        self.averages_callbacks = []
+        self.trigger_callbacks = []
+        self.raw_trigger_callbacks = []
+        self.calibration_callbacks = []
+        self.dut_callbacks = []
+
+        labels = {'snr': str(snr)} if snr is not None else {}
+        self._labels = labels or None
+        self._average_frames = registry.counter('frames_total', "Frames decoded", dict(labels, type='average'))
+        self._trigger_frames = registry.counter('frames_total', "Frames decoded", dict(labels, type='trigger'))
+        self._invalid_samples = registry.counter('invalid_range_samples_total',
+                                                 "Trigger samples without a valid measurement range", labels)
+
+    def connect(self):
+        ''' Open the debugger and start RTT, the PPK is reset '''
+        if self.offload:
+            # Before the debugger library starts any threads
+            self.decoder = DecoderProcess(self, registry=self.registry, labels=self._labels)
+            self.decoder.start()
+        try:
+            self.rtt = rtt.rtt(self.handle_frames, batch=True, api=self.api, registry=self.registry, snr=self.snr,
+                               raw_callback=self.decoder.feed if self.decoder else None)
+        except BaseException:
+            if self.decoder:
+                self.decoder.close()
+            raise
+
+    def disconnect(self):
+        ''' Stop receiving, the frames already read are still handled '''
+        self.rtt.stop()
+        if self.decoder:
+            self.decoder.close()
+
+    def start(self):
+        ''' Read the calibration values and start receiving measurements.
+            Raises ValueError if the calibration banner can't be parsed.
+        '''
+        data = self.rtt.nrfjprog.rtt_read(0, 200)
+        self.calibration = Calibration(data)
+        self.res_lo  = self.calibration.res_lo
+        self.res_mid = self.calibration.res_mid
+        self.res_hi  = self.calibration.res_hi
+        self.vdd = self.calibration.vdd
+        if self.decoder:
+            self.decoder.update_params()
+        self.rtt.start()
+
+    def on_average(self, callback):
+        ''' callback(sample_A) for every average sample '''
+        self.average_callbacks.append(callback)
+
+    def on_averages(self, callback):
+        ''' callback(samples_A) with an array of average samples, cheaper than on_average '''
+        self.averages_callbacks.append(callback)
+
+    def on_trigger(self, callback):
+        ''' callback(amps, ranges) for every trigger packet '''
+        self.trigger_callbacks.append(callback)
+
+    def on_trigger_raw(self, callback):
+        ''' callback(data) with the undecoded bytes of every trigger packet '''
+        self.raw_trigger_callbacks.append(callback)
+
+    def on_calibration(self, callback):
+        ''' callback(done), with done False when the offset calibration starts
+            and True when it is finished.
+        '''
+        self.calibration_callbacks.append(callback)
+
+    def on_dut_power(self, callback):
+        ''' callback(on) after the DUT power is switched '''
+        self.dut_callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        for callbacks in (self.average_callbacks, self.averages_callbacks, self.trigger_callbacks,
+                          self.raw_trigger_callbacks, self.calibration_callbacks,
+                          self.dut_callbacks):
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def samples(self, maxsize=100000, timeout=None):
+        ''' Iterate over ('average', sample_A) and ('trigger', amps) tuples.
+            Stops when no data arrives within timeout seconds.
+        '''
+        q = queue.Queue(maxsize)
+        average = lambda sample: q.put(('average', sample))
+        trigger = lambda amps, ranges: q.put(('trigger', amps))
+        self.on_average(average)
+        self.on_trigger(trigger)
+        try:
+            while True:
+                try:
+                    yield q.get(timeout=timeout)
+                except queue.Empty:
+                    return
+        finally:
+            # Nobody empties the queue any more, a full one would block the decoders
+            self.remove_callback(average)
+            self.remove_callback(trigger)
+
+    # Commands, all raise rtt.CommandError if the PPK can't be reached
+    def write(self, cmd):
+        self.rtt.write_stuffed(cmd)
+
+    def batch(self):
+        ''' with device.batch(): commands in the block are sent in one write at its end '''
+        return self.rtt.commands.batch()
+
+    def run(self):
+        self.write(protocol.RUN.encode())
+
+    def stop(self):
+        self.write(protocol.STOP.encode())
+
+    def set_trigger(self, trigger):
+        ''' Trigger level in uA '''
+        self.write(protocol.TRIGGER_SET.encode(trigger))
+
+    def single_trigger(self, trigger):
+        self.write(protocol.SINGLE_TRIG.encode(trigger))
+
+    def trigger_stop(self):
+        self.write(protocol.TRIG_STOP.encode())
+
+    def set_trigger_window(self, samples):
+        self.write(protocol.TRIG_WINDOW_SET.encode(samples))
+
+    def toggle_external_trigger(self):
+        self.write(protocol.TOGGLE_EXT_TRIG.encode())
+
+    def set_average_samples(self, samples):
+        ''' Number of samples averaged per average sample, in steps of 10 '''
+        self.write(protocol.AVG_NUM_SET.encode(samples // 10))
+        self.avg_samples = samples
+        self.avg_interval = SAMPLE_INTERVAL * samples
+
+    def set_range(self, meas_range):
+        ''' 0: 10uA, 1: 1mA, 2: 100mA, 3: auto '''
+        self.write(protocol.RANGE_SET.encode(meas_range))
+
+    def dut_power(self, on):
+        self._write_dut(on)
+        self.dut_on = bool(on)
+        for callback in self.dut_callbacks:
+            callback(self.dut_on)
+
+    def _write_dut(self, on):
+        # Switch the DUT without changing dut_on, for the offset calibration
+        self.write(protocol.DUT.encode(1 if on else 0))
+
+    def set_vdd(self, target_vdd):
+        ''' Set VDD in mV, large changes are done in 100 mV steps '''
+        if abs(target_vdd - self.vdd) > 350:
+            step = 100 if target_vdd > self.vdd else -100
+            values = list(range(self.vdd + step, target_vdd, step)) + [target_vdd]
+        else:
+            values = [target_vdd]
+        with self.batch():
+            for value in values:
+                self.write(protocol.SETVDD.encode(value))
+        self.vdd = target_vdd
+
+    def set_vref_hi(self, switch_up):
+        ''' Switch up point, as the value of the GUI slider '''
+        pot = 27000.0 * ((10.98194 * switch_up / 1000) / 0.41 - 1)
+        self.write(protocol.SETVREFHI.encode(int(pot / 2)))
+
+    def set_vref_lo(self, switch_down):
+        ''' Switch down hysteresis, as the value of the GUI slider '''
+        pot = 2000.0 * (16.3 * switch_down / 100.0 - 1) - 30000.0
+        self.write(protocol.SETVREFLO.encode(int(pot / 2)))
+
+    def set_user_resistors(self, r_lo, r_mid, r_hi):
+        ''' Store user calibrated measurement resistors in the PPK and use them '''
+        self.write(protocol.SET_RES_USER.encode(r_lo, r_mid, r_hi))
+        self.res_lo  = r_lo
+        self.res_mid = r_mid
+        self.res_hi  = r_hi
+
+    def calibrate_offset(self):
+        ''' Measure the offset with the DUT off for CALIBRATION_FRAMES frames '''
+        self.global_offset = 0.0
+        self._calibration_counter = None
+        self.calibrating = True
+
+    # Decoding
+    def _calibration_step(self, sample_A):
+        # One frame during the offset calibration, sample_A is None for trigger frames
+        if self._calibration_counter is None:
+            self._calibration_counter = CALIBRATION_FRAMES
+            self._calibration_samples = []
+            self._write_dut(False)
+            for callback in self.calibration_callbacks:
+                callback(False)
+
+        if self._calibration_counter:
+            self._calibration_counter -= 1
+            if sample_A is not None:
+                self._calibration_samples.append(sample_A)
+        else:
+            # Got all the samples
+            samples = self._calibration_samples[CALIBRATION_SKIP:CALIBRATION_END]
+            if samples:
+                self.global_offset = np.average(samples)
+            self.calibrating = False
+            self._calibration_counter = None
+            self._write_dut(self.dut_on)     # As it was, the DUT callbacks never saw it go off
+            for callback in self.calibration_callbacks:
+                callback(True)
+
+    def handle_frames(self, frames):
+        ''' A batch of frames from the RTT. The average frames in it are
+            decoded in one go, one at a time only during calibration.
+        '''
+        if self.calibrating:
+            for data in frames:
+                self.handle_frame(data)
+            return
+        averages = [data for data in frames if protocol.is_average(data)]
+        self._average_frames.inc(len(averages))
+        self._trigger_frames.inc(len(frames) - len(averages))
+        if averages:
+            samples = protocol.decode_averages(averages).astype(np.float64)
+            samples /= 1e6
+            samples -= self.global_offset
+            self.charge.add(samples, self.avg_interval, self.vdd)
+            self._deliver_averages(samples)
+        if len(averages) < len(frames):
+            for data in frames:
+                if not protocol.is_average(data):
+                    self._handle_trigger(data)
+
+    def handle_frame(self, data):
+        ''' One frame, 4 bytes for avg window, 16 bytes for trigger window '''
+        if self.calibrating:
+            self._calibration_step(protocol.decode_average(data) / 1e6 if protocol.is_average(data) else None)
+
+        if protocol.is_average(data):
+            self._average_frames.inc()
+            sample_A = protocol.decode_average(data) / 1e6 - self.global_offset
+            if not self.calibrating:
+                self.charge.add(sample_A, self.avg_interval, self.vdd)
+            self._deliver_averages(np.array([sample_A]))
+        else:  # Trigger data received
+            self._trigger_frames.inc()
+            self._handle_trigger(data)
+
+    def handle_decoded_averages(self, samples, frames):
+        ''' Average samples in A without the offset, decoded by the DecoderProcess '''
+        self._average_frames.inc(frames)
+        if self.calibrating:
+            # As handle_frame does, one sample at a time
+            corrected = []
+            for sample_A in samples.tolist():
+                if self.calibrating:
+                    self._calibration_step(sample_A)
+                sample_A -= self.global_offset
+                if not self.calibrating:
+                    self.charge.add(sample_A, self.avg_interval, self.vdd)
+                corrected.append(sample_A)
+            self._deliver_averages(np.array(corrected))
+            return
+        samples = samples - self.global_offset
+        self.charge.add(samples, self.avg_interval, self.vdd)
+        self._deliver_averages(samples)
+
+    def handle_decoded_trigger(self, raw, amps, ranges, invalid, frames):
+        ''' Trigger samples decoded by the DecoderProcess, with their raw bytes '''
+        self._trigger_frames.inc(frames)
+        if self.calibrating:
+            for i in range(frames):
+                self._calibration_step(None)
+        if self.raw_trigger_callbacks:
+            raw = raw.tobytes()
+        self._deliver_trigger(raw, amps, ranges, invalid)
+
+    def _deliver_averages(self, samples):
+        for callback in self.averages_callbacks:
+            callback(samples)
+        if self.average_callbacks:
+            for sample_A in samples.tolist():
+                for callback in self.average_callbacks:
+                    callback(sample_A)
+
+    def _handle_trigger(self, data):
+        ranges, amps, invalid = decode_trigger(data, self.res_lo, self.res_mid, self.res_hi,
+                                               self.global_offset)
+        self._deliver_trigger(data, amps, ranges, invalid)
+
+    def _deliver_trigger(self, data, amps, ranges, invalid):
+        for callback in self.raw_trigger_callbacks:
+            callback(data)
+        if len(amps):
+            self.current_meas_range = int(ranges[-1])
+        if invalid:
+            self.invalid_range_count += invalid
+            self._invalid_samples.inc(invalid)
+            print("Range not detected for %d of %d samples (%d in total)"
+                  % (invalid, len(amps), self.invalid_range_count))
+        for callback in self.trigger_callbacks:
+            callback(amps, ranges)
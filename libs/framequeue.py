@@ -0,0 +1,118 @@
+import threading
+
+# What put does when the queue is full
+DROP_BLOCK  = 'block'           # Wait for the decoders to make room
+DROP_OLDEST = 'drop-oldest'     # Overwrite the oldest queued frames
+DROP_NEWEST = 'drop-newest'     # Discard the incoming frames
+
+DROP_POLICIES = (DROP_BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class FrameQueue(object):
+    ''' Bounded queue of frames between the RTT reader and the decoders.
+        The slots are preallocated as a fixed size ring, frames are added and
+        removed in batches with slice copies under one lock.
+        depth, high_water and dropped can be read at any time.
+    '''
+    def __init__(self, size=100000, policy=DROP_OLDEST):
+        if policy not in DROP_POLICIES:
+            raise ValueError("Unknown drop policy %s, use one of %s" % (policy, ', '.join(DROP_POLICIES)))
+        self.size = int(size)
+        self.policy = policy
+        self.high_water = 0     # Highest depth seen
+        self.dropped = 0        # Frames lost because the queue was full
+        self.frames_in = 0
+        self.closed = False
+
+        self._slots = [None] * self.size
+        self._head = 0          # Oldest queued frame
+        self._count = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    @property
+    def depth(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    def _write(self, frames):
+        # Copy frames in after the newest, lock must be held and room available
+        tail = (self._head + self._count) % self.size
+        first = min(len(frames), self.size - tail)
+        self._slots[tail:tail + first] = frames[:first]
+        self._slots[:len(frames) - first] = frames[first:]
+        self._count += len(frames)
+
+    def _discard(self, n):
+        # Drop the n oldest frames, lock must be held
+        first = min(n, self.size - self._head)
+        self._slots[self._head:self._head + first] = [None] * first
+        self._slots[:n - first] = [None] * (n - first)
+        self._head = (self._head + n) % self.size
+        self._count -= n
+
+    def put(self, frame):
+        self.put_many([frame])
+
+    def put_many(self, frames):
+        ''' Queue a list of frames, applying the drop policy if they don't fit '''
+        frames = list(frames)
+        with self._lock:
+            self.frames_in += len(frames)
+            while frames:
+                if self.closed:
+                    self.dropped += len(frames)
+                    break
+                free = self.size - self._count
+
+                if len(frames) > free:
+                    if self.policy == DROP_NEWEST:
+                        self.dropped += len(frames) - free
+                        frames = frames[:free]
+                    elif self.policy == DROP_OLDEST:
+                        if len(frames) > self.size:
+                            self.dropped += len(frames) - self.size
+                            frames = frames[-self.size:]
+                        overflow = len(frames) - free
+                        self._discard(overflow)
+                        self.dropped += overflow
+                        free += overflow
+                    elif free == 0:
+                        self._not_full.wait()
+                        continue
+
+                batch = frames[:free]
+                frames = frames[free:]
+                if batch:
+                    self._write(batch)
+                    self.high_water = max(self.high_water, self._count)
+                    self._not_empty.notify()
+
+    def get_batch(self, max_frames=1024, timeout=None):
+        ''' Remove and return up to max_frames of the oldest frames.
+            Waits for frames to arrive; returns an empty list on timeout or
+            when the queue is closed and empty.
+        '''
+        with self._lock:
+            if self._count == 0 and not self.closed:
+                self._not_empty.wait(timeout)
+            n = min(max_frames, self._count)
+            if n == 0:
+                return []
+            first = min(n, self.size - self._head)
+            batch = self._slots[self._head:self._head + first] + self._slots[:n - first]
+            self._discard(n)
+            self._not_full.notify_all()
+            if self._count:
+                self._not_empty.notify()    # Let another decoder take the rest
+            return batch
+
+    def close(self):
+        ''' Wake up all waiting threads, later puts are dropped '''
+        with self._lock:
+            self.closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
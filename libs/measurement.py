@@ -0,0 +1,47 @@
+import numpy as np
+
+# Raw sample format of the PPK, shared by the live decoding and saved captures
+SAMPLE_INTERVAL = 13.0e-6
+ADC_REF = 0.6
+ADC_GAIN = 4.0
+ADC_MAX = 8192.0
+
+MEAS_RANGE_NONE = 0
+MEAS_RANGE_LO = 1
+MEAS_RANGE_MID = 2
+MEAS_RANGE_HI = 3
+MEAS_RANGE_INVALID = 4
+
+MEAS_RANGE_POS = 14
+MEAS_RANGE_MSK = (3 << 14)
+
+MEAS_ADC_POS = 0
+MEAS_ADC_MSK = 0x3FFF
+
+
+def decode_samples(samples, res_lo, res_mid, res_hi, offset=0.0):
+    ''' Decode an array of 16 bit samples in one go.
+        Returns the range codes, the samples in A and the number of samples
+        that arrived without a valid measurement range (INVALID/NONE).
+    '''
+    ranges = (samples & MEAS_RANGE_MSK) >> MEAS_RANGE_POS
+    adc_val = (samples & MEAS_ADC_MSK) >> MEAS_ADC_POS
+
+    # A per LSB for each range, indexed by the range code. NONE gives 0 A.
+    scale = np.array([0.0,
+                      ADC_REF / (ADC_GAIN * ADC_MAX * res_lo),
+                      ADC_REF / (ADC_GAIN * ADC_MAX * res_mid),
+                      ADC_REF / (ADC_GAIN * ADC_MAX * res_hi)])
+    amps = adc_val * scale[ranges]
+    # Offset is only calibrated for the LO range
+    amps[ranges == MEAS_RANGE_LO] -= offset
+
+    invalid = int(np.count_nonzero((ranges < MEAS_RANGE_LO) | (ranges > MEAS_RANGE_HI)))
+    return ranges, amps, invalid
+
+
+def decode_trigger(data, res_lo, res_mid, res_hi, offset=0.0):
+    ''' Decode a whole trigger packet, see decode_samples '''
+    raw = bytearray(data)
+    samples = np.frombuffer(bytes(raw[:len(raw) & ~1]), dtype='<u2')
+    return decode_samples(samples, res_lo, res_mid, res_hi, offset)
@@ -0,0 +1,313 @@
+from __future__ import print_function
+import bisect
+import json
+import os
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+RATE_PERIOD     = 1.0       # Counters report their rate over about this long [s]
+EXPORT_INTERVAL = 1.0       # [s]
+EXPORT_HOST     = '127.0.0.1'
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0, 3.0)
+BYTES_BUCKETS   = (0, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+COUNT_BUCKETS   = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % item for item in sorted(labels.items())))
+
+
+class Counter(object):
+    ''' Only goes up '''
+    kind = 'counter'
+
+    def __init__(self, name, help='', labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self.rate = 0.0             # Per second, over the last RATE_PERIOD when read
+        self._period_start = time.time()
+        self._period_value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def read(self):
+        now = time.time()
+        elapsed = now - self._period_start
+        if elapsed >= RATE_PERIOD:
+            value = self.value
+            self.rate = (value - self._period_value) / elapsed
+            self._period_start = now
+            self._period_value = value
+        return {'value': self.value, 'rate': self.rate}
+
+
+class Gauge(object):
+    ''' A value that goes up and down, set() or read from func when exported '''
+    kind = 'gauge'
+
+    def __init__(self, name, help='', labels=None, func=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        if self.func is not None:
+            try:
+                self.value = self.func()
+            except Exception:
+                pass        # Keep the last value if the source is gone
+        return {'value': self.value}
+
+
+class Histogram(object):
+    ''' Counts of observations at or below each bucket bound, plus count,
+        sum and max. observe() is a bisect and a few adds under a lock.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help='', labels=None, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)     # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def time(self):
+        ''' with histogram.time(): observes how long the block took '''
+        return _Timer(self)
+
+    def quantile(self, q):
+        ''' Upper bound of the bucket holding the q quantile, None before any observation '''
+        with self._lock:
+            counts = list(self._counts)
+            count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.buckets + (self.max,), counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def read(self):
+        with self._lock:
+            cumulative = []
+            seen = 0
+            for n in self._counts:
+                seen += n
+                cumulative.append(seen)
+            result = {'count': self.count, 'sum': self.sum, 'max': self.max,
+                      'buckets': list(zip([str(b) for b in self.buckets] + ['+Inf'], cumulative))}
+        result['mean'] = result['sum'] / result['count'] if result['count'] else None
+        result['p50'] = self.quantile(0.5)
+        result['p99'] = self.quantile(0.99)
+        return result
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start)
+
+
+class Registry(object):
+    ''' The metrics of a process, by name and labels. counter(), gauge() and
+        histogram() return the existing metric if it was made before, so
+        every user can ask for it by name.
+    '''
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **options):
+        key = _key(name, labels)
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(name, help, labels, **options)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric %s is a %s" % (key, metric.kind))
+            return metric
+
+    def counter(self, name, help='', labels=None):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=None, func=None):
+        gauge = self._get(Gauge, name, help, labels)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, help='', labels=None, buckets=SECONDS_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return [self._metrics[key] for key in sorted(self._metrics)]
+
+    def snapshot(self):
+        ''' {key: reading} of all metrics, with the time it was taken '''
+        return {'time': time.time(),
+                'metrics': dict((_key(m.name, m.labels), dict(m.read(), kind=m.kind)) for m in self.metrics())}
+
+    def prometheus(self):
+        ''' All metrics in the Prometheus text exposition format '''
+        lines = []
+        described = set()
+        for metric in self.metrics():
+            if metric.name not in described:
+                described.add(metric.name)
+                if metric.help:
+                    lines.append('# HELP %s %s' % (metric.name, metric.help))
+                lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            reading = metric.read()
+            if metric.kind == 'histogram':
+                for bound, count in reading['buckets']:
+                    labels = dict(metric.labels, le=bound)
+                    lines.append('%s %d' % (_key(metric.name + '_bucket', labels), count))
+                lines.append('%s %r' % (_key(metric.name + '_sum', metric.labels), float(reading['sum'])))
+                lines.append('%s %d' % (_key(metric.name + '_count', metric.labels), reading['count']))
+            else:
+                lines.append('%s %r' % (_key(metric.name, metric.labels), float(reading['value'])))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()       # Used by everything unless given another one
+
+
+def write_snapshot(registry, path):
+    ''' Write registry.snapshot() to path as JSON, replacing it atomically '''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(registry.snapshot(), f, indent=1, sort_keys=True)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)     # rename can't replace on Windows
+    os.rename(tmp, path)
+
+
+class MetricsExporter(object):
+    ''' Makes a registry readable from outside the process: a JSON snapshot
+        rewritten at path every interval seconds, and/or the Prometheus
+        text format at http://127.0.0.1:port/metrics.
+    '''
+    def __init__(self, registry=REGISTRY, path=None, port=None, interval=EXPORT_INTERVAL):
+        self.registry = registry
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self._stop = threading.Event()
+        self._threads = []
+        self._server = None
+
+    def start(self):
+        if self.port is not None:
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = registry.prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = HTTPServer((EXPORT_HOST, self.port), Handler)
+            self.port = self._server.server_address[1]      # When 0 picked a free port
+            self._spawn(self._server.serve_forever)
+        if self.path:
+            self._spawn(self.t_write)
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+        self._threads.append(thread)
+
+    def t_write(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            write_snapshot(self.registry, self.path)
+        except (IOError, OSError) as e:
+            print("Unable to write metrics %s: %s" % (self.path, e))
+
+    def close(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.path:
+            self.write()
+
+
+if __name__ == '__main__':
+    # python -m libs.metrics, cost of the hot path calls
+    registry = Registry()
+    counter = registry.counter('frames_total', labels={'type': 'average'})
+    histogram = registry.histogram('decode_batch_seconds')
+    n = 200000
+    start = time.time()
+    for i in range(n):
+        counter.inc(1024)
+    print("Counter.inc:       %.3f us" % ((time.time() - start) / n * 1e6))
+    start = time.time()
+    for i in range(n):
+        histogram.observe(0.001)
+    print("Histogram.observe: %.3f us" % ((time.time() - start) / n * 1e6))
+    start = time.time()
+    for i in range(n):
+        with histogram.time():
+            pass
+    print("Histogram.time:    %.3f us" % ((time.time() - start) / n * 1e6))
+    print(registry.prometheus())
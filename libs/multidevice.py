@@ -0,0 +1,412 @@
+from __future__ import print_function
+import math
+import multiprocessing
+import threading
+import time
+import numpy as np
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import libs.rtt as rtt
+from libs.device import PPKDevice
+from libs.measurement import SAMPLE_INTERVAL
+from libs.metrics import REGISTRY
+from libs.ringbuffer import RingBuffer
+
+THREADS   = 'threads'       # Every board read and decoded by the threads of its rtt, in this process
+PROCESSES = 'processes'     # Every board in a process of its own
+MODES     = (THREADS, PROCESSES)
+
+HISTORY       = 60.0    # Average samples kept per board [s]
+OPEN_TIMEOUT  = 10.0    # For a board process to connect to its PPK [s]
+CALL_TIMEOUT  = 5.0     # For a board process to run a command [s]
+RESULT_POLL   = 0.5     # [s]
+
+
+def enum_boards(api=rtt.API.API):
+    ''' Serial numbers of the emulators connected to the computer '''
+    nrfjprog = api('NRF52')
+    nrfjprog.open()
+    try:
+        return sorted(nrfjprog.enum_emu_snr() or [])
+    finally:
+        nrfjprog.close()
+
+
+class BoardStream(object):
+    ''' The average samples of one board, on the board's own sample clock.
+        Sample n was measured at t0 + n * interval. The PPK sends no times,
+        so t0 comes from when the samples arrived: a block that arrived at
+        t was measured before t, and the smallest t - samples so far *
+        interval over all blocks is the closest bound on when the first
+        sample was measured. It only gets better as the run goes on.
+        A change of interval starts the clock over.
+    '''
+    def __init__(self, snr, interval=SAMPLE_INTERVAL * 10, history=HISTORY):
+        self.snr = snr
+        self.history = history
+        self.interval = interval
+        self.t0 = None
+        self.samples = 0            # Since the clock started
+        self.ring = RingBuffer(history / interval)
+        self.first_arrival = None
+        self.last_arrival = None
+
+        # Of every sample outside the offset calibration
+        self.count = 0
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def add(self, samples, arrival, interval, calibrating=False):
+        samples = np.asarray(samples, dtype=np.float64)
+        with self._lock:
+            if interval != self.interval:
+                self.interval = interval
+                self.t0 = None
+                self.samples = 0
+                self.ring.resize(self.history / interval)
+            self.samples += len(samples)
+            t0 = arrival - self.samples * self.interval
+            if self.t0 is None or t0 < self.t0:
+                self.t0 = t0
+            self.ring.extend(samples)
+            if self.first_arrival is None:
+                self.first_arrival = arrival
+            self.last_arrival = arrival
+
+            if calibrating or not len(samples):
+                return
+            self.count += len(samples)
+            self._sum += float(samples.sum())
+            self._sumsq += float(np.dot(samples, samples))
+            low, high = float(samples.min()), float(samples.max())
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+
+    def last_time(self):
+        ''' When the newest sample was measured, None before any '''
+        with self._lock:
+            if self.t0 is None or not self.samples:
+                return None
+            return self.t0 + (self.samples - 1) * self.interval
+
+    def window(self, start, end):
+        ''' (times, samples) of the samples kept that were measured from start to end '''
+        with self._lock:
+            if self.t0 is None:
+                return np.zeros(0), np.zeros(0)
+            first = max(self.samples - self.ring.size, 0)
+            i = max(int(math.ceil((start - self.t0) / self.interval)), first)
+            j = min(int(math.floor((end - self.t0) / self.interval)) + 1, self.samples)
+            if j <= i:
+                return np.zeros(0), np.zeros(0)
+            size = self.ring.size
+            samples = self.ring.view()[size - (self.samples - i):size - (self.samples - j)].copy()
+            return self.t0 + np.arange(i, j) * self.interval, samples
+
+    def stats(self):
+        with self._lock:
+            mean = self._sum / self.count if self.count else None
+            elapsed = (self.last_arrival or 0.0) - (self.first_arrival or 0.0)
+            return {'samples': self.count,
+                    'mean': mean,
+                    'rms': math.sqrt(self._sumsq / self.count) if self.count else None,
+                    'min': self.min,
+                    'max': self.max,
+                    'interval': self.interval,
+                    'rate': self.samples / elapsed if elapsed > 0 else 0.0,
+                    't0': self.t0}
+
+
+def _board_info(device):
+    return {'board_id': device.calibration.board_id, 'vdd': device.vdd,
+            'res_lo': device.res_lo, 'res_mid': device.res_mid, 'res_hi': device.res_hi}
+
+
+def _board_status(device):
+    return {'calibrating': device.calibrating,
+            'dropped_frames': device.rtt.queue.dropped,
+            'queue_high_water': device.rtt.queue.high_water,
+            'invalid_range': device.invalid_range_count,
+            'commands': device.rtt.commands.stats(),
+            'mAh': device.charge.read().mAh}
+
+
+class _ThreadBoard(object):
+    ''' A board handled in this process by the reader and decoder threads of its rtt '''
+    def __init__(self, snr, api, registry, deliver):
+        self.snr = snr
+        self.device = PPKDevice(api=api, registry=registry, snr=snr)
+        self.device.on_averages(self._averages)
+        self._deliver = deliver
+        self._result = None
+
+    def _averages(self, samples):
+        self._deliver(self.snr, time.time(), self.device.avg_interval, self.device.calibrating, samples)
+
+    def open(self):
+        self.device.connect()
+        self.device.start()
+        return _board_info(self.device)
+
+    def send(self, name, args):
+        try:
+            if name == 'status':
+                self._result = (True, _board_status(self.device))
+            else:
+                self._result = (True, getattr(self.device, name)(*args))
+        except Exception as e:
+            self._result = (False, e)
+
+    def reply(self):
+        ok, result = self._result
+        self._result = None
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        self.device.disconnect()
+
+
+def _board_main(snr, api, conn, results):
+    # Runs in the process of one board: measurements go to results, the
+    # commands come over conn, each answered with (ok, result or message)
+    device = PPKDevice(api=api, snr=snr)
+    device.on_averages(lambda samples: results.put((snr, time.time(), device.avg_interval,
+                                                    device.calibrating, samples)))
+    try:
+        device.connect()
+        device.start()
+    except Exception as e:
+        conn.send((False, str(e)))
+        return
+    conn.send((True, _board_info(device)))
+    while True:
+        name, args = conn.recv()
+        if name is None:
+            break
+        try:
+            if name == 'status':
+                conn.send((True, _board_status(device)))
+            else:
+                conn.send((True, getattr(device, name)(*args)))
+        except Exception as e:
+            conn.send((False, "%s: %s" % (type(e).__name__, e)))
+    device.disconnect()
+    conn.send((True, None))
+
+
+class _ProcessBoard(object):
+    ''' A board handled by a process of its own, see _board_main '''
+    def __init__(self, snr, api, results):
+        self.snr = snr
+        self._conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_board_main, args=(snr, api, child, results))
+        self.process.daemon = True
+
+    def open(self):
+        self.process.start()
+        return self._answer(OPEN_TIMEOUT)
+
+    def send(self, name, args):
+        self._conn.send((name, args))
+
+    def reply(self):
+        return self._answer(CALL_TIMEOUT)
+
+    def _answer(self, timeout):
+        if not self._conn.poll(timeout):
+            raise IOError("PPK %s did not answer" % self.snr)
+        ok, result = self._conn.recv()
+        if not ok:
+            raise IOError("PPK %s: %s" % (self.snr, result))
+        return result
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.send(None, ())
+                self.reply()
+            except (IOError, EOFError):
+                pass
+        self.process.join(CALL_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class DeviceManager(object):
+    ''' Acquisition from several PPKs at once, one per emulator serial
+        number, all of them connected if snrs is None.
+        With mode THREADS every board gets the reader and decoder threads of
+        its own rtt in this process. With PROCESSES every board runs in a
+        process of its own, so decoding scales with the number of cores
+        instead of sharing one interpreter lock; its average samples come
+        back through a queue. The metrics of a board process stay in that
+        process. api must be picklable for PROCESSES where processes are
+        spawned rather than forked (Windows).
+        The average samples of each board go to its BoardStream, which puts
+        them on a common clock for aligned(), and to the on_averages
+        callbacks. Commands are sent to every board with call().
+    '''
+    def __init__(self, snrs=None, api=rtt.API.API, mode=THREADS, registry=REGISTRY, history=HISTORY):
+        if mode not in MODES:
+            raise ValueError("Unknown mode %r, one of %s" % (mode, ', '.join(MODES)))
+        self.snrs = sorted(snrs) if snrs is not None else enum_boards(api)
+        if not self.snrs:
+            raise IOError("No emulators connected")
+        self.api = api
+        self.mode = mode
+        self.registry = registry
+        self.streams = dict((snr, BoardStream(snr, history=history)) for snr in self.snrs)
+        self.info = {}                  # snr: board id, vdd and resistors
+        self.averages_callbacks = []
+        self._boards = {}
+        self._results = None
+        self._collector = None
+        self._stop = threading.Event()
+
+    def on_averages(self, callback):
+        ''' callback(snr, samples_A) for each block of average samples, from the thread that received it '''
+        self.averages_callbacks.append(callback)
+
+    def open(self):
+        ''' Connect to every board and start receiving, IOError if one can't be reached '''
+        if self.mode == PROCESSES:
+            self._results = multiprocessing.Queue()
+            self._collector = threading.Thread(target=self.t_collect)
+            self._collector.setDaemon(True)
+            self._collector.start()
+        try:
+            for snr in self.snrs:
+                if self.mode == PROCESSES:
+                    board = _ProcessBoard(snr, self.api, self._results)
+                else:
+                    board = _ThreadBoard(snr, self.api, self.registry, self._deliver)
+                self._boards[snr] = board
+                self.info[snr] = board.open()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for board in self._boards.values():
+            board.close()
+        self._boards = {}
+        self._stop.set()
+        if self._collector is not None:
+            self._collector.join()
+            self._collector = None
+
+    def _deliver(self, snr, arrival, interval, calibrating, samples):
+        self.streams[snr].add(samples, arrival, interval, calibrating)
+        for callback in self.averages_callbacks:
+            try:
+                callback(snr, samples)
+            except Exception as e:
+                print("Averages callback failed: %s" % e)
+
+    def t_collect(self):
+        while not self._stop.is_set():
+            try:
+                item = self._results.get(timeout=RESULT_POLL)
+            except queue.Empty:
+                continue
+            self._deliver(*item)
+
+    def call(self, name, *args):
+        ''' device.name(*args) on every board, all at once. Returns {snr: result},
+            raises the error of the first board that failed.
+        '''
+        boards = [self._boards[snr] for snr in self.snrs]
+        for board in boards:
+            board.send(name, args)
+        results = {}
+        error = None
+        for board in boards:
+            try:
+                results[board.snr] = board.reply()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def status(self):
+        ''' {snr: stats} of every board: its samples and what its rtt and device report '''
+        status = self.call('status')
+        for snr in self.snrs:
+            status[snr].update(self.streams[snr].stats())
+            status[snr].update(self.info.get(snr, {}))
+        return status
+
+    def aligned(self, seconds=1.0, step=None, end=None):
+        ''' The mean current of every board in bins of step seconds over
+            seconds up to end, by default the newest time all boards have
+            samples for. step is the longest average interval by default.
+            Returns (times, values), with times the start of each bin and
+            values[i] the means of board snrs[i], NaN where it had none.
+            np.nansum(values, axis=0) is the current of all boards together.
+        '''
+        streams = [self.streams[snr] for snr in self.snrs]
+        if step is None:
+            step = max(stream.interval for stream in streams)
+        if end is None:
+            last = [stream.last_time() for stream in streams]
+            if None in last:
+                return np.zeros(0), np.zeros((len(streams), 0))
+            end = min(last)
+        bins = max(int(round(seconds / step)), 1)
+        start = end - bins * step
+        values = np.empty((len(streams), bins))
+        for row, stream in zip(values, streams):
+            times, samples = stream.window(start, end)
+            index = np.minimum(((times - start) / step).astype(np.intp), bins - 1)
+            counts = np.bincount(index, minlength=bins)
+            sums = np.bincount(index, samples, minlength=bins)
+            row[:] = np.nan
+            np.divide(sums, counts, out=row, where=counts > 0)
+        return start + np.arange(bins) * step, values
+
+
+if __name__ == '__main__':
+    # python -m libs.multidevice [boards] [speed] [threads|processes], simulated boards at speed x real time
+    import os
+    import sys
+    from libs import simulator
+    boards = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    mode = sys.argv[3] if len(sys.argv) > 3 else PROCESSES
+    seconds = 5.0
+
+    waveforms = [simulator.square(10.0, 1000.0 * (i + 1), 0.1, 0.5) for i in range(boards)]
+    api = simulator.rack_factory(boards, waveforms, speed=speed)
+    manager = DeviceManager(api=api, mode=mode)
+    cpu = sum(os.times()[:4])
+    manager.open()
+    with_boards = ', '.join('%s %s' % (snr, info['board_id']) for snr, info in sorted(manager.info.items()))
+    print("%d boards in %s: %s" % (boards, mode, with_boards))
+    manager.call('set_average_samples', 10)
+    manager.call('run')
+    time.sleep(seconds)
+    status = manager.status()
+    times, values = manager.aligned(seconds=1.0, step=0.1)
+    manager.call('stop')
+    manager.close()
+    cpu = sum(os.times()[:4]) - cpu
+
+    total = 0.0
+    for snr in manager.snrs:
+        s = status[snr]
+        total += s['rate']
+        print("%s  %8.0f samples/s  mean %10.3f uA  dropped %d frames"
+              % (snr, s['rate'], (s['mean'] or 0.0) * 1e6, s['dropped_frames']))
+    print("Total %.0f samples/s, %.0f per CPU second" % (total, total * seconds / cpu))
+    print("Aligned 100 ms means over the last second [uA]:")
+    for snr, row in zip(manager.snrs, values):
+        print("%s  %s" % (snr, ' '.join('%7.1f' % v for v in row * 1e6)))
+    print("sum        %s" % ' '.join('%7.1f' % v for v in np.nansum(values, axis=0) * 1e6))
@@ -0,0 +1,219 @@
+from __future__ import print_function
+import ctypes
+import multiprocessing
+import signal
+import threading
+import time
+import numpy as np
+from libs.deframer import Deframer
+from libs.measurement import decode_samples
+from libs import protocol
+from libs.metrics import REGISTRY
+from libs.shmring import ShmRing
+
+RAW_RING_SIZE    = 4 << 20      # Bytes read from the RTT waiting for the decoder process
+RESULT_RING_SIZE = 16 << 20     # Decoded samples waiting for the client
+POLL_TIMEOUT     = 0.1          # Longest wait for a ring before checking for the end [s]
+FULL_SLEEP       = 0.001        # Between tries while the result ring is full [s]
+
+# Record kinds
+RAW      = 1    # Bytes as read from the RTT
+AVERAGES = 2    # float64 A, without the offset; a: frames
+TRIGGER  = 3    # n float64 A, n raw uint16 and n uint8 ranges; a: frames, b: samples without a valid range
+
+# Shared counters of the decoder process
+STAT_CHUNKS          = 0
+STAT_FRAMES          = 1
+STAT_AVERAGES        = 2
+STAT_TRIGGER_SAMPLES = 3
+STAT_BUSY            = 4    # Seconds spent decoding
+STAT_FULL_WAIT       = 5    # Seconds waiting for room in the result ring
+STATS                = 6
+
+# Parameters the client keeps up to date for the trigger decoding
+PARAM_RES_LO  = 0
+PARAM_RES_MID = 1
+PARAM_RES_HI  = 2
+PARAM_OFFSET  = 3
+PARAMS        = 4
+
+
+def trigger_record_size(n):
+    return n * (8 + 2 + 1)
+
+
+def split_trigger(payload):
+    ''' (amps, raw, ranges) views of a TRIGGER record payload '''
+    n = len(payload) // trigger_record_size(1)
+    amps = payload[:8 * n].view(np.float64)
+    raw = payload[8 * n:10 * n]
+    ranges = payload[10 * n:11 * n]
+    return amps, raw, ranges
+
+
+def _reserve(ring, stop, kind, nbytes, a, b, stats):
+    # Wait for room rather than drop decoded samples, the raw ring takes up the slack
+    start = time.time()
+    view = ring.reserve(kind, nbytes, a, b)
+    while view is None and not stop.is_set():
+        time.sleep(FULL_SLEEP)
+        view = ring.reserve(kind, nbytes, a, b)
+    stats[STAT_FULL_WAIT] += time.time() - start
+    return view
+
+
+def decode_chunk(deframer, chunk, results, params, stats, stop):
+    ''' Deframe one chunk of RTT bytes and write its average and trigger
+        samples to the results ring, in the decoder process
+    '''
+    frames = deframer.feed(chunk)
+    stats[STAT_CHUNKS] += 1
+    stats[STAT_FRAMES] += len(frames)
+    averages = [frame for frame in frames if protocol.is_average(frame)]
+    if averages:
+        view = _reserve(results, stop, AVERAGES, 8 * len(averages), len(averages), 0, stats)
+        if view is not None:
+            samples = view.view(np.float64)
+            samples[:] = protocol.decode_averages(averages)
+            samples /= 1e6
+            results.commit()
+        stats[STAT_AVERAGES] += len(averages)
+    if len(averages) < len(frames):
+        raw = b''.join(frame[:len(frame) & ~1] for frame in frames if not protocol.is_average(frame))
+        samples = np.frombuffer(raw, dtype=protocol.TRIGGER_SAMPLE)
+        ranges, amps, invalid = decode_samples(samples, params[PARAM_RES_LO], params[PARAM_RES_MID],
+                                               params[PARAM_RES_HI], params[PARAM_OFFSET])
+        n = len(samples)
+        view = _reserve(results, stop, TRIGGER, trigger_record_size(n), len(frames) - len(averages),
+                        invalid, stats)
+        if view is not None:
+            amps_view, raw_view, ranges_view = split_trigger(view)
+            amps_view[:] = amps
+            raw_view[:] = np.frombuffer(raw, dtype=np.uint8)
+            ranges_view[:] = ranges
+            results.commit()
+        stats[STAT_TRIGGER_SAMPLES] += n
+
+
+def _decoder_main(raw_ring, results, params, stats, stop):
+    # The decoder process: RAW records in, AVERAGES and TRIGGER records out,
+    # until stop is set and every raw chunk is decoded. Ctrl-C is left to
+    # the client, which stops it with close() once the reader is done.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    deframer = Deframer()
+    while True:
+        record = raw_ring.get()
+        if record is None:
+            if stop.is_set() and raw_ring.get() is None:
+                break
+            raw_ring.wait(POLL_TIMEOUT)
+            continue
+        kind, a, b, payload = record
+        chunk = payload.tobytes()
+        raw_ring.release()
+        start = time.time()
+        decode_chunk(deframer, chunk, results, params, stats, stop)
+        stats[STAT_BUSY] += time.time() - start
+
+
+class DecoderProcess(object):
+    ''' Deframes and decodes the RTT data in a process of its own, so it
+        doesn't compete with the reader, the GUI and the callbacks for the
+        interpreter lock.
+        feed(), called by the RTT reader with every chunk read, copies it
+        into a shared memory ring for the process and counts it as dropped
+        if the ring is full. The process writes the average samples in A
+        and the decoded trigger samples with their raw values and ranges
+        into a second shared ring. A thread here reads them in place and
+        passes numpy views of the shared memory to
+        device.handle_decoded_averages() and handle_decoded_trigger(); the
+        views are only valid during the call.
+        The trigger decoding uses the resistors and offset of the device,
+        copied to shared memory with update_params() before every record.
+        Start it before anything else has threads running, the process may
+        be forked.
+    '''
+    def __init__(self, device, raw_size=RAW_RING_SIZE, result_size=RESULT_RING_SIZE, registry=REGISTRY,
+                 labels=None):
+        self.device = device
+        self.raw = ShmRing(raw_size)
+        self.results = ShmRing(result_size)
+        self.params = multiprocessing.RawArray(ctypes.c_double, PARAMS)
+        self._stats = multiprocessing.RawArray(ctypes.c_double, STATS)
+        self.dropped_bytes = 0      # Read from the RTT while the raw ring was full
+        self.dropped_chunks = 0
+        self._stop = multiprocessing.Event()
+        self.update_params()
+        self.process = multiprocessing.Process(target=_decoder_main,
+                                               args=(self.raw, self.results, self.params, self._stats, self._stop))
+        self.process.daemon = True
+        self._thread = None
+
+        registry.gauge('offload_dropped_bytes', "RTT bytes dropped with the raw ring full", labels,
+                       func=lambda: self.dropped_bytes)
+        registry.gauge('offload_busy_seconds', "Time the decoder process spent decoding", labels,
+                       func=lambda: self._stats[STAT_BUSY])
+        registry.gauge('offload_raw_ring_used', "Bytes waiting for the decoder process", labels,
+                       func=lambda: self.raw.used)
+        registry.gauge('offload_result_ring_used', "Bytes of results waiting to be handled", labels,
+                       func=lambda: self.results.used)
+
+    def update_params(self):
+        device = self.device
+        if device.res_lo is not None:
+            self.params[PARAM_RES_LO] = device.res_lo
+            self.params[PARAM_RES_MID] = device.res_mid
+            self.params[PARAM_RES_HI] = device.res_hi
+        self.params[PARAM_OFFSET] = device.global_offset
+
+    def start(self):
+        self.update_params()
+        self.process.start()
+        self._thread = threading.Thread(target=self.t_results)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def feed(self, data):
+        if not self.raw.put(RAW, data):
+            self.dropped_bytes += len(data)
+            self.dropped_chunks += 1
+
+    def close(self):
+        ''' Decode what was fed so far and stop the process '''
+        self._stop.set()
+        self.process.join()
+        if self._thread is not None:
+            self._thread.join()
+
+    def t_results(self):
+        device = self.device
+        while True:
+            self.update_params()
+            record = self.results.get()
+            if record is None:
+                if not self.process.is_alive() and self.results.get() is None:
+                    break
+                self.results.wait(POLL_TIMEOUT)
+                continue
+            kind, a, b, payload = record
+            try:
+                if kind == AVERAGES:
+                    device.handle_decoded_averages(payload.view(np.float64), a)
+                elif kind == TRIGGER:
+                    amps, raw, ranges = split_trigger(payload)
+                    device.handle_decoded_trigger(raw, amps, ranges, b, a)
+            except Exception as e:
+                print(e)
+            self.results.release()
+
+    def stats(self):
+        return {'chunks': int(self._stats[STAT_CHUNKS]),
+                'frames': int(self._stats[STAT_FRAMES]),
+                'averages': int(self._stats[STAT_AVERAGES]),
+                'trigger_samples': int(self._stats[STAT_TRIGGER_SAMPLES]),
+                'busy_s': self._stats[STAT_BUSY],
+                'full_wait_s': self._stats[STAT_FULL_WAIT],
+                'dropped_bytes': self.dropped_bytes,
+                'dropped_chunks': self.dropped_chunks,
+                'raw_used': self.raw.used,
+                'results_used': self.results.used}
@@ -0,0 +1,117 @@
+from __future__ import print_function
+import time
+
+READ_SIZE_MIN   = 1024
+READ_SIZE_START = 10000
+READ_SIZE_MAX   = 262144
+IDLE_SLEEP_MIN  = 0.001     # First back off after an empty read [s]
+IDLE_SLEEP_MAX  = 0.020     # Longest sleep between reads [s]
+TARGET_FILL     = 0.5       # Part of the read size to let arrive between reads
+RATE_SMOOTHING  = 0.2
+STATS_PERIOD    = 1.0       # [s]
+
+
+class AdaptivePoller(object):
+    ''' Decides how many bytes to ask rtt_read for and how long to wait
+        before the next read.
+        A read that fills the request doubles the read size and polls again
+        right away. Empty reads back off exponentially up to IDLE_SLEEP_MAX.
+        Otherwise the poller sleeps until about TARGET_FILL of the read size
+        is expected at the measured data rate, so the interval shortens as
+        the load goes up, and the read size shrinks when even the longest
+        sleep would leave most of it unused.
+    '''
+    def __init__(self, min_size=READ_SIZE_MIN, max_size=READ_SIZE_MAX,
+                 min_sleep=IDLE_SLEEP_MIN, max_sleep=IDLE_SLEEP_MAX):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.read_size = max(min(READ_SIZE_START, max_size), min_size)
+        self.interval = 0.0
+        self.data_rate = 0.0        # Smoothed incoming bytes/s
+
+        self.reads = 0
+        self.empty_reads = 0
+        self.bytes_read = 0
+        self.poll_rate = 0.0        # reads/s over the last STATS_PERIOD
+        self.bytes_per_read = 0.0   # over the last STATS_PERIOD
+        self._period_start = time.time()
+        self._period_reads = 0
+        self._period_bytes = 0
+        self._last_read = time.time()
+
+    def update(self, nbytes):
+        ''' Adapt to the number of bytes the last read returned '''
+        self.reads += 1
+        self.bytes_read += nbytes
+        self._period_reads += 1
+        self._period_bytes += nbytes
+
+        now = time.time()
+        dt = now - self._last_read
+        self._last_read = now
+        if dt > 0:
+            self.data_rate += RATE_SMOOTHING * (nbytes / dt - self.data_rate)
+
+        if nbytes >= self.read_size:
+            # More is probably waiting in the RTT buffer
+            self.read_size = min(self.read_size * 2, self.max_size)
+            self.interval = 0.0
+        elif nbytes == 0:
+            self.empty_reads += 1
+            self.interval = min(max(self.interval * 2, self.min_sleep), self.max_sleep)
+        else:
+            if self.data_rate * self.max_sleep * 4 < self.read_size:
+                self.read_size = max(self.read_size // 2, self.min_size)
+            wait = TARGET_FILL * self.read_size / self.data_rate if self.data_rate else self.max_sleep
+            self.interval = min(wait, self.max_sleep)
+
+        elapsed = now - self._period_start
+        if elapsed >= STATS_PERIOD:
+            self.poll_rate = self._period_reads / elapsed
+            self.bytes_per_read = self._period_bytes / float(self._period_reads)
+            self._period_start = now
+            self._period_reads = 0
+            self._period_bytes = 0
+
+    def wait(self):
+        if self.interval:
+            time.sleep(self.interval)
+
+    def stats(self):
+        return {'read_size': self.read_size,
+                'interval': self.interval,
+                'data_rate': self.data_rate,
+                'poll_rate': self.poll_rate,
+                'bytes_per_read': self.bytes_per_read,
+                'reads': self.reads,
+                'empty_reads': self.empty_reads,
+                'bytes_read': self.bytes_read}
+
+
+class _RateAPI(object):
+    ''' Stand-in for pynrfjprog.API whose RTT channel produces bytes at a fixed rate '''
+    def __init__(self, bytes_per_s):
+        self.bytes_per_s = bytes_per_s
+        self._start = time.time()
+        self._sent = 0
+
+    def rtt_read(self, channel, length, encoding=None):
+        available = int((time.time() - self._start) * self.bytes_per_s) - self._sent
+        n = max(min(available, length), 0)
+        self._sent += n
+        return bytearray(n)
+
+
+if __name__ == '__main__':
+    # python -m libs.poller, shows how the poller settles for a few data rates
+    for rate in (0, 50000, 1000000, 10000000):
+        api = _RateAPI(rate)
+        poller = AdaptivePoller()
+        end = time.time() + 2 * STATS_PERIOD
+        while time.time() < end:
+            poller.update(len(api.rtt_read(0, poller.read_size)))
+            poller.wait()
+        print("%9d B/s: %7.0f reads/s %9.0f bytes/read, read size %d"
+              % (rate, poller.poll_rate, poller.bytes_per_read, poller.read_size))
@@ -0,0 +1,211 @@
+from __future__ import print_function
+import struct
+import numpy as np
+from libs.deframer import stuff
+
+
+class RTT_COMMANDS():
+    RTT_CMD_TRIGGER_SET         = 0x01  # following trigger of type int16
+    RTT_CMD_AVG_NUM_SET         = 0x02  # Number of samples x16 to average over
+    RTT_CMD_TRIG_WINDOW_SET     = 0x03  # following window of type unt16
+    RTT_CMD_TRIG_INTERVAL_SET   = 0x04  #
+    RTT_CMD_SINGLE_TRIG         = 0x05
+    RTT_CMD_RUN                 = 0x06
+    RTT_CMD_STOP                = 0x07
+    RTT_CMD_RANGE_SET           = 0x08
+    RTT_CMD_LCD_SET             = 0x09
+    RTT_CMD_TRIG_STOP           = 0x0A
+    RTT_CMD_CALIBRATE_OFFSET    = 0x0B
+    RTT_CMD_DUT                 = 0x0C
+    RTT_CMD_SETVDD              = 0x0D
+    RTT_CMD_SETVREFLO           = 0x0E
+    RTT_CMD_SETVREFHI           = 0x0F
+    RTT_CMD_TOGGLE_EXT_TRIG     = 0x11
+    RTT_CMD_SET_RES_USER        = 0x12
+
+
+class Command(object):
+    ''' One RTT_COMMANDS message, the command id followed by its fields.
+        fmt is the struct format of the whole message, id included.
+    '''
+    def __init__(self, name, cmd_id, fmt='B'):
+        self.name = name
+        self.id = cmd_id
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+    def encode(self, *values):
+        ''' The message as bytes, ValueError if a value doesn't fit '''
+        try:
+            return self.struct.pack(self.id, *values)
+        except struct.error as e:
+            raise ValueError("%s %r: %s" % (self.name, values, e))
+
+    def frame(self, *values):
+        ''' The message stuffed into an STX/ETX frame, as sent over RTT '''
+        return stuff(self.encode(*values))
+
+    def decode(self, payload):
+        ''' Values of a message, without the id '''
+        return self.struct.unpack(bytes(payload))[1:]
+
+
+# Commands used by this application. 16 bit fields are sent high byte
+# first, the resistor values as little endian floats.
+TRIGGER_SET       = Command('TRIGGER_SET', RTT_COMMANDS.RTT_CMD_TRIGGER_SET, '>BH')         # uA
+AVG_NUM_SET       = Command('AVG_NUM_SET', RTT_COMMANDS.RTT_CMD_AVG_NUM_SET, '>BH')         # samples / 10
+TRIG_WINDOW_SET   = Command('TRIG_WINDOW_SET', RTT_COMMANDS.RTT_CMD_TRIG_WINDOW_SET, '>BH') # samples
+SINGLE_TRIG       = Command('SINGLE_TRIG', RTT_COMMANDS.RTT_CMD_SINGLE_TRIG, '>BH')         # uA
+RUN               = Command('RUN', RTT_COMMANDS.RTT_CMD_RUN)
+STOP              = Command('STOP', RTT_COMMANDS.RTT_CMD_STOP)
+RANGE_SET         = Command('RANGE_SET', RTT_COMMANDS.RTT_CMD_RANGE_SET, 'BB')
+TRIG_STOP         = Command('TRIG_STOP', RTT_COMMANDS.RTT_CMD_TRIG_STOP)
+DUT               = Command('DUT', RTT_COMMANDS.RTT_CMD_DUT, 'BB')                          # 1: on
+SETVDD            = Command('SETVDD', RTT_COMMANDS.RTT_CMD_SETVDD, '>BH')                   # mV
+SETVREFLO         = Command('SETVREFLO', RTT_COMMANDS.RTT_CMD_SETVREFLO, '>BH')             # pot / 2
+SETVREFHI         = Command('SETVREFHI', RTT_COMMANDS.RTT_CMD_SETVREFHI, '>BH')             # pot / 2
+TOGGLE_EXT_TRIG   = Command('TOGGLE_EXT_TRIG', RTT_COMMANDS.RTT_CMD_TOGGLE_EXT_TRIG)
+SET_RES_USER      = Command('SET_RES_USER', RTT_COMMANDS.RTT_CMD_SET_RES_USER, '<Bfff')     # ohm
+
+COMMANDS = dict((c.id, c) for c in (TRIGGER_SET, AVG_NUM_SET, TRIG_WINDOW_SET, SINGLE_TRIG, RUN,
+                                    STOP, RANGE_SET, TRIG_STOP, DUT, SETVDD, SETVREFLO, SETVREFHI,
+                                    TOGGLE_EXT_TRIG, SET_RES_USER))
+
+
+def decode_command(payload):
+    ''' (Command, values) of a received command frame payload.
+        ValueError for an unknown id or a payload of the wrong size.
+    '''
+    payload = bytearray(payload)
+    if not payload or payload[0] not in COMMANDS:
+        raise ValueError("Unknown command %r" % bytes(payload[:1]))
+    command = COMMANDS[payload[0]]
+    if len(payload) != command.size:
+        raise ValueError("%s takes %d bytes, got %d" % (command.name, command.size, len(payload)))
+    return command, command.decode(payload)
+
+
+# Frames from the PPK: an average sample, or a window of raw trigger samples
+AVERAGE_FRAME_SIZE = 4
+AVERAGE = struct.Struct('<f')   # uA
+AVERAGE_SAMPLE = np.dtype('<f4')
+TRIGGER_SAMPLE = np.dtype('<u2')
+
+
+def is_average(frame):
+    return len(frame) == AVERAGE_FRAME_SIZE
+
+
+def decode_average(frame):
+    ''' Average sample in uA '''
+    return AVERAGE.unpack(frame)[0]
+
+
+def decode_averages(frames):
+    ''' Average samples in uA of a list of average frames, as a float32 array '''
+    return np.frombuffer(b''.join(frames), dtype=AVERAGE_SAMPLE)
+
+
+def encode_average(uA):
+    return AVERAGE.pack(uA)
+
+
+def decode_trigger_samples(frame):
+    ''' Raw 16 bit samples of a trigger frame, see measurement.decode_samples '''
+    raw = bytes(frame)
+    return np.frombuffer(raw[:len(raw) & ~1], dtype=TRIGGER_SAMPLE)
+
+
+def encode_trigger_samples(samples):
+    return np.asarray(samples, dtype=TRIGGER_SAMPLE).tobytes()
+
+
+class Calibration(object):
+    ''' Values from the banner the PPK prints over RTT after reset '''
+    def __init__(self, data):
+        try:
+            prod_data = data.split("USER SET ")[0]
+            self.res_lo  = float(prod_data.split("R1:")[1].split(" R2")[0])
+            self.res_mid = float(prod_data.split("R2:")[1].split(" R3")[0])
+            self.res_hi  = float(prod_data.split("R3:")[1].split("Board ID ")[0])
+            self.board_id = str(prod_data.split("Board ID ")[1])
+        except (IndexError, ValueError):
+            raise ValueError("Initialization failed, could not read calibration values.")
+
+        # Factory calibrated resistors, the user set ones below may replace them
+        self.calibrated_res_lo  = self.res_lo
+        self.calibrated_res_mid = self.res_mid
+        self.calibrated_res_hi  = self.res_hi
+
+        if 'USER SET' in data:
+            user_data = data.split("USER SET ")[1].split("Refs")[0]
+            self.res_lo  = float(user_data.split("R1:")[1].split(" R2")[0])
+            self.res_mid = float(user_data.split("R2:")[1].split(" R3")[0])
+            self.res_hi  = float(user_data.split("R3:")[1].split("Board ID ")[0])
+
+        try:
+            refs_data = data.split("Refs ")[1]
+            self.vref_hi = int(refs_data.split("HI: ")[1].split(" LO")[0])
+            self.vref_lo = int(refs_data.split("LO: ")[1])
+            self.vdd     = int(refs_data.split("VDD: ")[1].split(" HI")[0])
+        except (IndexError, ValueError):
+            raise ValueError("Corrupted data received from PPK, please reflash the PPK.")
+
+
+if __name__ == '__main__':
+    # python -m libs.protocol, encode and decode throughput against the hand packed versions
+    import time
+
+    def rate(f, n):
+        start = time.time()
+        for i in range(n):
+            f(i)
+        return n / (time.time() - start) / 1e6
+
+    def hand_packed(value):
+        s = chr(0x02)
+        for byte in [RTT_COMMANDS.RTT_CMD_SETVDD, value >> 8, value & 0xFF]:
+            if byte == 0x02 or byte == 0x03 or byte == 0x1F:
+                s = s + chr(0x1F) + chr(byte ^ 0x20)
+            else:
+                s = s + chr(byte)
+        return s + chr(0x03)
+
+    n = 200000
+    print("SETVDD frame, hand packed: %6.2f M/s" % rate(lambda i: hand_packed(i & 0xFFFF), n))
+    print("SETVDD frame, Command:     %6.2f M/s" % rate(lambda i: SETVDD.frame(i & 0xFFFF), n))
+    print("SET_RES_USER encode:       %6.2f M/s" % rate(lambda i: SET_RES_USER.encode(1.0, 2.0, 3.0), n))
+
+    frame = encode_average(123.5)
+    print("Average, struct.unpack:    %6.2f M/s" % rate(lambda i: struct.unpack('f', frame)[0], n))
+    print("Average, decode_average:   %6.2f M/s" % rate(lambda i: decode_average(frame), n))
+
+    # Decoding of the average frames as rtt_handler did it, one by one, and in batches
+    frames = [encode_average(x) for x in np.random.exponential(1000.0, 100000)]
+    offset = 1e-7
+    byte = chr if str is bytes else (lambda b: bytes((b,)))
+    start = time.time()
+    for data in frames:
+        sample_A = struct.unpack('f', b''.join([byte(b) for b in bytearray(data)]))[0] / 1e6 - offset
+    before = len(frames) / (time.time() - start)
+    start = time.time()
+    for data in frames:
+        sample_A = decode_average(data) / 1e6 - offset
+    single = len(frames) / (time.time() - start)
+    start = time.time()
+    for i in range(0, len(frames), 1024):
+        samples = decode_averages(frames[i:i + 1024]).astype(np.float64)
+        samples /= 1e6
+        samples -= offset
+    batched = len(frames) / (time.time() - start)
+    print("Averages, chr join:        %6.2f M samples/s" % (before / 1e6))
+    print("Averages, one by one:      %6.2f M samples/s" % (single / 1e6))
+    print("Averages, batches of 1024: %6.2f M samples/s, %.0fx" % (batched / 1e6, batched / before))
+
+    trigger = encode_trigger_samples(np.arange(512))
+    print("Trigger frames of 512:     %6.2f M/s" % rate(lambda i: decode_trigger_samples(trigger), n // 10))
+
+    for command in COMMANDS.values():
+        values = command.decode(bytes(bytearray(command.size)))
+        values = tuple(v + 1 for v in values)
+        assert decode_command(command.encode(*values)) == (command, values)
@@ -0,0 +1,169 @@
+from __future__ import print_function
+import numpy as np
+from libs.ringbuffer import RingBuffer
+
+FACTOR     = 4      # Samples per block from one level to the next
+MIN_BLOCKS = 64     # No level is made coarser than this many blocks over the buffer
+
+
+class _Level(object):
+    ''' Min and max of each block of FACTOR**n samples, newest blocks kept in rings '''
+    def __init__(self, block, capacity):
+        self.block = block          # Samples per block
+        self.blocks = 0             # Blocks completed since the last rebuild
+        self.mins = RingBuffer(capacity)
+        self.maxs = RingBuffer(capacity)
+        # Values from the level below not yet making up a whole block
+        self.pending_min = np.zeros(0)
+        self.pending_max = np.zeros(0)
+
+    def fold(self, mins, maxs, factor):
+        ''' Add values from the level below, returns the completed blocks '''
+        if len(self.pending_min):
+            mins = np.concatenate((self.pending_min, mins))
+            maxs = np.concatenate((self.pending_max, maxs))
+        full = len(mins) // factor * factor
+        self.pending_min = mins[full:].copy()
+        self.pending_max = maxs[full:].copy()
+        block_min = mins[:full].reshape(-1, factor).min(axis=1)
+        block_max = maxs[:full].reshape(-1, factor).max(axis=1)
+        self.mins.extend(block_min)
+        self.maxs.extend(block_max)
+        self.blocks += len(block_min)
+        return block_min, block_max
+
+
+class MinMaxPyramid(object):
+    ''' Min/max decimation of the samples in a RingBuffer, for plotting.
+        Level n holds the min and max of every FACTOR**n samples. sync() folds
+        in the samples appended since the last call, so keeping it up to date
+        costs about as much as the new samples. After a clear() or resize()
+        of the source it starts over. plot() picks the coarsest level that
+        still gives one block per pixel for the requested range and returns the min and max of each block as a vertical pair of
+        points, so short spikes stay visible at any zoom.
+    '''
+    def __init__(self, source, factor=FACTOR):
+        self.source = source
+        self.factor = factor
+        self.rebuild()
+
+    def rebuild(self):
+        ''' Start over from the current contents of the source '''
+        total, self.resets, samples = self.source.snapshot()
+        self.size = len(samples)
+        self.levels = []
+        block = self.factor
+        while self.size // block >= MIN_BLOCKS:
+            self.levels.append(_Level(block, self.size // block + 2))
+            block *= self.factor
+        # Absolute index (source.total count) of the first sample folded in
+        self.origin = total - self.size
+        self.synced = self.origin
+        self._fold(samples)
+
+    def _fold(self, samples):
+        mins = maxs = samples
+        for level in self.levels:
+            if not len(mins) and not len(level.pending_min):
+                break
+            mins, maxs = level.fold(mins, maxs, self.factor)
+        self.synced += len(samples)
+
+    def sync(self):
+        ''' Fold in the samples appended to the source since the last call '''
+        # Count and samples read together, the source may be extended meanwhile.
+        # The same goes for the raw samples read by plot().
+        total, resets, new = self.source.snapshot(self.synced)
+        if resets != self.resets or new is None:
+            self.rebuild()
+        elif len(new):
+            self._fold(new)
+
+    def _partial(self, k):
+        # Min and max of the samples after the last completed block of level k
+        values = []
+        for level in self.levels[:k + 1]:
+            values.append(level.pending_min)
+            values.append(level.pending_max)
+        values = np.concatenate(values)
+        if not len(values):
+            return None
+        return values.min(), values.max()
+
+    def plot(self, x0, x1, dx, pixels):
+        ''' Points to draw for x0 <= x <= x1 when the newest sample of the
+            source is at (size - 1) * dx and the plot is pixels wide.
+            Returns x and y arrays of about 2 * pixels points at most.
+        '''
+        first = self.synced - self.size     # Absolute index of x == 0
+        a0 = max(int(x0 / dx) + first, first)
+        a1 = min(int(np.ceil(x1 / dx)) + first + 1, self.synced)
+        if a1 <= a0:
+            return np.zeros(0), np.zeros(0)
+        pixels = max(int(pixels), 1)
+
+        # Raw samples if they fit, else the finest level with a block per pixel
+        n = a1 - a0
+        k = -1
+        if n > 2 * pixels and self.levels:
+            k = 0
+            while k + 1 < len(self.levels) and n > pixels * self.levels[k].block:
+                k += 1
+        if k < 0:
+            y = self.source.snapshot(a0, a1 - a0)[2]
+            if y is None:
+                return np.zeros(0), np.zeros(0)
+            return (np.arange(a0, a0 + len(y)) - first) * dx, y
+
+        level = self.levels[k]
+        stored = min(level.blocks, len(level.mins))
+        b0 = max((a0 - self.origin) // level.block, level.blocks - stored)
+        b1 = min((a1 - self.origin - 1) // level.block + 1, level.blocks)
+        n = max(b1 - b0, 0)
+        mins = level.mins.latest(level.blocks - b0)[:n]
+        maxs = level.maxs.latest(level.blocks - b0)[:n]
+        starts = np.arange(b0, b0 + n) * level.block + self.origin
+        if n and starts[0] < first:
+            # Part of the first block has left the source, use what remains
+            head = self.source.snapshot(first, starts[0] + level.block - first)[2]
+            if head is not None and len(head):
+                mins = np.append(head.min(), mins[1:])
+                maxs = np.append(head.max(), maxs[1:])
+            starts[0] = first
+
+        if (a1 - self.origin) > level.blocks * level.block:
+            partial = self._partial(k)
+            if partial is not None:
+                mins = np.append(mins, partial[0])
+                maxs = np.append(maxs, partial[1])
+                starts = np.append(starts, level.blocks * level.block + self.origin)
+
+        x = np.repeat((starts - first) * dx, 2)
+        y = np.empty(2 * len(mins))
+        y[0::2] = mins
+        y[1::2] = maxs
+        return x, y
+
+
+if __name__ == '__main__':
+    # python -m libs.pyramid, cost of keeping the pyramid in sync and of one plot
+    import time
+    size = 2000000
+    ring = RingBuffer(size)
+    ring.extend(np.random.randn(size))
+    start = time.time()
+    pyramid = MinMaxPyramid(ring)
+    print("Built over %d samples in %.1f ms, %d levels" % (size, (time.time() - start) * 1e3, len(pyramid.levels)))
+
+    batch = 8000
+    start = time.time()
+    for i in range(100):
+        ring.extend(np.random.randn(batch))
+        pyramid.sync()
+    print("sync of %d new samples: %.3f ms" % (batch, (time.time() - start) * 1e3 / 100))
+
+    start = time.time()
+    for i in range(100):
+        x, y = pyramid.plot(0, size * 1e-4, 1e-4, 1000)
+    print("Full range plot: %d points in %.3f ms (setData would get %d)"
+          % (len(y), (time.time() - start) * 1e3 / 100, size))
@@ -0,0 +1,539 @@
+from __future__ import print_function
+import io
+import os
+import struct
+import threading
+import time
+import numpy as np
+from libs.measurement import decode_samples
+from libs.bursts import BurstIndex, BURSTS_EXT
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Capture file: a HEADER_SIZE header followed by the samples of one stream,
+# back to back, so the sample area can be memory mapped as one array.
+# The number of samples follows from the file size.
+MAGIC       = b'PPKREC\r\n'
+VERSION     = 1
+HEADER_SIZE = 4096
+
+STREAM_AVERAGE = 0
+STREAM_TRIGGER = 1
+
+FORMAT_FLOAT32 = 0      # Samples in A, little endian float32
+FORMAT_RAW16   = 1      # Little endian uint16 ADC codes, measurement range in bit 14-15
+
+SAMPLE_DTYPES = {FORMAT_FLOAT32: np.dtype('<f4'),
+                 FORMAT_RAW16: np.dtype('<u2')}
+
+AVG_EXT  = '.avg.ppkrec'
+TRIG_EXT = '.trig.ppkrec'
+INDEX_EXT = '.idx.npz'          # Added to the capture file name
+
+INDEX_BLOCK = 65536             # Samples per block of a capture index
+INDEX_CHUNK = 64                # Blocks read at a time when building an index
+
+# Fsync policies
+FSYNC_NEVER    = 'never'        # Leave it to the OS
+FSYNC_INTERVAL = 'interval'     # At most every fsync_interval seconds
+FSYNC_ALWAYS   = 'always'       # After every written block
+
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_INTERVAL, FSYNC_ALWAYS)
+
+BLOCK_SAMPLES = 16384           # Samples collected before handing a block to the writer
+TRIGGER_FLUSH = 0.5             # Longest a partial trigger block waits for more samples [s]
+WRITE_BUFFER  = 4 * 1024 * 1024
+QUEUE_BLOCKS  = 1024            # Blocks waiting for the writer before new ones are dropped
+BURSTS_SAVE_INTERVAL = 60.0     # Between saves of the burst index while recording [s]
+
+_HEADER = struct.Struct('<8sHHHHIddddddiii32s')
+
+
+class CaptureHeader(object):
+    ''' Everything needed to interpret the samples of a capture file '''
+    def __init__(self, stream=STREAM_AVERAGE, sample_format=FORMAT_FLOAT32, sample_interval=0.0,
+                 start_time=0.0, res_lo=0.0, res_mid=0.0, res_hi=0.0, offset=0.0,
+                 vdd=0, vref_hi=0, vref_lo=0, board_id=''):
+        self.stream = stream
+        self.sample_format = sample_format
+        self.sample_interval = sample_interval
+        self.start_time = start_time
+        self.res_lo = res_lo
+        self.res_mid = res_mid
+        self.res_hi = res_hi
+        self.offset = offset        # To subtract from LO range samples of raw captures
+        self.vdd = vdd
+        self.vref_hi = vref_hi
+        self.vref_lo = vref_lo
+        self.board_id = board_id
+
+    @property
+    def dtype(self):
+        return SAMPLE_DTYPES[self.sample_format]
+
+    def pack(self):
+        data = _HEADER.pack(MAGIC, VERSION, self.stream, self.sample_format, 0, HEADER_SIZE,
+                            self.sample_interval, self.start_time,
+                            self.res_lo, self.res_mid, self.res_hi, self.offset,
+                            self.vdd, self.vref_hi, self.vref_lo,
+                            self.board_id.strip().encode('ascii', 'replace'))
+        return data + b'\0' * (HEADER_SIZE - len(data))
+
+    @classmethod
+    def unpack(cls, data):
+        ''' Raises ValueError if data is not a capture header '''
+        if len(data) < _HEADER.size:
+            raise ValueError("Not a PPK capture, file too short")
+        fields = _HEADER.unpack(data[:_HEADER.size])
+        if fields[0] != MAGIC:
+            raise ValueError("Not a PPK capture")
+        if fields[1] != VERSION:
+            raise ValueError("Unsupported PPK capture version %d" % fields[1])
+        (magic, version, stream, sample_format, reserved, header_size,
+         sample_interval, start_time, res_lo, res_mid, res_hi, offset,
+         vdd, vref_hi, vref_lo, board_id) = fields
+        if header_size != HEADER_SIZE or sample_format not in SAMPLE_DTYPES:
+            raise ValueError("Corrupted PPK capture header")
+        return cls(stream, sample_format, sample_interval, start_time,
+                   res_lo, res_mid, res_hi, offset, vdd, vref_hi, vref_lo,
+                   board_id.rstrip(b'\0').decode('ascii'))
+
+
+class StreamWriter(object):
+    ''' Append-only writer of one capture file. Only used from the writer thread. '''
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.samples = 0
+        self._file = io.open(path, 'wb', buffering=WRITE_BUFFER)
+        self._file.write(header.pack())
+
+    def write(self, data):
+        self._file.write(data)
+        self.samples += len(data) // self.header.dtype.itemsize
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class Recorder(object):
+    ''' Records the average samples (float32 A) and the raw trigger samples
+        of a PPKDevice to capture files base.avg.ppkrec and base.trig.ppkrec.
+        The device callbacks only collect samples into blocks; the file writes
+        and fsyncs are done by a separate writer thread. If the writer falls
+        more than QUEUE_BLOCKS behind, blocks are dropped and counted instead
+        of stalling the acquisition. Trigger samples are also handed over in
+        blocks, or after TRIGGER_FLUSH when no more come.
+        When a header field changes, the interval, resistors, offset, VDD or
+        switch points, a new file is started for the stream, base.avg-2.ppkrec
+        and so on, so the samples are always read with the settings they were
+        taken with. A dropped average block also starts a new average file,
+        so its samples are always back to back. The header of a file, with
+        its start time, is taken when its first samples come in and goes to
+        the writer with the first block.
+        With bursts=(high, low, min_gap), in A and s, the writer thread also
+        builds a BurstIndex of every average file from the blocks it writes,
+        saved next to it at the end and with the fsync of the interval policy
+        at most every BURSTS_SAVE_INTERVAL.
+    '''
+    def __init__(self, device, base, trigger=True, fsync=FSYNC_INTERVAL, fsync_interval=1.0, bursts=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %s, use one of %s" % (fsync, ', '.join(FSYNC_POLICIES)))
+        self.device = device
+        self.base = base
+        self.trigger = trigger
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.bursts = bursts
+        self.burst_index = None         # Of the average file being written
+        self.dropped_blocks = 0
+        self.paths = []
+
+        self._lock = threading.Lock()
+        self._avg_block = []            # Arrays of samples
+        self._avg_count = 0
+        self._avg_writer = None
+        self._avg_settings = None       # Of the file being collected
+        self._avg_header = None         # Of the next average file, until its first block is queued
+        self._trig_block = []           # Raw sample bytes
+        self._trig_count = 0
+        self._trig_since = 0.0          # When the first samples of the block came in
+        self._trig_settings = None
+        self._trig_header = None
+        self._trig_writer = None
+        self._segments = {STREAM_AVERAGE: 0, STREAM_TRIGGER: 0}
+        self._queue = queue.Queue(QUEUE_BLOCKS)
+        self._thread = None
+
+    def header(self, stream, interval, start_time=None):
+        ''' Header with the device settings now, start_time defaults to now '''
+        device = self.device
+        sample_format = FORMAT_FLOAT32 if stream == STREAM_AVERAGE else FORMAT_RAW16
+        if start_time is None:
+            start_time = time.time()
+        return CaptureHeader(stream, sample_format, interval, start_time,
+                             device.res_lo, device.res_mid, device.res_hi, device.global_offset,
+                             device.vdd, device.calibration.vref_hi, device.calibration.vref_lo,
+                             device.calibration.board_id)
+
+    def _settings(self, stream):
+        # The header fields that can change during a recording
+        device = self.device
+        interval = device.avg_interval if stream == STREAM_AVERAGE else device.sample_interval
+        return (interval, device.res_lo, device.res_mid, device.res_hi, device.global_offset,
+                device.vdd, device.calibration.vref_hi, device.calibration.vref_lo)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.t_write)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self.device.on_averages(self.average_handler)
+        if self.trigger:
+            self.device.on_trigger_raw(self.trigger_handler)
+
+    def close(self):
+        ''' Stop recording, writes out what is collected and waits for the writer '''
+        self.device.remove_callback(self.average_handler)
+        self.device.remove_callback(self.trigger_handler)
+        with self._lock:
+            self._flush_average()
+            self._flush_trigger()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped_blocks += 1
+            return False
+
+    def _flush_average(self):
+        # Lock must be held. After a dropped block the next samples start a
+        # new file, timed from when they come in.
+        if self._avg_block:
+            block = np.concatenate(self._avg_block).astype('<f4').tobytes()
+            self._avg_block = []
+            self._avg_count = 0
+            if self._put((STREAM_AVERAGE, self._avg_header, block)):
+                self._avg_header = None
+            else:
+                self._avg_settings = None
+
+    def average_handler(self, samples):
+        if self.device.calibrating:
+            return
+        with self._lock:
+            settings = self._settings(STREAM_AVERAGE)
+            if settings != self._avg_settings:
+                self._flush_average()
+                self._avg_settings = settings
+                # The samples came in together, the first one was measured this long ago
+                interval = settings[0]
+                self._avg_header = self.header(STREAM_AVERAGE, interval, time.time() - len(samples) * interval)
+            self._avg_block.append(samples)
+            self._avg_count += len(samples)
+            if self._avg_count >= BLOCK_SAMPLES:
+                self._flush_average()
+
+    def _flush_trigger(self):
+        # Lock must be held. A dropped first block leaves the header for the next one.
+        if self._trig_block:
+            block = b''.join(self._trig_block)
+            self._trig_block = []
+            self._trig_count = 0
+            if self._put((STREAM_TRIGGER, self._trig_header, block)):
+                self._trig_header = None
+
+    def _flush_idle(self):
+        # From the writer, for a trigger block nothing was added to for a while
+        with self._lock:
+            if self._trig_block and time.time() - self._trig_since >= TRIGGER_FLUSH:
+                self._flush_trigger()
+
+    def trigger_handler(self, data):
+        with self._lock:
+            now = time.time()
+            settings = self._settings(STREAM_TRIGGER)
+            if settings != self._trig_settings:
+                self._flush_trigger()
+                self._trig_settings = settings
+                interval = settings[0]
+                self._trig_header = self.header(STREAM_TRIGGER, interval, now - len(data) // 2 * interval)
+            if not self._trig_block:
+                self._trig_since = now
+            self._trig_block.append(bytes(data[:len(data) & ~1]))
+            self._trig_count += len(data) // 2
+            if self._trig_count >= BLOCK_SAMPLES or now - self._trig_since >= TRIGGER_FLUSH:
+                self._flush_trigger()
+
+    def _open(self, stream, header):
+        self._segments[stream] += 1
+        suffix = '' if self._segments[stream] == 1 else '-%d' % self._segments[stream]
+        ext = AVG_EXT if stream == STREAM_AVERAGE else TRIG_EXT
+        path = self.base + ext.replace('.ppkrec', suffix + '.ppkrec')
+        self.paths.append(path)
+        writer = StreamWriter(path, header)
+        if stream == STREAM_AVERAGE and self.bursts:
+            self._save_bursts()
+            high, low, min_gap = self.bursts
+            self.burst_index = BurstIndex(high, low, header.sample_interval, min_gap, header.start_time)
+            self.paths.append(path + BURSTS_EXT)
+        return writer
+
+    def _save_bursts(self):
+        if self.burst_index is None:
+            return
+        path = self._avg_writer.path + BURSTS_EXT
+        try:
+            self.burst_index.save(path)
+        except (IOError, OSError) as e:
+            print("Unable to write burst index %s: %s" % (path, e))
+
+    def t_write(self):
+        last_sync = last_save = time.time()
+        while True:
+            try:
+                item = self._queue.get(timeout=TRIGGER_FLUSH)
+            except queue.Empty:
+                self._flush_idle()
+                continue
+            if item is None:
+                break
+            stream, header, block = item     # header only with the first block of a file
+            if stream == STREAM_AVERAGE:
+                if header is not None:
+                    if self._avg_writer is not None:
+                        self._avg_writer.close()
+                    self._avg_writer = self._open(STREAM_AVERAGE, header)
+                writer = self._avg_writer
+            else:
+                if header is not None:
+                    if self._trig_writer is not None:
+                        self._trig_writer.close()
+                    self._trig_writer = self._open(STREAM_TRIGGER, header)
+                writer = self._trig_writer
+            writer.write(block)
+            if stream == STREAM_AVERAGE and self.burst_index is not None:
+                self.burst_index.feed(np.frombuffer(block, dtype='<f4'))
+
+            if self.fsync == FSYNC_ALWAYS:
+                writer.sync()
+            elif self.fsync == FSYNC_INTERVAL and time.time() - last_sync >= self.fsync_interval:
+                for writer in (self._avg_writer, self._trig_writer):
+                    if writer is not None:
+                        writer.sync()
+                last_sync = time.time()
+                # The whole index is rewritten, not at every sync
+                if last_sync - last_save >= BURSTS_SAVE_INTERVAL:
+                    self._save_bursts()
+                    last_save = last_sync
+            self._flush_idle()
+
+        for writer in (self._avg_writer, self._trig_writer):
+            if writer is not None:
+                writer.close()
+        self._save_bursts()
+
+
+class CaptureReader(object):
+    ''' Random access to a capture file without loading it.
+        The sample area is memory mapped, so opening takes the same time for
+        any file size and slices are views into the page cache.
+        Times are in seconds from the first sample of the file. The trigger
+        stream only holds the recorded trigger windows back to back, so its
+        times count recorded samples rather than wall clock time.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with io.open(path, 'rb') as f:
+            self.header = CaptureHeader.unpack(f.read(HEADER_SIZE))
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+        dtype = self.header.dtype
+        # A recording that was cut short may end with part of a sample
+        count = max(size - HEADER_SIZE, 0) // dtype.itemsize
+        if count:
+            self.samples = np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+        else:
+            self.samples = np.zeros(0, dtype=dtype)
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def sample_interval(self):
+        return self.header.sample_interval
+
+    @property
+    def duration(self):
+        return len(self.samples) * self.header.sample_interval
+
+    def index(self, t):
+        ''' Index of the sample nearest to time t, clamped to the file '''
+        return min(max(int(round(t / self.header.sample_interval)), 0), len(self.samples))
+
+    def slice(self, t0, t1):
+        ''' Stored samples from t0 up to t1 as a read-only view, nothing is copied '''
+        return self.samples[self.index(t0):self.index(t1)]
+
+    def amps(self, t0, t1):
+        ''' Samples from t0 up to t1 in A. Average captures return the view
+            from slice(), raw captures convert only the requested samples.
+        '''
+        return self.decode(self.slice(t0, t1))
+
+    def decode(self, samples):
+        ''' Stored samples of this file in A '''
+        if self.header.sample_format == FORMAT_FLOAT32:
+            return samples
+        h = self.header
+        return decode_samples(samples, h.res_lo, h.res_mid, h.res_hi, h.offset)[1]
+
+    def close(self):
+        ''' Drop the mapping, it is unmapped once no slices refer to it '''
+        self.samples = np.zeros(0, dtype=self.header.dtype)
+
+
+class CaptureIndex(object):
+    ''' Running sum and sum of squares in A at every INDEX_BLOCK samples of a
+        capture, kept in a sidecar file next to it. Mean, rms and charge
+        between any two times take two lookups plus the samples of at most
+        two partial blocks, however long the capture is.
+        Opening reuses the sidecar and only indexes the blocks written since,
+        so it can be opened again while a recording grows.
+    '''
+    def __init__(self, reader, block=INDEX_BLOCK):
+        self.reader = reader
+        self.block = block
+        self.path = reader.path + INDEX_EXT
+        # _cum[k] is the sum of the first k blocks
+        self._cum = np.zeros(1)
+        self._cumsq = np.zeros(1)
+        self._load()
+        if self.update():
+            self.save()
+
+    def _load(self):
+        # An unreadable sidecar, truncated or corrupted, is rebuilt
+        try:
+            with np.load(self.path) as data:
+                if int(data['block']) != self.block or float(data['start_time']) != self.reader.header.start_time:
+                    return
+                cum, cumsq = data['sum'], data['sumsq']
+        except Exception:
+            return
+        if len(cum) - 1 <= len(self.reader) // self.block:
+            self._cum, self._cumsq = cum, cumsq
+
+    def save(self):
+        ''' Write the sidecar, replacing it atomically '''
+        tmp = self.path + '.tmp'
+        with io.open(tmp, 'wb') as f:
+            np.savez(f, block=self.block, start_time=self.reader.header.start_time,
+                     sum=self._cum, sumsq=self._cumsq)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)    # rename can't replace on Windows
+        os.rename(tmp, self.path)
+
+    def update(self):
+        ''' Index the whole blocks of the capture not indexed yet. Returns
+            True if there were any.
+        '''
+        done = len(self._cum) - 1
+        blocks = len(self.reader) // self.block
+        if blocks <= done:
+            return False
+        sums = [self._cum]
+        sumsqs = [self._cumsq]
+        last, lastsq = self._cum[-1], self._cumsq[-1]
+        for first in range(done, blocks, INDEX_CHUNK):
+            end = min(first + INDEX_CHUNK, blocks)
+            amps = self.reader.decode(self.reader.samples[first * self.block:end * self.block])
+            amps = np.asarray(amps, dtype=np.float64).reshape(-1, self.block)
+            sums.append(last + np.cumsum(amps.sum(axis=1)))
+            sumsqs.append(lastsq + np.cumsum(np.square(amps).sum(axis=1)))
+            last, lastsq = sums[-1][-1], sumsqs[-1][-1]
+        self._cum = np.concatenate(sums)
+        self._cumsq = np.concatenate(sumsqs)
+        return True
+
+    def _direct(self, i, j):
+        if j <= i:
+            return 0.0, 0.0
+        amps = np.asarray(self.reader.decode(self.reader.samples[i:j]), dtype=np.float64)
+        return float(amps.sum()), float(np.square(amps).sum())
+
+    def sums(self, i, j):
+        ''' Sum and sum of squares in A of samples i up to j '''
+        n = len(self.reader)
+        i = min(max(int(i), 0), n)
+        j = min(max(int(j), i), n)
+        b0 = -(-i // self.block)                # First whole block
+        b1 = min(j // self.block, len(self._cum) - 1)
+        if b1 <= b0:
+            return self._direct(i, j)
+        head, headsq = self._direct(i, b0 * self.block)
+        tail, tailsq = self._direct(b1 * self.block, j)
+        return (self._cum[b1] - self._cum[b0] + head + tail,
+                self._cumsq[b1] - self._cumsq[b0] + headsq + tailsq)
+
+    def region(self, t0, t1):
+        ''' Mean [A], rms [A] and charge [C] from t0 up to t1. Raises
+            ValueError when no samples are in between.
+        '''
+        i, j = self.reader.index(t0), self.reader.index(t1)
+        if j <= i:
+            raise ValueError("No samples between %g and %g s" % (t0, t1))
+        total, total_sq = self.sums(i, j)
+        n = float(j - i)
+        return total / n, np.sqrt(max(total_sq / n, 0.0)), total * self.reader.sample_interval
+
+    def energy(self, t0, t1):
+        ''' Energy [J] from t0 up to t1 at the vdd of the capture '''
+        return self.region(t0, t1)[2] * self.reader.header.vdd / 1000.0
+
+
+if __name__ == '__main__':
+    # python -m libs.recording [GB], opens a sparse synthetic capture and times random slices
+    import random
+    import sys
+    import tempfile
+
+    gigabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 4.0
+    path = os.path.join(tempfile.gettempdir(), 'ppk_synthetic' + TRIG_EXT)
+    header = CaptureHeader(STREAM_TRIGGER, FORMAT_RAW16, 13.0e-6, time.time(),
+                           510.0, 28.0, 1.8, 0.0, 3000, 0, 0, 'synthetic')
+    with io.open(path, 'wb') as f:
+        f.write(header.pack())
+        f.truncate(HEADER_SIZE + int(gigabytes * 1024 ** 3))
+    try:
+        start = time.time()
+        reader = CaptureReader(path)
+        opened = time.time() - start
+        print("%.1f GB, %d samples, %.0f s of data, opened in %.3f ms"
+              % (gigabytes, len(reader), reader.duration, opened * 1e3))
+
+        window = 0.1
+        times = []
+        for i in range(200):
+            t0 = random.uniform(0, reader.duration - window)
+            start = time.time()
+            amps = reader.amps(t0, t0 + window)
+            times.append(time.time() - start)
+        times.sort()
+        print("amps() of %.1f s (%d samples): median %.3f ms, worst %.3f ms"
+              % (window, len(amps), times[len(times) // 2] * 1e3, times[-1] * 1e3))
+        reader.close()
+    finally:
+        os.remove(path)
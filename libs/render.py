@@ -0,0 +1,142 @@
+from __future__ import print_function
+import os
+import sys
+import threading
+import time
+from libs.metrics import REGISTRY
+
+DEFAULT_FPS  = 30
+STATS_PERIOD = 1.0      # [s]
+
+
+def _thread_time_windows():
+    import ctypes
+    from ctypes import wintypes
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentThread.restype = wintypes.HANDLE
+    kernel32.GetThreadTimes.argtypes = [wintypes.HANDLE] + [ctypes.POINTER(wintypes.FILETIME)] * 4
+    thread = kernel32.GetCurrentThread()
+
+    def thread_time():
+        times = [wintypes.FILETIME() for i in range(4)]
+        kernel32.GetThreadTimes(thread, *[ctypes.byref(t) for t in times])
+        kernel, user = times[2], times[3]
+        ticks = ((kernel.dwHighDateTime + user.dwHighDateTime) << 32) \
+            + kernel.dwLowDateTime + user.dwLowDateTime
+        return ticks * 100e-9
+    return thread_time
+
+
+def _thread_time_rusage():
+    import resource
+    RUSAGE_THREAD = 1   # Linux only, not exported by the Python 2 resource module
+
+    def thread_time():
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return thread_time
+
+
+def _thread_time():
+    # CPU time of the calling thread in s, the best the platform offers
+    if hasattr(time, 'thread_time'):
+        return time.thread_time
+    try:
+        if os.name == 'nt':
+            return _thread_time_windows()
+        if sys.platform.startswith('linux'):
+            return _thread_time_rusage()
+    except (ImportError, AttributeError, OSError):
+        pass
+    return None     # No per thread CPU time, cpu_load stays None
+
+thread_time = _thread_time()
+
+
+class RenderScheduler(object):
+    ''' Coalesces plot updates and redraws at most fps times a second.
+        Data handlers call mark_dirty(name) from any thread, as often as
+        they like. tick(), called from the GUI thread by a timer at the
+        frame interval, runs each dirty redraw once. Nothing is redrawn
+        while visible() is false; the pending updates are kept for when the
+        window shows again.
+        cpu_load is the share of one core the calling thread used over the
+        last STATS_PERIOD, measured around everything it did, including
+        the Qt painting between ticks. Redraw times, frames and the load
+        also go to registry.
+    '''
+    def __init__(self, fps=DEFAULT_FPS, visible=None, registry=REGISTRY):
+        self.fps = fps
+        self.visible = visible
+        self._redraws = {}
+        self._dirty = set()
+        self._lock = threading.Lock()   # mark_dirty() is called from the decoder threads
+
+        self.frames = 0             # Ticks that redrew something
+        self.skipped = 0            # Ticks with pending updates while hidden
+        self.frame_rate = 0.0       # Over the last STATS_PERIOD
+        self.render_time = 0.0      # Average time in the redraw functions per frame [s]
+        self.cpu_load = None
+        self._period_start = time.time()
+        self._period_cpu = thread_time() if thread_time else None
+        self._period_frames = 0
+        self._period_render = 0.0
+
+        self._redraw_time = registry.histogram('gui_redraw_seconds', "Time in the redraw functions per frame")
+        self._frames = registry.counter('gui_frames_total', "Frames redrawn")
+        registry.gauge('gui_cpu_load', "Share of a core used by the GUI thread", func=lambda: self.cpu_load or 0.0)
+        registry.gauge('gui_frame_rate', "Frames redrawn per second", func=lambda: self.frame_rate)
+
+    @property
+    def interval_ms(self):
+        ''' Timer interval for tick() '''
+        return max(int(1000.0 / self.fps), 1)
+
+    def add(self, name, redraw):
+        self._redraws[name] = redraw
+
+    def mark_dirty(self, name):
+        with self._lock:
+            self._dirty.add(name)
+
+    def tick(self):
+        now = time.time()
+        if now - self._period_start >= STATS_PERIOD:
+            self._update_stats(now)
+
+        if not self._dirty:
+            return
+        if self.visible is not None and not self.visible():
+            self.skipped += 1
+            return
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        start = time.time()
+        for name in dirty:
+            self._redraws[name]()
+        elapsed = time.time() - start
+        self._redraw_time.observe(elapsed)
+        self._frames.inc()
+        self._period_render += elapsed
+        self._period_frames += 1
+        self.frames += 1
+
+    def _update_stats(self, now):
+        elapsed = now - self._period_start
+        self.frame_rate = self._period_frames / elapsed
+        self.render_time = self._period_render / self._period_frames if self._period_frames else 0.0
+        if thread_time:
+            cpu = thread_time()
+            self.cpu_load = (cpu - self._period_cpu) / elapsed
+            self._period_cpu = cpu
+        self._period_start = now
+        self._period_frames = 0
+        self._period_render = 0.0
+
+    def stats(self):
+        return {'frame_rate': self.frame_rate,
+                'render_time': self.render_time,
+                'cpu_load': self.cpu_load,
+                'frames': self.frames,
+                'skipped': self.skipped}
@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class RingBuffer(object):
+    ''' Fixed size circular buffer for sample data.
+        Every sample is stored twice, at idx and idx + size, so the samples
+        ordered oldest to newest are always one contiguous slice of the storage.
+        This gives O(1) append and a zero-copy ordered view for plotting.
+    '''
+    def __init__(self, size, dtype=np.float64):
+        self.dtype = dtype
+        self.size = max(int(size), 1)
+        self.total = 0      # Number of samples appended since creation
+        self.resets = 0     # Number of clear() and resize() calls
+        self._data = np.zeros(2 * self.size, dtype=dtype)
+        self._head = 0      # Position of the oldest sample, next to be overwritten
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        return self.view()[key]
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.view()
+        return self.view().astype(dtype)
+
+    def append(self, value):
+        ''' Add one sample, overwriting the oldest '''
+        i = self._head
+        self._data[i] = value
+        self._data[i + self.size] = value
+        self._head = (i + 1) % self.size
+        self.total += 1
+
+    def _store(self, storage, values):
+        # Write at most size values from the head on into a mirrored storage
+        # array laid out like _data. The head is not moved.
+        n = len(values)
+        i = self._head
+        first = min(n, self.size - i)
+        storage[i:i + first] = values[:first]
+        storage[i + self.size:i + self.size + first] = values[:first]
+        rest = n - first
+        if rest:
+            storage[:rest] = values[first:]
+            storage[self.size:self.size + rest] = values[first:]
+
+    def extend(self, values):
+        ''' Add a block of samples, overwriting the oldest '''
+        values = np.asarray(values, dtype=self.dtype)
+        self.total += len(values)
+        if len(values) > self.size:
+            values = values[-self.size:]
+        n = len(values)
+        if n == 0:
+            return
+        self._store(self._data, values)
+        self._head = (self._head + n) % self.size
+
+    def view(self):
+        ''' All samples, oldest first, as a view into the storage (no copy).
+            The view changes as new samples are appended.
+        '''
+        return self._data[self._head:self._head + self.size]
+
+    def latest(self, n):
+        ''' View of the n newest samples '''
+        n = min(int(n), self.size)
+        end = self._head + self.size
+        return self._data[end - n:end]
+
+    def snapshot(self, since=None, count=None):
+        ''' (total, resets, copy of up to count samples appended after the
+            first since of them), all samples if since is None. The copy is
+            None if some of them were overwritten already.
+        '''
+        new = self.size if since is None else self.total - since
+        if not 0 <= new <= self.size:
+            return self.total, self.resets, None
+        return self.total, self.resets, self.latest(new)[:count].copy()
+
+    def clear(self):
+        self._data[:] = 0
+        self._head = 0
+        self.resets += 1
+
+    def resize(self, size):
+        ''' Change the buffer length, keeping the newest samples '''
+        size = max(int(size), 1)
+        if size == self.size:
+            return
+        keep = self.latest(size).copy()
+        self.resets += 1
+        self.size = size
+        self._data = np.zeros(2 * size, dtype=self.dtype)
+        self._head = 0
+        self._data[size - len(keep):size] = keep
+        self._data[2 * size - len(keep):] = keep
@@ -1,6 +1,12 @@
+import collections
+import contextlib
 import threading
 import time
 from pynrfjprog import API
+from libs.deframer import Deframer, stuff
+from libs.framequeue import FrameQueue, DROP_OLDEST
+from libs.poller import AdaptivePoller
+from libs.metrics import REGISTRY, BYTES_BUCKETS, COUNT_BUCKETS
 
 JLINK_PRO_V8    = 4000
 JLINK_OBD       = 1000
@@ -8,13 +14,14 @@ JLINK_OBD       = 1000
 # Always try to have highest speed
 JLINK_SPEED_KHZ = JLINK_PRO_V8
 
-STX = 0x02
-ETX = 0x03
-ESC = 0x1F
+# Frames buffered between the reader and the decoders, about 10 s of average data
+FRAME_QUEUE_SIZE = 100000
+DECODE_BATCH     = 1024
 
-MODE_IDLE = 0
-MODE_RECV = 1
-MODE_ESC_RECV = 2
+# Commands
+WRITE_TIMEOUT     = 1.0     # To get a batch into the RTT down buffer [s]
+WRITE_RETRY_SLEEP = 0.001   # Between writes while the down buffer is full [s]
+LATENCY_HISTORY   = 1000    # Latencies kept for stats()
 
 NRF_EGU0_BASE          = 0x40014000
 TASKS_TRIGGER0_OFFSET  = 0
@@ -35,15 +42,152 @@ TASKS_TRIGGER14_OFFSET = 56
 TASKS_TRIGGER15_OFFSET = 60
 
 
+class CommandError(IOError):
+    ''' A command could not be sent to the PPK '''
+
+
+class CommandQueue(object):
+    ''' Commands for the PPK, framed into one bytearray as they are added.
+        Outside a batch() every command is sent right away; inside one they
+        are kept until the outermost batch ends. Either way everything
+        pending goes out in one rtt_write and one EGU trigger, which makes
+        the firmware read its RTT down buffer. If the down buffer takes only
+        part of it, the firmware is triggered and the rest written again
+        until WRITE_TIMEOUT.
+        The latency of a command is from put() until its batch is triggered.
+        Failures raise CommandError; the commands of a failed batch are
+        dropped.
+    '''
+    def __init__(self, link, registry=REGISTRY):
+        self.link = link            # The rtt, its nrfjprog is replaced on reconnect
+        self._pending = bytearray()
+        self._queued = []           # (command id, put() time) of the pending commands
+        self._depth = 0             # Nesting of batch()
+        self._lock = threading.RLock()
+
+        self.commands = 0           # Sent
+        self.writes = 0             # rtt_write calls
+        self.bytes_written = 0
+        self.failures = 0           # Batches that raised CommandError
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)  # (command id, s)
+        self._latency = registry.histogram('command_latency_seconds', "From queueing a command until it was sent")
+        self._failures = registry.counter('command_failures_total', "Command batches that could not be sent")
+
+    def put(self, cmd):
+        ''' Queue a command, bytes or byte values starting with the command id '''
+        with self._lock:
+            self._pending += stuff(cmd)
+            self._queued.append((bytearray(cmd[:1])[0], time.time()))
+            if not self._depth:
+                self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        ''' Send all commands put() in the with block together at its end '''
+        with self._lock:
+            self._depth += 1
+            try:
+                yield self
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    self.flush()
+
+    def flush(self):
+        ''' Send the pending commands '''
+        with self._lock:
+            if not self._pending:
+                return
+            data, self._pending = bytes(self._pending), bytearray()
+            queued, self._queued = self._queued, []
+            try:
+                self._send(data)
+            except CommandError:
+                self.failures += 1
+                self._failures.inc()
+                raise
+            done = time.time()
+            self.commands += len(queued)
+            self.bytes_written += len(data)
+            self.latencies.extend((cmd, done - queued_at) for cmd, queued_at in queued)
+            for cmd, queued_at in queued:
+                self._latency.observe(done - queued_at)
+
+    def _send(self, data):
+        # Lock must be held
+        nrfjprog = self.link.nrfjprog
+        deadline = time.time() + WRITE_TIMEOUT
+        try:
+            while True:
+                written = nrfjprog.rtt_write(0, data, encoding=None)
+                self.writes += 1
+                data = data[written:]
+                nrfjprog.write_u32(NRF_EGU0_BASE + TASKS_TRIGGER0_OFFSET, 0x00000001, 0)
+                nrfjprog.go()
+                if not data:
+                    return
+                if time.time() > deadline:
+                    raise CommandError("RTT down buffer full, %d bytes of commands not sent" % len(data))
+                time.sleep(WRITE_RETRY_SLEEP)
+        except CommandError:
+            raise
+        except Exception as e:
+            raise CommandError("Unable to send command to the PPK: %s" % e)
+
+    def stats(self):
+        latencies = [latency for cmd, latency in self.latencies]
+        return {'commands': self.commands,
+                'writes': self.writes,
+                'bytes': self.bytes_written,
+                'failures': self.failures,
+                'latency_last': latencies[-1] if latencies else None,
+                'latency_mean': sum(latencies) / len(latencies) if latencies else None,
+                'latency_max': max(latencies) if latencies else None}
+
+
 class rtt(object):
-    def __init__(self, callback):
+    def __init__(self, callback, queue_size=FRAME_QUEUE_SIZE, drop_policy=DROP_OLDEST, decoders=1, api=API.API,
+                 batch=False, registry=REGISTRY, snr=None, raw_callback=None):
+        ''' callback is called with every received frame from the decoder thread(s),
+            or with the list of frames of each batch of up to DECODE_BATCH if batch is true.
+            With more than one decoder frames may be handled out of order.
+            api is the pynrfjprog API class, or a stand-in with the same methods.
+            snr is the serial number of the emulator to use, any one if None.
+            With raw_callback every chunk read is passed to it as it is
+            instead, from the reader thread, and no decoders are started.
+            Reads, decoding and the frame queue are measured in registry,
+            labelled with the snr if given.
+        '''
+        labels = {'snr': str(snr)} if snr is not None else None
+        self._read_bytes = registry.histogram('rtt_read_bytes', "Bytes returned by rtt_read", labels,
+                                              buckets=BYTES_BUCKETS)
+        self._read_errors = registry.counter('rtt_read_errors_total', "rtt_read calls that raised", labels)
+        self._reconnects = registry.counter('rtt_reconnects_total', "Reconnects after a lost connection", labels)
+        self._decode_time = registry.histogram('decode_batch_seconds', "Time in the frame callback per batch", labels)
+        self._batch_frames = registry.histogram('decode_batch_frames', "Frames per decoded batch", labels,
+                                                buckets=COUNT_BUCKETS)
+        registry.gauge('frame_queue_depth', "Frames waiting for the decoders", labels,
+                       func=lambda: self.queue.depth)
+        registry.gauge('frame_queue_high_water', "Highest frame queue depth", labels,
+                       func=lambda: self.queue.high_water)
+        registry.gauge('frame_queue_dropped', "Frames dropped by the full queue", labels,
+                       func=lambda: self.queue.dropped)
+        registry.gauge('rtt_poll_rate', "rtt_read calls per second", labels,
+                       func=lambda: self.poller.poll_rate)
+        registry.gauge('rtt_data_rate_bytes', "Bytes per second from the PPK", labels,
+                       func=lambda: self.poller.data_rate)
         self.alive = True
+        self.api = api
+        self.snr = snr
         # Open connection to debugger and rtt
-        self.nrfjprog = API.API('NRF52')
+        self.nrfjprog = self.api('NRF52')
         self.nrfjprog.open()
         try:
-            self.nrfjprog.connect_to_emu_without_snr(jlink_speed_khz=JLINK_SPEED_KHZ)
+            self._connect()
         except:
+            if snr is not None:
+                self.nrfjprog.close()
+                raise IOError("No emulator with serial number %s" % snr)
             print "\r\nNo emulator connection detected, exiting."
             exit()
         self.nrfjprog.sys_reset()
@@ -52,6 +196,19 @@ class rtt(object):
         time.sleep(1)
 
         self.callback = callback
+        self.raw_callback = raw_callback
+        self.batch = batch
+        self.deframer = Deframer()
+        self.queue = FrameQueue(queue_size, drop_policy)
+        self.decoders = decoders
+        self.poller = AdaptivePoller()
+        self.commands = CommandQueue(self, registry)
+
+    def _connect(self):
+        if self.snr is None:
+            self.nrfjprog.connect_to_emu_without_snr(jlink_speed_khz=JLINK_SPEED_KHZ)
+        else:
+            self.nrfjprog.connect_to_emu_with_snr(self.snr, jlink_speed_khz=JLINK_SPEED_KHZ)
 
     def start(self):
         #Start thread for reading rtt.
@@ -59,41 +216,59 @@ class rtt(object):
         self.read_thread.setDaemon(True)
         self.read_thread.start()
 
+        # Decoding runs separately so slow handling never delays rtt_read
+        self.decode_threads = []
+        for i in range(self.decoders if self.raw_callback is None else 0):
+            thread = threading.Thread(target=self.t_decode)
+            thread.setDaemon(True)
+            thread.start()
+            self.decode_threads.append(thread)
+
+    def stop(self):
+        ''' Stop reading, let the decoders finish what is queued and close the debugger '''
+        self.alive = False
+        self.read_thread.join()
+        self.queue.close()
+        for thread in self.decode_threads:
+            thread.join()
+        self.nrfjprog.close()
+
+    def t_decode(self):
+        while not self.queue.closed or len(self.queue):
+            frames = self.queue.get_batch(DECODE_BATCH, timeout=0.5)
+            if not frames:
+                continue
+            start = time.time()
+            if self.batch:
+                try:
+                    self.callback(frames)
+                except Exception as e:
+                    print e
+            else:
+                for frame in frames:
+                    try:
+                        self.callback(frame)
+                    except Exception as e:
+                        print e
+            self._decode_time.observe(time.time() - start)
+            self._batch_frames.observe(len(frames))
+
     def t_read(self):
         print "Power Profiler Kit running"
         try:
-            self.read_mode = MODE_IDLE
-            data_buffer = []
-
             while self.alive:
                 try:
-                    data = self.nrfjprog.rtt_read(0,10000, encoding=None)
-                    if data != '':
-                        for byte in data:
-                            n = byte
-                            if self.read_mode == MODE_IDLE:
-                                ''' Mode Idle - Not Receiving '''
-                                if n == STX:
-                                    self.read_mode = MODE_RECV
-
-                            elif self.read_mode == MODE_RECV:
-                                ''' Mode Receiving - Receiving data '''
-                                if n == ESC:
-                                    self.read_mode = MODE_ESC_RECV
-                                elif n == ETX:
-                                    self.callback(data_buffer)
-                                    data_buffer[:] = []
-                                    self.read_mode = MODE_IDLE
-                                elif n == STX:
-                                    data_buffer[:] = []
-                                else:
-                                    data_buffer.append(n)
-
-                            elif self.read_mode == MODE_ESC_RECV:
-                                ''' Mode Escape Received - Convert next byte '''
-                                data_buffer.append(n ^ 0x20)
-                                self.read_mode = MODE_RECV
+                    data = self.nrfjprog.rtt_read(0, self.poller.read_size, encoding=None)
+                    self.poller.update(len(data))
+                    self._read_bytes.observe(len(data))
+                    if data and self.raw_callback is not None:
+                        self.raw_callback(data)
+                    elif data:
+                        # Frames are immutable bytes, the handler may keep them
+                        self.queue.put_many(self.deframer.feed(data))
+                    self.poller.wait()
                 except Exception as e:
+                    self._read_errors.inc()
                     print e
                     print "Lost connection, retrying for 10 times"
                     print ("Reconnecting...")
@@ -104,14 +279,16 @@ class rtt(object):
                             print tries
                             time.sleep(0.6)
                             self.nrfjprog.close()
-                            self.nrfjprog = API.API('NRF52')
+                            self.nrfjprog = self.api('NRF52')
                             self.nrfjprog.open()
-                            self.nrfjprog.connect_to_emu_without_snr(jlink_speed_khz=JLINK_SPEED_KHZ)
+                            self._connect()
                             self.nrfjprog.sys_reset()
                             self.nrfjprog.go()
                             self.nrfjprog.rtt_start()
+                            self.deframer.reset()
                             time.sleep(1)
                             print "Reconnected, you may start the graphs again."
+                            self._reconnects.inc()
                             connected = True
                             break
 
@@ -127,20 +304,8 @@ class rtt(object):
         except Exception, e:
             print e
             self.alive = False
+            self.queue.close()
 
     def write_stuffed(self, cmd):
-        s = ''
-        s = chr(STX)
-        for byte in cmd:
-            if byte == STX or byte == ETX or byte == ESC:
-                s = s + chr(ESC)
-                s = s + chr(byte ^ 0x20)
-            else:
-                s = s + chr(byte)
-        s = s + chr(ETX)
-        try:
-            self.nrfjprog.rtt_write(0, s, encoding=None)
-            self.nrfjprog.write_u32(NRF_EGU0_BASE + TASKS_TRIGGER0_OFFSET, 0x00000001, 0)
-            self.nrfjprog.go()
-        except:
-            pass
+        ''' Send a command, or queue it inside commands.batch(). Raises CommandError. '''
+        self.commands.put(cmd)
@@ -0,0 +1,215 @@
+from __future__ import print_function
+import io
+import json
+import os
+import threading
+import time
+from libs.charge import ChargeReading
+
+SESSION = 'session'     # Accumulators used in the device ChargeIntegrator
+TOTAL   = 'total'
+
+EMIT_INTERVAL       = 2.0   # [s]
+CHECKPOINT_INTERVAL = 60.0  # [s]
+CHECKPOINT_VERSION  = 1
+CHECKPOINT_SESSIONS = 1000  # Newest ended sessions kept in the checkpoint, all are in the log
+
+
+class Session(object):
+    ''' One stretch of time with the DUT either on or off '''
+    def __init__(self, index, dut_on, start, reading=None, end=None, interrupted=False):
+        self.index = index
+        self.dut_on = dut_on
+        self.start = start              # Wall clock time
+        self.end = end                  # None while it runs
+        self.reading = reading or ChargeReading()
+        self.interrupted = interrupted  # Ended by a crash, totals are from the last checkpoint
+
+    def as_dict(self):
+        return {'index': self.index, 'dut_on': self.dut_on, 'start': self.start, 'end': self.end,
+                'reading': self.reading.as_dict(), 'interrupted': self.interrupted}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['index'], d['dut_on'], d['start'], ChargeReading.from_dict(d['reading']),
+                   d['end'], d['interrupted'])
+
+    def log_line(self):
+        return "%s %s %s %10.1f s %12.6f mAh %12.6f mWh %12.6f mA%s\n" % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start)),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.end)),
+            'ON ' if self.dut_on else 'OFF', self.reading.seconds, self.reading.mAh,
+            self.reading.mWh, self.reading.current * 1e3, ' interrupted' if self.interrupted else '')
+
+
+class SessionEngine(object):
+    ''' Battery life bookkeeping on the acquisition side.
+        A new session starts each time the DUT is switched on or off; its
+        charge comes from the device ChargeIntegrator, which sees every
+        average sample in the decoder thread, so a stalled GUI loses nothing.
+        A thread of its own passes summary() to the on_emit callbacks every
+        emit_interval seconds and writes a small JSON checkpoint every
+        checkpoint_interval seconds. With resume=True a checkpoint left by a
+        crashed run is loaded: its sessions are kept, the one running is
+        closed as interrupted and the totals carry on from there.
+        Ended sessions are also appended to the text log, if given.
+    '''
+    def __init__(self, device, checkpoint=None, log=None, resume=False,
+                 emit_interval=EMIT_INTERVAL, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.device = device
+        self.checkpoint_path = checkpoint
+        self.log_path = log
+        self.emit_interval = emit_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.emit_callbacks = []
+
+        self.sessions = []              # Ended sessions
+        self.current = None
+        self._next_index = 0
+        self._base = ChargeReading()    # Total of a resumed run
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        if resume and checkpoint:
+            self._resume()
+
+    def on_emit(self, callback):
+        ''' callback(summary) every emit_interval seconds, from the engine thread '''
+        self.emit_callbacks.append(callback)
+
+    def start(self):
+        charge = self.device.charge
+        with self._lock:
+            charge.start(TOTAL)
+            self._new_session(self.device.dut_on)
+        self.device.on_dut_power(self.dut_changed)
+        self._thread = threading.Thread(target=self.t_engine)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def close(self):
+        ''' Ends the running session and writes a last checkpoint '''
+        self.device.remove_callback(self.dut_changed)
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            self._end_session()
+        self.save_checkpoint()
+
+    def _end_session(self):
+        # Lock must be held
+        if self.current is None:
+            return
+        self.current.reading = self.device.charge.read(SESSION)
+        self.current.end = time.time()
+        self.sessions.append(self.current)
+        self._log(self.current)
+        self.current = None
+
+    def _new_session(self, dut_on):
+        # Lock must be held
+        self.device.charge.start(SESSION)
+        self.current = Session(self._next_index, dut_on, time.time())
+        self._next_index += 1
+
+    def dut_changed(self, on):
+        with self._lock:
+            if self.current is not None and self.current.dut_on == on:
+                return
+            self._end_session()
+            self._new_session(on)
+
+    def _log(self, session):
+        if not self.log_path:
+            return
+        try:
+            with open(self.log_path, 'a') as f:
+                f.write(session.log_line())
+        except (IOError, OSError) as e:
+            print("Unable to write session log %s: %s" % (self.log_path, e))
+
+    def total(self):
+        ''' Charge of the whole run, resumed runs included '''
+        return self._base + self.device.charge.read(TOTAL)
+
+    def summary(self):
+        with self._lock:
+            current = self.current
+            reading = self.device.charge.read(SESSION) if current else ChargeReading()
+            total = self.total()
+            return {'session': current.index if current else self._next_index,
+                    'dut_on': current.dut_on if current else self.device.dut_on,
+                    'elapsed': time.time() - current.start if current else 0.0,
+                    'seconds': reading.seconds,
+                    'mAh': reading.mAh,
+                    'mWh': reading.mWh,
+                    'current': reading.current,
+                    'total_seconds': total.seconds,
+                    'total_mAh': total.mAh,
+                    'total_mWh': total.mWh}
+
+    def t_engine(self):
+        last_checkpoint = time.time()
+        while not self._stop.wait(self.emit_interval):
+            summary = self.summary()
+            for callback in self.emit_callbacks:
+                try:
+                    callback(summary)
+                except Exception as e:
+                    print("Session emit callback failed: %s" % e)
+            if time.time() - last_checkpoint >= self.checkpoint_interval:
+                self.save_checkpoint()
+                last_checkpoint = time.time()
+
+    def save_checkpoint(self):
+        ''' Write the state to the checkpoint file, replacing it atomically '''
+        if not self.checkpoint_path:
+            return
+        with self._lock:
+            current = None
+            if self.current is not None:
+                current = Session(self.current.index, self.current.dut_on, self.current.start,
+                                  self.device.charge.read(SESSION), time.time())
+            state = {'version': CHECKPOINT_VERSION,
+                     'saved': time.time(),
+                     'total': self.total().as_dict(),
+                     'next_index': self._next_index,
+                     'sessions': [s.as_dict() for s in self.sessions[-CHECKPOINT_SESSIONS:]],
+                     'current': current.as_dict() if current else None}
+        tmp = self.checkpoint_path + '.tmp'
+        try:
+            with io.open(tmp, 'wb') as f:
+                f.write(json.dumps(state).encode('ascii'))
+                f.flush()
+                os.fsync(f.fileno())
+            if os.name == 'nt' and os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)     # rename can't replace on Windows
+            os.rename(tmp, self.checkpoint_path)
+        except (IOError, OSError) as e:
+            print("Unable to write checkpoint %s: %s" % (self.checkpoint_path, e))
+
+    def _resume(self):
+        state = None
+        # The .tmp file is complete if the crash came between remove and rename
+        for path in (self.checkpoint_path, self.checkpoint_path + '.tmp'):
+            try:
+                with io.open(path, 'rb') as f:
+                    state = json.loads(f.read().decode('ascii'))
+                break
+            except (IOError, OSError, ValueError):
+                continue
+        if state is None:
+            return
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version %s in %s" % (state.get('version'), self.checkpoint_path))
+        self.sessions = [Session.from_dict(d) for d in state['sessions']]
+        if state['current']:
+            session = Session.from_dict(state['current'])
+            session.interrupted = True
+            self.sessions.append(session)
+            self._log(session)
+        self._next_index = state['next_index']
+        self._base = ChargeReading.from_dict(state['total'])
+        print("Resumed %d sessions, %.3f mAh so far" % (len(self.sessions), self._base.mAh))
@@ -0,0 +1,122 @@
+from __future__ import print_function
+import ctypes
+import multiprocessing
+import struct
+import numpy as np
+
+# Record header: payload length, kind and two ints for the kind to use
+HEADER = struct.Struct('<IIii')
+ALIGN  = 16                 # Records start at multiples of this, so payloads can be viewed as any dtype
+PAD    = 0                  # Kind of the filler record before the wrap around
+
+_WRITE = 0                  # Positions, counted in bytes from the start
+_READ  = 1
+
+
+def _aligned(n):
+    return (n + ALIGN - 1) & ~(ALIGN - 1)
+
+
+class ShmRing(object):
+    ''' Ring of variable length records in shared memory, for one writer
+        process and one reader process.
+        The writer reserve()s a record, fills the numpy view it gets and
+        commit()s it; the reader get()s the oldest record as a numpy view
+        of the shared buffer and release()s it when done, nothing is copied
+        on either side. A record never wraps: if it doesn't fit before the
+        end of the buffer the rest is padded and it starts at the beginning.
+        The write and read positions are only ever increased, each by one
+        side, so no lock is needed. commit() signals a semaphore that
+        wait() blocks on.
+        Made with multiprocessing.RawArray, so it can be passed to a
+        multiprocessing.Process as an argument.
+    '''
+    def __init__(self, size):
+        self.size = _aligned(int(size))
+        self._buffer = multiprocessing.RawArray(ctypes.c_ubyte, self.size)
+        self._positions = multiprocessing.RawArray(ctypes.c_longlong, 2)
+        self._doorbell = multiprocessing.Semaphore(0)
+        self._attach()
+
+    def _attach(self):
+        self.data = np.frombuffer(self._buffer, dtype=np.uint8)
+        self._reserved = None       # Position after the record being written
+        self._next = None           # Position after the record being read
+
+    def __getstate__(self):
+        return {'size': self.size, '_buffer': self._buffer, '_positions': self._positions,
+                '_doorbell': self._doorbell}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    @property
+    def used(self):
+        ''' Bytes written and not released yet, headers and padding included '''
+        return self._positions[_WRITE] - self._positions[_READ]
+
+    # Writer side
+    def reserve(self, kind, nbytes, a=0, b=0):
+        ''' A uint8 view of nbytes to fill for a record, None if the ring is too full '''
+        need = HEADER.size + _aligned(nbytes)
+        if need > self.size // 2:
+            # Larger ones might never fit between the padding and the reader
+            raise ValueError("Record of %d bytes larger than half the ring" % nbytes)
+        write = self._positions[_WRITE]
+        free = self.size - (write - self._positions[_READ])
+        offset = write % self.size
+        pad = self.size - offset if offset + need > self.size else 0
+        if pad + need > free:
+            return None
+        if pad:
+            HEADER.pack_into(self.data, offset, pad - HEADER.size, PAD, 0, 0)
+            offset = 0
+        HEADER.pack_into(self.data, offset, nbytes, kind, a, b)
+        self._reserved = write + pad + need
+        start = offset + HEADER.size
+        return self.data[start:start + nbytes]
+
+    def commit(self):
+        ''' Make the reserved record visible to the reader '''
+        self._positions[_WRITE] = self._reserved
+        self._reserved = None
+        self._doorbell.release()
+
+    def put(self, kind, payload, a=0, b=0):
+        ''' Copy bytes or an array into a record, False if the ring is too full '''
+        payload = np.frombuffer(payload, dtype=np.uint8) if isinstance(payload, bytes) else \
+            np.ascontiguousarray(payload).view(np.uint8).ravel()
+        view = self.reserve(kind, len(payload), a, b)
+        if view is None:
+            return False
+        view[:] = payload
+        self.commit()
+        return True
+
+    # Reader side
+    def get(self):
+        ''' (kind, a, b, payload) of the oldest record, payload a uint8 view
+            valid until release(). None if the ring is empty.
+        '''
+        read = self._positions[_READ]
+        while read < self._positions[_WRITE]:
+            offset = read % self.size
+            nbytes, kind, a, b = HEADER.unpack_from(self.data, offset)
+            if kind == PAD:
+                read += HEADER.size + nbytes
+                self._positions[_READ] = read
+                continue
+            self._next = read + HEADER.size + _aligned(nbytes)
+            start = offset + HEADER.size
+            return kind, a, b, self.data[start:start + nbytes]
+        return None
+
+    def release(self):
+        ''' Free the record from the last get() for the writer '''
+        self._positions[_READ] = self._next
+        self._next = None
+
+    def wait(self, timeout):
+        ''' Block until a record may have been committed, or timeout seconds '''
+        return self._doorbell.acquire(True, timeout)
@@ -0,0 +1,439 @@
+from __future__ import print_function
+import collections
+import math
+import time
+import numpy as np
+import libs.protocol as protocol
+from libs.deframer import Deframer, stuff, STX, ETX, ESC
+from libs.measurement import (SAMPLE_INTERVAL, ADC_REF, ADC_GAIN, ADC_MAX, MEAS_ADC_MSK, MEAS_RANGE_POS,
+                              MEAS_RANGE_LO, MEAS_RANGE_MID, MEAS_RANGE_HI)
+
+NRF_EGU0_TASKS_TRIGGER0 = 0x40014000
+
+UP_BUFFER_SIZE        = 1 << 20     # Bytes the PPK can have waiting for rtt_read, more are dropped
+DOWN_BUFFER_SIZE      = 128         # Bytes rtt_write can leave for the PPK before it is triggered
+GENERATE_CHUNK        = 8192        # Samples made at a time when not running in real time
+MAX_CATCHUP           = 1.0         # Longest gap filled in after a late rtt_read [s]
+TRIGGER_FRAME_SAMPLES = 8           # Raw samples per trigger frame
+RANGE_FULL_SCALE      = 0.9         # Part of a range's full scale where auto ranging switches up
+COMMAND_HISTORY       = 1000
+
+# Board the simulator pretends to be
+RES_LO   = 510.0
+RES_MID  = 28.0
+RES_HI   = 1.8
+BOARD_ID = 'SIM00001'
+SNR      = 682000001    # Serial number of its J-Link OB
+VDD      = 3000
+VREF_HI  = 26000
+VREF_LO  = 26000
+
+# RTT_CMD_RANGE_SET values: 10 uA, 1 mA, 100 mA, auto
+_FORCED_RANGES = {0: MEAS_RANGE_LO, 1: MEAS_RANGE_MID, 2: MEAS_RANGE_HI}
+
+
+# Waveforms, the DUT current in uA at an array of times in s
+def constant(uA):
+    return lambda t: np.full(len(t), float(uA))
+
+
+def square(low_uA, high_uA, period, duty=0.5):
+    ''' high_uA for the first duty part of every period, low_uA the rest '''
+    return lambda t: np.where(np.mod(t, period) < duty * period, float(high_uA), float(low_uA))
+
+
+def sine(mean_uA, amplitude_uA, period):
+    return lambda t: mean_uA + amplitude_uA * np.sin(2 * math.pi / period * t)
+
+
+WAVEFORMS = {'constant': constant, 'square': square, 'sine': sine}
+
+
+def parse_waveform(spec):
+    ''' Waveform from a spec like square:10,5000,0.1,0.01, the arguments of
+        the function of that name. ValueError if it can't be made.
+    '''
+    name, _, args = spec.partition(':')
+    if name not in WAVEFORMS:
+        raise ValueError("Unknown waveform %s, use one of %s" % (name, ', '.join(sorted(WAVEFORMS))))
+    try:
+        return WAVEFORMS[name](*[float(a) for a in args.split(',') if a])
+    except TypeError as e:
+        raise ValueError("Bad arguments for waveform %s: %s" % (name, e))
+
+
+def _stuff_averages(uA):
+    # Frames for an array of average samples, only the frames with bytes
+    # that need escaping are stuffed one by one
+    raw = np.asarray(uA, dtype=protocol.AVERAGE_SAMPLE).view(np.uint8).reshape(-1, 4)
+    framed = np.empty((len(raw), 6), dtype=np.uint8)
+    framed[:, 0] = STX
+    framed[:, 1:5] = raw
+    framed[:, 5] = ETX
+    special = ((raw == STX) | (raw == ETX) | (raw == ESC)).any(axis=1)
+    if not special.any():
+        return framed.tobytes()
+    parts = []
+    start = 0
+    for i in np.nonzero(special)[0].tolist():
+        parts.append(framed[start:i].tobytes())
+        parts.append(bytes(stuff(raw[i].tobytes())))
+        start = i + 1
+    parts.append(framed[start:].tobytes())
+    return b''.join(parts)
+
+
+class SimulatedPPK(object):
+    ''' The PPK firmware as seen over RTT.
+        Measures the current of a simulated DUT every SAMPLE_INTERVAL, from
+        waveform (uA at times in s) plus offset_uA and gaussian noise_uA,
+        and produces what the firmware sends: average frames of avg_samples
+        samples and, while a trigger is armed, windows of raw samples
+        encoded with their range, in frames of TRIGGER_FRAME_SAMPLES.
+        With realtime the samples are made as the wall clock passes, speed
+        times faster than the real PPK, and dropped if the up buffer is
+        full; otherwise every read gets as much
+        data as it asks for, as fast as it can be made. The samples are a
+        function of the sample count and seed only, so runs repeat exactly.
+        Commands are executed when the EGU task is triggered, as the
+        firmware does. snr is the serial number of the emulator on the board.
+    '''
+    def __init__(self, waveform=None, offset_uA=0.2, noise_uA=0.0, realtime=True, speed=1.0, seed=0,
+                 res_lo=RES_LO, res_mid=RES_MID, res_hi=RES_HI, board_id=BOARD_ID,
+                 trigger_frame_samples=TRIGGER_FRAME_SAMPLES, snr=SNR):
+        self.waveform = waveform or constant(100.0)
+        self.offset_uA = offset_uA
+        self.noise_uA = noise_uA
+        self.realtime = realtime
+        self.speed = speed
+        self.seed = seed
+        self.res = {MEAS_RANGE_LO: res_lo, MEAS_RANGE_MID: res_mid, MEAS_RANGE_HI: res_hi}
+        self.board_id = board_id
+        self.snr = snr
+        self.trigger_frame_samples = trigger_frame_samples
+        self.user_res = None
+
+        self.commands = collections.deque(maxlen=COMMAND_HISTORY)   # (name, values) received
+        self.bad_commands = 0
+        self.frames_sent = 0
+        self.bytes_dropped = 0
+        self.reset()
+
+    def reset(self):
+        ''' Power on state, with the calibration banner waiting to be read '''
+        self.running = False
+        self.dut_on = True
+        self.avg_samples = 10
+        self.vdd = VDD
+        self.vref_hi = VREF_HI
+        self.vref_lo = VREF_LO
+        self.forced_range = None
+        self.ext_trigger = False
+        self.trigger_level = None       # uA, None when no trigger is armed
+        self.single = False
+        self.trig_window = 512
+        self._window = []               # Raw samples of the window being captured
+        self._window_left = 0
+
+        self.sample_index = 0
+        self.run_sample = 0             # Sample index at the last RUN
+        self.averages_sent = 0          # Since the last RUN
+        self._started = time.time()
+        self._random = np.random.RandomState(self.seed)
+        self._pending = np.zeros(0)     # Samples not making up a whole average yet
+        self._deframer = Deframer()
+        self.up = bytearray(self.banner().encode('ascii'))
+        self.down = bytearray()
+
+    def banner(self):
+        res = [self.res[MEAS_RANGE_LO], self.res[MEAS_RANGE_MID], self.res[MEAS_RANGE_HI]]
+        user = self.user_res or res
+        return ("R1:%.3f R2:%.3f R3:%.3f Board ID %s USER SET R1:%.3f R2:%.3f R3:%.3f "
+                "Refs VDD: %d HI: %d LO: %d" % tuple(res + [self.board_id] + list(user)
+                                                      + [self.vdd, self.vref_hi, self.vref_lo]))
+
+    # Commands
+    def write(self, data):
+        ''' rtt_write, returns the number of bytes that fit in the down buffer '''
+        n = min(len(data), DOWN_BUFFER_SIZE - len(self.down))
+        self.down += bytearray(data[:n])
+        return n
+
+    def trigger_task(self):
+        ''' The EGU task the host triggers after writing, runs the commands received '''
+        frames = self._deframer.feed(bytes(self.down))
+        self.down = bytearray()
+        for frame in frames:
+            try:
+                command, values = protocol.decode_command(frame)
+            except ValueError:
+                self.bad_commands += 1
+                continue
+            self.commands.append((command.name, values))
+            self.execute(command, values)
+
+    def execute(self, command, values):
+        if command is protocol.RUN:
+            self.running = True
+            self.run_sample = self.sample_index
+            self.averages_sent = 0
+            self._pending = np.zeros(0)
+        elif command is protocol.STOP:
+            self.running = False
+        elif command is protocol.AVG_NUM_SET:
+            self.avg_samples = max(values[0] * 10, 1)
+        elif command in (protocol.TRIGGER_SET, protocol.SINGLE_TRIG):
+            self.trigger_level = values[0]
+            self.single = command is protocol.SINGLE_TRIG
+        elif command is protocol.TRIG_STOP:
+            self.trigger_level = None
+            self._window_left = 0
+            self._window = []
+        elif command is protocol.TRIG_WINDOW_SET:
+            self.trig_window = max(values[0], 1)
+        elif command is protocol.TOGGLE_EXT_TRIG:
+            self.ext_trigger = not self.ext_trigger
+        elif command is protocol.RANGE_SET:
+            self.forced_range = _FORCED_RANGES.get(values[0])
+        elif command is protocol.DUT:
+            self.dut_on = bool(values[0])
+        elif command is protocol.SETVDD:
+            self.vdd = values[0]
+        elif command is protocol.SETVREFHI:
+            self.vref_hi = values[0]
+        elif command is protocol.SETVREFLO:
+            self.vref_lo = values[0]
+        elif command is protocol.SET_RES_USER:
+            self.user_res = list(values)
+
+    # Measurements
+    def read(self, length):
+        ''' rtt_read, up to length bytes of what the PPK has sent '''
+        if self.realtime:
+            due = int((time.time() - self._started) * self.speed / SAMPLE_INTERVAL) - self.sample_index
+            skipped = max(due - int(MAX_CATCHUP * self.speed / SAMPLE_INTERVAL), 0)
+            if skipped:
+                self._skip(skipped)
+                due -= skipped
+            while due > 0:
+                n = min(due, GENERATE_CHUNK)
+                self._send(self.generate(n))
+                due -= n
+        else:
+            while self.running and len(self.up) < length:
+                self._send(self.generate(GENERATE_CHUNK))
+        data = bytes(self.up[:length])
+        del self.up[:length]
+        return data
+
+    def _send(self, data):
+        if len(self.up) + len(data) > UP_BUFFER_SIZE:
+            self.bytes_dropped += len(data)
+        else:
+            self.up += data
+
+    def _skip(self, n):
+        # Time passing without anyone reading, nothing of it is sent
+        self.sample_index += n
+        self._pending = np.zeros(0)
+
+    def current(self, n):
+        ''' The next n samples of the measured current in uA '''
+        t = (self.sample_index + np.arange(n)) * SAMPLE_INTERVAL
+        uA = self.waveform(t) if self.dut_on else np.zeros(n)
+        uA = uA + self.offset_uA
+        if self.noise_uA:
+            uA += self._random.normal(0.0, self.noise_uA, n)
+        self.sample_index += n
+        return uA
+
+    def raw_samples(self, uA):
+        ''' 16 bit samples with range and ADC value, as the PPK measures uA '''
+        amps = np.maximum(uA, 0.0) * 1e-6
+        lsb = dict((r, ADC_REF / (ADC_GAIN * ADC_MAX * self.res[r])) for r in self.res)
+        if self.forced_range is not None:
+            ranges = np.full(len(amps), self.forced_range)
+        else:
+            ranges = np.where(amps < RANGE_FULL_SCALE * MEAS_ADC_MSK * lsb[MEAS_RANGE_LO], MEAS_RANGE_LO,
+                              np.where(amps < RANGE_FULL_SCALE * MEAS_ADC_MSK * lsb[MEAS_RANGE_MID],
+                                       MEAS_RANGE_MID, MEAS_RANGE_HI))
+        scale = np.array([1.0, lsb[MEAS_RANGE_LO], lsb[MEAS_RANGE_MID], lsb[MEAS_RANGE_HI]])
+        adc = np.minimum(np.round(amps / scale[ranges]), MEAS_ADC_MSK).astype(np.uint16)
+        return adc | (ranges.astype(np.uint16) << MEAS_RANGE_POS)
+
+    def generate(self, n):
+        ''' Frames the PPK sends during the next n samples '''
+        uA = self.current(n)
+        if not self.running:
+            return b''
+        out = []
+        if self.trigger_level is not None or self._window_left:
+            out.append(self._trigger_frames(uA))
+
+        samples = np.concatenate((self._pending, uA))
+        full = len(samples) // self.avg_samples * self.avg_samples
+        self._pending = samples[full:]
+        averages = samples[:full].reshape(-1, self.avg_samples).mean(axis=1)
+        self.frames_sent += len(averages)
+        self.averages_sent += len(averages)
+        out.append(_stuff_averages(averages))
+        return b''.join(out)
+
+    def average_times(self, first, last):
+        ''' Wall clock times at which the PPK had averages first to last
+            (counted from the last RUN) complete, in real time mode without
+            skips or changes of avg_samples since the RUN.
+        '''
+        ends = self.run_sample + (np.arange(first, last + 1) + 1) * self.avg_samples
+        return self._started + ends * SAMPLE_INTERVAL / self.speed
+
+    def _trigger_frames(self, uA):
+        # Windows of raw samples starting where the current reaches the trigger level
+        frames = []
+        i = 0
+        while i < len(uA):
+            if not self._window_left:
+                if self.trigger_level is None:
+                    break
+                above = np.nonzero(uA[i:] >= self.trigger_level)[0]
+                if not len(above):
+                    break
+                i += int(above[0])
+                self._window_left = self.trig_window
+            n = min(self._window_left, len(uA) - i)
+            self._window.append(self.raw_samples(uA[i:i + n]))
+            self._window_left -= n
+            i += n
+            if not self._window_left:
+                window = np.concatenate(self._window)
+                self._window = []
+                for j in range(0, len(window), self.trigger_frame_samples):
+                    frames.append(bytes(stuff(protocol.encode_trigger_samples(
+                        window[j:j + self.trigger_frame_samples]))))
+                self.frames_sent += (len(window) + self.trigger_frame_samples - 1) // self.trigger_frame_samples
+                if self.single:
+                    self.trigger_level = None
+        return b''.join(frames)
+
+
+class API(object):
+    ''' Stand-in for the part of pynrfjprog.API.API used by rtt, talking to
+        a SimulatedPPK instead of a J-Link. Pass it, or the callable from
+        api_factory() or rack_factory(), as api to PPKDevice or rtt.
+        rack is {snr: SimulatedPPK} of the boards connected to the computer,
+        by default only ppk.
+    '''
+    def __init__(self, device_family='NRF52', ppk=None, rack=None):
+        self.device_family = device_family
+        if rack is None:
+            ppk = ppk or SimulatedPPK()
+            rack = {ppk.snr: ppk}
+        self.rack = rack
+        self.ppk = ppk or rack[min(rack)]
+        self.is_open = False
+        self.connected = False
+        self.rtt_started = False
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+        self.connected = False
+        self.rtt_started = False
+
+    def enum_emu_snr(self):
+        self._check(self.is_open, "open() first")
+        return sorted(self.rack)
+
+    def connect_to_emu_without_snr(self, jlink_speed_khz=None):
+        self._check(self.is_open, "open() first")
+        self.connected = True
+
+    def connect_to_emu_with_snr(self, serial_number, jlink_speed_khz=None):
+        self._check(self.is_open, "open() first")
+        self._check(serial_number in self.rack, "No emulator with serial number %s" % serial_number)
+        self.ppk = self.rack[serial_number]
+        self.connected = True
+
+    def sys_reset(self):
+        self._check(self.connected)
+        self.ppk.reset()
+        self.rtt_started = False
+
+    def go(self):
+        self._check(self.connected)
+
+    def rtt_start(self):
+        self._check(self.connected)
+        self.rtt_started = True
+
+    def rtt_read(self, channel_index, length, encoding='utf-8'):
+        self._check(self.rtt_started, "RTT not started")
+        data = self.ppk.read(length)
+        return data.decode(encoding) if encoding else data
+
+    def rtt_write(self, channel_index, msg, encoding='utf-8'):
+        self._check(self.rtt_started, "RTT not started")
+        return self.ppk.write(msg.encode(encoding) if encoding else bytes(msg))
+
+    def write_u32(self, addr, data, control):
+        self._check(self.connected)
+        if addr == NRF_EGU0_TASKS_TRIGGER0 and data:
+            self.ppk.trigger_task()
+
+    def _check(self, condition, message="Not connected to an emulator"):
+        if not condition:
+            raise RuntimeError(message)
+
+
+def api_factory(ppk=None, **options):
+    ''' api for PPKDevice or rtt where every connection, reconnects included,
+        talks to the same SimulatedPPK, made from options if not given.
+        The SimulatedPPK is the factory's ppk attribute.
+    '''
+    ppk = ppk or SimulatedPPK(**options)
+
+    def factory(device_family='NRF52'):
+        return API(device_family, ppk)
+    factory.ppk = ppk
+    return factory
+
+
+def rack_factory(boards, waveforms=None, **options):
+    ''' api for PPKDevice or rtt with boards SimulatedPPKs connected, found
+        by enum_emu_snr() and connect_to_emu_with_snr(). Each board gets
+        its own serial number, board id and seed, and the waveform from
+        waveforms at its position if given. The factory's ppks attribute
+        is {snr: SimulatedPPK}.
+    '''
+    ppks = {}
+    for i in range(boards):
+        board = dict(options, snr=SNR + i, board_id='SIM%05d' % (i + 1), seed=options.get('seed', 0) + i)
+        if waveforms:
+            board['waveform'] = waveforms[i % len(waveforms)]
+        ppks[SNR + i] = SimulatedPPK(**board)
+
+    def factory(device_family='NRF52'):
+        return API(device_family, rack=ppks)
+    factory.ppks = ppks
+    return factory
+
+
+if __name__ == '__main__':
+    # python -m libs.simulator, how fast the simulator makes data without real time pacing
+    ppk = SimulatedPPK(square(10.0, 5000.0, 0.01, 0.1), realtime=False, noise_uA=0.1)
+    ppk.execute(protocol.TRIGGER_SET, (1000,))
+    ppk.execute(protocol.RUN, ())
+    ppk.read(200)
+    deframer = Deframer()
+    start = time.time()
+    total = 0
+    frames = 0
+    while time.time() - start < 2.0:
+        data = ppk.read(262144)
+        total += len(data)
+        frames += len(deframer.feed(data))
+    elapsed = time.time() - start
+    print("%.1f MB/s, %.0f k frames/s, %.1f s of PPK time per s"
+          % (total / elapsed / 1e6, frames / elapsed / 1e3, ppk.sample_index * SAMPLE_INTERVAL / elapsed))
@@ -0,0 +1,273 @@
+from __future__ import print_function
+import collections
+import math
+import threading
+import numpy as np
+from libs.ringbuffer import RingBuffer
+
+
+class PrefixSumRingBuffer(RingBuffer):
+    ''' RingBuffer with the running sum and sum of squares stored next to
+        every sample, so the sum, mean and rms of any part of the buffer
+        take two lookups each.
+        The running sums are laid out like the samples. They are rebased
+        each time the buffer wraps around, so they stay about as large as
+        the sum over one buffer and the rounding error doesn't grow however
+        long it runs.
+        Samples are added from the decoder thread while the GUI thread reads
+        and resizes, a lock keeps them consistent. The methods starting with
+        an underscore expect it to be held.
+    '''
+    def __init__(self, size, dtype=np.float64):
+        RingBuffer.__init__(self, size, dtype)
+        self._lock = threading.Lock()
+        self._reset_sums()
+
+    def _reset_sums(self):
+        values = self.view().astype(np.float64)
+        self._cum = np.zeros(2 * self.size)
+        self._cumsq = np.zeros(2 * self.size)
+        # Both halves, the next wrap rebases from the one before the head
+        self._store(self._cum, np.cumsum(values))
+        self._store(self._cumsq, np.cumsum(values * values))
+        self._last = float(self._cum[self._head + self.size - 1])
+        self._lastsq = float(self._cumsq[self._head + self.size - 1])
+
+    def append(self, value):
+        with self._lock:
+            self._append(value)
+
+    def _append(self, value):
+        i = self._head
+        self._last += value
+        self._lastsq += value * value
+        self._cum[i] = self._cum[i + self.size] = self._last
+        self._cumsq[i] = self._cumsq[i + self.size] = self._lastsq
+        RingBuffer.append(self, value)
+        if self._head == 0:
+            self._rebase()
+
+    def extend(self, values):
+        with self._lock:
+            self._extend(np.asarray(values, dtype=self.dtype))
+
+    def _extend(self, values):
+        if len(values) > self.size:
+            self.total += len(values) - self.size
+            values = values[-self.size:]
+        if not len(values):
+            return
+        wraps = self._head + len(values) >= self.size
+        cums = self._last + np.cumsum(values, dtype=np.float64)
+        cumsqs = self._lastsq + np.cumsum(np.square(values, dtype=np.float64))
+        self._store(self._cum, cums)
+        self._store(self._cumsq, cumsqs)
+        self._last = float(cums[-1])
+        self._lastsq = float(cumsqs[-1])
+        RingBuffer.extend(self, values)
+        if wraps:
+            self._rebase()
+
+    def _rebase(self):
+        # Make the running sums count from the oldest sample again
+        start = self._head
+        self._cum -= self._cum[start] - self._data[start]
+        self._cumsq -= self._cumsq[start] - self._data[start] ** 2
+        self._last = float(self._cum[start + self.size - 1])
+        self._lastsq = float(self._cumsq[start + self.size - 1])
+
+    def snapshot(self, since=None, count=None):
+        with self._lock:
+            return RingBuffer.snapshot(self, since, count)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        RingBuffer.clear(self)
+        self._reset_sums()
+
+    def resize(self, size):
+        with self._lock:
+            self._resize(size)
+
+    def _resize(self, size):
+        if max(int(size), 1) == self.size:
+            return
+        RingBuffer.resize(self, size)
+        self._reset_sums()
+
+    def sums(self, i, j):
+        ''' Sum and sum of squares of view()[i:j] '''
+        with self._lock:
+            return self._sums(i, j)
+
+    def _sums(self, i, j):
+        i = min(max(int(i), 0), self.size)
+        j = min(max(int(j), i), self.size)
+        if i == j:
+            return 0.0, 0.0
+        h = self._head
+        end_sum, end_sumsq = self._cum[h + j - 1], self._cumsq[h + j - 1]
+        # Running sums just before sample i
+        value = self._data[h + i]
+        start_sum = self._cum[h + i] - value
+        start_sumsq = self._cumsq[h + i] - value * value
+        return end_sum - start_sum, max(end_sumsq - start_sumsq, 0.0)
+
+    def region(self, i, j):
+        ''' Mean, rms and sum of view()[i:j]. Raises ValueError when empty. '''
+        with self._lock:
+            return self._region(i, j)
+
+    def _region(self, i, j):
+        i = min(max(int(i), 0), self.size)
+        j = min(max(int(j), i), self.size)
+        if i == j:
+            raise ValueError("Empty region")
+        total, total_sq = self._sums(i, j)
+        n = float(j - i)
+        return total / n, math.sqrt(total_sq / n), total
+
+
+class StatsRingBuffer(PrefixSumRingBuffer):
+    ''' PrefixSumRingBuffer that also keeps max and min of its contents up
+        to date as samples are added, so max, min, mean and rms are O(1)
+        to read however long the buffer is.
+        Max and min come from monotonic deques of (index, value), whose
+        front is the extreme of the window.
+    '''
+    def __init__(self, size, dtype=np.float64):
+        PrefixSumRingBuffer.__init__(self, size, dtype)
+        self._reset_stats()
+
+    def _reset_stats(self):
+        # Recompute everything from the contents, after clear() and resize()
+        values = self.view()
+        first = self.total - self.size      # Index of the oldest sample
+        self._maxq = self._extremes(values, first, np.maximum, np.greater)
+        self._minq = self._extremes(values, first, np.minimum, np.less)
+
+    @staticmethod
+    def _extremes(values, first, accumulate, better):
+        # Monotonic deque for the window: samples not beaten by a newer one
+        best_after = accumulate.accumulate(values[::-1])[::-1]
+        keep = np.append(better(values[:-1], best_after[1:]), True)
+        indices = np.nonzero(keep)[0]
+        return collections.deque(zip((indices + first).tolist(), values[indices].tolist()))
+
+    def _append(self, value):
+        value = float(value)
+        index = self.total
+        maxq = self._maxq
+        while maxq and maxq[-1][1] <= value:
+            maxq.pop()
+        maxq.append((index, value))
+        if maxq[0][0] <= index - self.size:
+            maxq.popleft()
+        minq = self._minq
+        while minq and minq[-1][1] >= value:
+            minq.pop()
+        minq.append((index, value))
+        if minq[0][0] <= index - self.size:
+            minq.popleft()
+
+        PrefixSumRingBuffer._append(self, value)
+
+    def _extend(self, values):
+        if len(values) >= self.size:
+            PrefixSumRingBuffer._extend(self, values)
+            self._reset_stats()
+            return
+        if not len(values):
+            return
+        self._merge(self._maxq, values, np.maximum, np.greater)
+        self._merge(self._minq, values, np.minimum, np.less)
+        PrefixSumRingBuffer._extend(self, values)
+
+    def _merge(self, queue, values, accumulate, better):
+        # A block at once: its own monotonic deque replaces the older entries
+        # its extreme beats or ties, then those out of the window are dropped.
+        # The loops only run over entries leaving the deque.
+        block = self._extremes(values, self.total, accumulate, better)
+        best = block[0][1]
+        while queue and not better(queue[-1][1], best):
+            queue.pop()
+        queue.extend(block)
+        oldest = self.total + len(values) - self.size
+        while queue[0][0] < oldest:
+            queue.popleft()
+
+    def _clear(self):
+        PrefixSumRingBuffer._clear(self)
+        self._reset_stats()
+
+    def _resize(self, size):
+        PrefixSumRingBuffer._resize(self, size)
+        self._reset_stats()
+
+    def stats(self):
+        ''' Returns max, min, mean and rms of the buffer '''
+        with self._lock:
+            mean, rms, total = self._region(0, self.size)
+            return self._maxq[0][1], self._minq[0][1], mean, rms
+
+
+if __name__ == '__main__':
+    # python -m libs.stats, stats() against the full rescans update_status did before
+    import time
+    size = 1000000
+    ring = StatsRingBuffer(size)
+    ring.extend(np.random.exponential(1e-3, size))
+
+    start = time.time()
+    for i in range(100000):
+        ring.append(np.random.exponential(1e-3) if i % 1000 else 0.5)
+    print("append: %.2f us per sample" % ((time.time() - start) * 10))
+
+    start = time.time()
+    _max, _min, _avg, _rms = ring.stats()
+    print("stats(): %.3f ms" % ((time.time() - start) * 1e3))
+
+    values = ring.view()
+    start = time.time()
+    ref = (max(values), min(values), np.average(values), np.sqrt(np.mean(np.absolute(values) ** 2)))
+    print("Full rescan: %.1f ms" % ((time.time() - start) * 1e3))
+    print("Largest relative difference: %.1e"
+          % max(abs(a - b) / abs(b) for a, b in zip((_max, _min, _avg, _rms), ref) if b))
+
+    # Running sums after a resize() to the same size with the head away from 0
+    ring = PrefixSumRingBuffer(3)
+    for value in range(8):
+        ring.append(float(value))
+    ring.resize(3)
+    ring.extend([10.0, 11.0])
+    assert ring.sums(0, 3)[0] == 7 + 10 + 11, ring.sums(0, 3)
+    ring = StatsRingBuffer(15384)
+    values = np.random.exponential(1e-3, 15384 + 7000)
+    ring.extend(values[:15384])
+    ring.extend(values[15384:])
+    ring.resize(15384)
+    for i in range(0, 20000, 500):
+        block = np.random.exponential(1e-3, 500)
+        ring.extend(block)
+        values = np.append(values, block)
+    window = values[-15384:]
+    assert np.isclose(ring.stats()[2], window.mean()), (ring.stats()[2], window.mean())
+    assert np.isclose(ring.region(0, 1000)[0], window[:1000].mean())
+    print("Running sums after resize(): ok")
+
+    # Blocks smaller than the buffer against appending one sample at a time
+    blocks = StatsRingBuffer(1000)
+    single = StatsRingBuffer(1000)
+    values = np.round(np.random.exponential(1e-3, 200000), 5)     # Ties too
+    start = time.time()
+    for i in range(0, len(values), 64):
+        blocks.extend(values[i:i + 64])
+    elapsed = time.time() - start
+    for value in values:
+        single.append(value)
+    assert list(blocks._maxq) == list(single._maxq) and list(blocks._minq) == list(single._minq)
+    assert blocks.stats()[:2] == (values[-1000:].max(), values[-1000:].min())
+    print("extend() of 64 sample blocks: %.2f us per sample" % (elapsed / len(values) * 1e6))
@@ -0,0 +1,338 @@
+from __future__ import print_function
+import threading
+import numpy as np
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from libs.ringbuffer import RingBuffer
+
+PRE_TRIGGER  = 0.01     # Captured before the trigger [s]
+POST_TRIGGER = 0.05     # Captured from the trigger on [s]
+EVENT_QUEUE  = 1000     # Events kept for events() before new ones are dropped
+
+_ONGOING = np.iinfo(np.int64).max     # End of a run that hasn't ended yet
+
+
+class _Runs(object):
+    ''' Runs of True in a boolean stream fed a block at a time.
+        feed() returns the start and end sample indices of every run in or
+        reaching into the block, the end of a run still going on at the end
+        of it is _ONGOING. Only the value and start of the last run are
+        carried between blocks.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.state = False
+        self.start = None
+
+    def feed(self, state, first):
+        empty = np.zeros(0, dtype=np.int64)
+        if not len(state):
+            return empty, empty
+        prev = np.empty(len(state) + 1, dtype=bool)
+        prev[0] = self.state
+        prev[1:] = state
+        change = np.flatnonzero(prev[1:] != prev[:-1])
+        rising = change[state[change]]
+        starts = rising.astype(np.int64) + first
+        ends = change[~state[change]].astype(np.int64) + first
+        if self.state:
+            starts = np.concatenate(([self.start], starts))
+        if len(starts) > len(ends):
+            ends = np.append(ends, _ONGOING)
+        self.state = bool(state[-1])
+        self.start = int(starts[-1]) if self.state else None
+        return starts, ends
+
+
+class Condition(object):
+    ''' What makes the trigger fire, found in blocks of samples in A.
+        Every condition has find(samples, first), which returns the indices
+        of the samples the trigger fires at, first being the index of
+        samples[0], counted from 0 at the last reset(), which clears the
+        state kept across blocks.
+        Durations are given in seconds and turned into samples by
+        bind(interval).
+    '''
+    def bind(self, interval):
+        self.reset()
+
+    def reset(self):
+        pass
+
+
+class Edge(Condition):
+    ''' The current crossing level, going up if rising or down otherwise '''
+    def __init__(self, level, rising=True):
+        self.level = level
+        self.rising = rising
+        self._runs = _Runs()
+
+    def reset(self):
+        self._runs.reset()
+
+    def find(self, samples, first):
+        starts, ends = self._runs.feed(samples >= self.level, first)
+        if self.rising:
+            return starts[starts > 0]   # The first sample has nothing before it to cross from
+        return ends[ends != _ONGOING]
+
+
+class Window(Condition):
+    ''' The current leaving the band from low to high, or entering it if inside '''
+    def __init__(self, low, high, inside=False):
+        self.low = low
+        self.high = high
+        self.inside = inside
+        self._runs = _Runs()
+
+    def reset(self):
+        self._runs.reset()
+
+    def find(self, samples, first):
+        outside = (samples < self.low) | (samples > self.high)
+        starts, ends = self._runs.feed(outside, first)
+        if self.inside:
+            return ends[ends != _ONGOING]
+        return starts[starts > 0]
+
+
+class PulseWidth(Condition):
+    ''' A pulse above level, or below it if not positive, lasting from
+        min_width to max_width seconds. Fires where the pulse ends.
+    '''
+    def __init__(self, level, min_width=0.0, max_width=None, positive=True):
+        self.level = level
+        self.min_width = min_width
+        self.max_width = max_width
+        self.positive = positive
+        self._runs = _Runs()
+
+    def bind(self, interval):
+        self._min = int(round(self.min_width / interval))
+        self._max = int(round(self.max_width / interval)) if self.max_width is not None else _ONGOING
+        self.reset()
+
+    def reset(self):
+        self._runs.reset()
+
+    def find(self, samples, first):
+        state = samples > self.level if self.positive else samples < self.level
+        starts, ends = self._runs.feed(state, first)
+        done = (ends != _ONGOING) & (starts > 0)     # A pulse going on at the start has no known width
+        width = ends[done] - starts[done]
+        return ends[done][(width >= self._min) & (width <= self._max)]
+
+
+class Above(Condition):
+    ''' The current above level, or below it if not above, for duration
+        seconds. Fires once per stretch, when it has lasted that long.
+    '''
+    def __init__(self, level, duration, above=True):
+        self.level = level
+        self.duration = duration
+        self.above = above
+        self._runs = _Runs()
+
+    def bind(self, interval):
+        self._samples = max(int(round(self.duration / interval)), 1)
+        self.reset()
+
+    def reset(self):
+        self._runs.reset()
+
+    def find(self, samples, first):
+        state = samples > self.level if self.above else samples < self.level
+        starts, ends = self._runs.feed(state, first)
+        fire = starts + self._samples - 1
+        return fire[(fire < ends) & (fire >= first) & (fire < first + len(samples))]
+
+
+CONDITIONS = {
+    'rising':  lambda uA: Edge(uA * 1e-6, rising=True),
+    'falling': lambda uA: Edge(uA * 1e-6, rising=False),
+    'window':  lambda low_uA, high_uA: Window(low_uA * 1e-6, high_uA * 1e-6),
+    'enter':   lambda low_uA, high_uA: Window(low_uA * 1e-6, high_uA * 1e-6, inside=True),
+    'pulse':   lambda uA, min_s, max_s=None: PulseWidth(uA * 1e-6, min_s, max_s),
+    'dip':     lambda uA, min_s, max_s=None: PulseWidth(uA * 1e-6, min_s, max_s, positive=False),
+    'above':   lambda uA, s: Above(uA * 1e-6, s),
+    'below':   lambda uA, s: Above(uA * 1e-6, s, above=False),
+}
+
+
+def parse_condition(spec):
+    ''' Condition from a spec like pulse:1000,0.001,0.01, the arguments of
+        CONDITIONS[name] with currents in uA and times in s. ValueError if
+        it can't be made.
+    '''
+    name, _, args = spec.partition(':')
+    if name not in CONDITIONS:
+        raise ValueError("Unknown trigger %s, use one of %s" % (name, ', '.join(sorted(CONDITIONS))))
+    try:
+        return CONDITIONS[name](*[float(a) for a in args.split(',') if a])
+    except TypeError as e:
+        raise ValueError("Bad arguments for trigger %s: %s" % (name, e))
+
+
+class TriggerEvent(object):
+    ''' One capture: samples in A from pre samples before the trigger to
+        the end of the post trigger time. index is the number of the
+        trigger sample in the stream, time its time from the start of it.
+    '''
+    def __init__(self, index, interval, samples, pre):
+        self.index = index
+        self.interval = interval
+        self.samples = samples
+        self.pre = pre
+
+    @property
+    def time(self):
+        return self.index * self.interval
+
+    @property
+    def times(self):
+        ''' Time of every sample relative to the trigger [s] '''
+        return (np.arange(len(self.samples)) - self.pre) * self.interval
+
+
+class TriggerEngine(object):
+    ''' Software trigger over the average sample stream.
+        feed() takes each block of samples: the condition finds where the
+        trigger fires in the whole block at once, and the samples around
+        every trigger are cut from a history ring once the post trigger
+        part has arrived, so nothing is done per sample in Python.
+        Triggers closer than holdoff seconds (pre + post by default) to the
+        previous one are ignored. Events go to the on_event callbacks, from
+        the thread calling feed(), and can be iterated over with events().
+    '''
+    def __init__(self, condition, interval, pre=PRE_TRIGGER, post=POST_TRIGGER, holdoff=None,
+                 max_events=EVENT_QUEUE):
+        self.condition = condition
+        self.pre_time = pre
+        self.post_time = post
+        self.holdoff_time = holdoff
+        self.event_callbacks = []
+        self.events_dropped = 0
+        self._queue = queue.Queue(max_events)
+        self._lock = threading.Lock()
+        self._device = None
+        self.reset(interval)
+
+    def reset(self, interval=None):
+        ''' Forget the stream so far, optionally with a new sample interval '''
+        with self._lock:
+            if interval is not None:
+                self.interval = interval
+            self.pre = int(round(self.pre_time / self.interval))
+            self.post = max(int(round(self.post_time / self.interval)), 1)
+            holdoff = self.holdoff_time if self.holdoff_time is not None else self.pre_time + self.post_time
+            self.holdoff = int(round(holdoff / self.interval))
+            self.condition.bind(self.interval)
+            self.history = RingBuffer(2 * (self.pre + self.post))
+            self.triggers = 0
+            self._next_allowed = 0
+            self._pending = []      # Trigger indices waiting for their post trigger samples
+
+    def on_event(self, callback):
+        ''' callback(event) for every capture '''
+        self.event_callbacks.append(callback)
+
+    def attach(self, device):
+        ''' Feed the engine with the average samples of a PPKDevice, outside the offset calibration '''
+        self._device = device
+        device.on_averages(self._device_averages)
+
+    def detach(self):
+        if self._device is not None:
+            self._device.remove_callback(self._device_averages)
+            self._device = None
+
+    def _device_averages(self, samples):
+        if self._device.calibrating:
+            return
+        if self._device.avg_interval != self.interval:
+            self.reset(self._device.avg_interval)
+        self.feed(samples)
+
+    def feed(self, samples):
+        samples = np.asarray(samples, dtype=np.float64)
+        with self._lock:
+            first = self.history.total
+            fired = self.condition.find(samples, first)
+            if len(fired):
+                self._accept(fired)
+            need = self.pre + self.post + len(samples)
+            if self.history.size < need:
+                self.history.resize(2 * need)
+            self.history.extend(samples)
+            events = self._cut()
+        for event in events:
+            self._deliver(event)
+
+    def _accept(self, fired):
+        # Lock must be held. The holdoff makes this a loop, but over triggers, not samples.
+        fired = fired[fired >= self._next_allowed]
+        if not self.holdoff:
+            accepted = fired.tolist()
+        else:
+            accepted = []
+            for index in fired.tolist():
+                if index >= self._next_allowed:
+                    accepted.append(index)
+                    self._next_allowed = index + self.holdoff
+        if accepted:
+            self._next_allowed = max(self._next_allowed, accepted[-1] + 1)
+        self.triggers += len(accepted)
+        self._pending.extend(accepted)
+
+    def _cut(self):
+        # Lock must be held. Events of the pending triggers with all their samples in.
+        total = self.history.total
+        events = []
+        while self._pending and self._pending[0] + self.post <= total:
+            index = self._pending.pop(0)
+            start = max(index - self.pre, 0, total - self.history.size)
+            end = index + self.post
+            samples = self.history.latest(total - start)[:end - start].copy()
+            events.append(TriggerEvent(index, self.interval, samples, index - start))
+        return events
+
+    def _deliver(self, event):
+        for callback in self.event_callbacks:
+            callback(event)
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.events_dropped += 1
+
+    def events(self, timeout=None):
+        ''' Iterate over the captured events, stops when none comes within timeout seconds '''
+        while True:
+            try:
+                yield self._queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+
+if __name__ == '__main__':
+    # python -m libs.swtrigger, samples per second each condition keeps up with
+    import time
+    interval = 13e-6 * 10
+    t = np.arange(2000000) * interval
+    rs = np.random.RandomState(0)
+    stream = np.where(np.mod(t, 0.01) < 0.001, 5e-3, 10e-6) + rs.normal(0, 1e-6, len(t))
+    block = 1024
+    for name, condition in [('rising', Edge(1e-3)), ('falling', Edge(1e-3, rising=False)),
+                            ('window', Window(0, 100e-6)), ('pulse', PulseWidth(1e-3, 0.0005, 0.002)),
+                            ('above', Above(1e-3, 0.0005))]:
+        engine = TriggerEngine(condition, interval, pre=0.001, post=0.002)
+        start = time.time()
+        for i in range(0, len(stream), block):
+            engine.feed(stream[i:i + block])
+        elapsed = time.time() - start
+        events = list(engine.events(timeout=0))
+        print("%-8s %6.1f M samples/s  %d triggers, first at %.4f s"
+              % (name, len(stream) / elapsed / 1e6, engine.triggers, events[0].time if events else -1))
@@ -8,9 +8,15 @@ try:
     import pyqtgraph as pg
     from pyqtgraph.Qt import QtCore, QtGui
     import numpy as np
-    import struct
     from libs.label import EditableLabel
-    import libs.rtt as rtt
+    from libs.pyramid import MinMaxPyramid
+    from libs.stats import PrefixSumRingBuffer, StatsRingBuffer
+    from libs.render import RenderScheduler
+    from libs.device import PPKDevice, SAMPLE_INTERVAL
+    from libs.rtt import CommandError
+    from libs.recording import Recorder
+    from libs.session import SessionEngine
+    from libs.metrics import REGISTRY, MetricsExporter
     import sys
     import platform
     # Check for python version error
@@ -35,24 +41,6 @@ GLOBAL_OFFSET = 0.0e-6
 str_uA = u'[\u03bcA]'
 str_delta = u'\u0394'
 
-SAMPLE_INTERVAL = 13.0e-6
-ADC_REF = 0.6
-ADC_GAIN = 4.0
-ADC_MAX = 8192.0
-
-MEAS_RANGE_NONE = 0
-MEAS_RANGE_LO = 1
-MEAS_RANGE_MID = 2
-MEAS_RANGE_HI = 3
-MEAS_RANGE_INVALID = 4
-
-MEAS_RANGE_POS = 14
-MEAS_RANGE_MSK = (3 << 14)
-
-MEAS_ADC_POS = 0
-MEAS_ADC_MSK = 0x3FFF
-
-
 def rms_flat(a):
     """
     Return the root mean square of all the elements of *a*, flattened out.
@@ -61,26 +49,6 @@ def rms_flat(a):
     return np.sqrt(np.mean(np.absolute(a)**2))
 
 
-class RTT_COMMANDS():
-    RTT_CMD_TRIGGER_SET         = 0x01  # following trigger of type int16
-    RTT_CMD_AVG_NUM_SET         = 0x02  # Number of samples x16 to average over
-    RTT_CMD_TRIG_WINDOW_SET     = 0x03  # following window of type unt16
-    RTT_CMD_TRIG_INTERVAL_SET   = 0x04  #
-    RTT_CMD_SINGLE_TRIG         = 0x05
-    RTT_CMD_RUN                 = 0x06
-    RTT_CMD_STOP                = 0x07
-    RTT_CMD_RANGE_SET           = 0x08
-    RTT_CMD_LCD_SET             = 0x09
-    RTT_CMD_TRIG_STOP           = 0x0A
-    RTT_CMD_CALIBRATE_OFFSET    = 0x0B
-    RTT_CMD_DUT                 = 0x0C
-    RTT_CMD_SETVDD              = 0x0D
-    RTT_CMD_SETVREFLO           = 0x0E
-    RTT_CMD_SETVREFHI           = 0x0F
-    RTT_CMD_TOGGLE_EXT_TRIG     = 0x11
-    RTT_CMD_SET_RES_USER        = 0x12
-
-
 class PlotData():
     ''' Global variables for data plots goes here, accessed by PlotData.var, not instanced '''
     trigger = 2500
@@ -99,12 +67,10 @@ class PlotData():
     trig_bufsize = int(trig_timewindow / trig_interval)
 
     avg_x = np.linspace(0.0, avg_timewindow, avg_bufsize)
-    avg_y = np.zeros(avg_bufsize, dtype=np.float)
+    avg_y = StatsRingBuffer(avg_bufsize)     # Keeps max/min/avg/rms up to date
+    avg_pyramid = MinMaxPyramid(avg_y)
     trig_x = np.linspace(0.0, trig_timewindow, trig_bufsize)
-    trig_y = np.zeros(trig_bufsize, dtype=np.float)
-
-    trigger_high = trigger >> 8
-    trigger_low = trigger & 0xFF
+    trig_y = PrefixSumRingBuffer(trig_bufsize)
 
     vref_hi = 0
     vref_lo = 0
@@ -117,6 +83,12 @@ class PlotData():
 '''
 
 avg_timeout = 200
+message_timeout = 5000  # How long a failed command is shown in the status bar [ms]
+render_fps = 30     # Highest rate the graphs are redrawn at
+decode_process = False  # Deframe and decode in a separate process, keeps the GUI responsive at high rates
+metrics_file = None     # JSON snapshot of the metrics, rewritten every second
+metrics_port = None     # Prometheus text format at http://127.0.0.1:port/metrics
+status_time = REGISTRY.histogram('gui_status_seconds', "Time to update the status labels")
 
 class ShowInfoWindow(QtCore.QThread):
     show_calib_signal = QtCore.Signal(str, str)
@@ -146,25 +118,17 @@ class CloseInfoWindow(QtCore.QThread):
         self.close_calib_signal.emit()
 
 
-startmeastime = time.time()
-measurestate = 0
-datafilename = "measure_data.txt"
-
-def logdata(msg):
-	"""Log our data to text file"""
-	dataf = open(datafilename,'at')
-	try: 
-		dataf.write(msg)
-	finally:
-		dataf.close()
+session_log = "measure_data.txt"             # A line for every ended DUT on/off session
+session_checkpoint = "measure_session.json"   # Totals so far, rewritten every minute
 
 
 
 class SettingsWindow(QtCore.QObject):
     def __init__(self, plot_data, plot_window):
         QtCore.QObject.__init__(self)
-        self.rtt = None
-        self.rtt_handler = None
+        self.device = None
+        self.sessions = None
+        self.recorder = None
         self.curs_avg_enabled = True
         self.curs_trig_enabled = True
         self.external_trig_enabled = False
@@ -209,31 +173,6 @@ class SettingsWindow(QtCore.QObject):
         print("Power Profiler Kit started, initializing...")
 
 
-    def write_new_res(self, r1, r2, r3):
-        r1_list = []
-        r2_list = []
-        r3_list = []
-
-        # Pack the floats
-        bufr1 = struct.pack('f', r1)
-        bufr2 = struct.pack('f', r2)
-        bufr3 = struct.pack('f', r3)
-
-        # PPK receives byte packages, put them in a list
-        for b in bufr1:
-            r1_list.append(b)
-        for b in bufr2:
-            r2_list.append(b)
-        for b in bufr3:
-            r3_list.append(b)
-
-        # Write the floats to PPK
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_SET_RES_USER,
-                                ord(r1_list[0]), ord(r1_list[1]), ord(r1_list[2]), ord(r1_list[3]),
-                                ord(r2_list[0]), ord(r2_list[1]), ord(r2_list[2]), ord(r2_list[3]),
-                                ord(r3_list[0]), ord(r3_list[1]), ord(r3_list[2]), ord(r3_list[3])
-                                ])
-
     def destroyedEvent(self):
         try:
             QtGui.QApplication.quit()
@@ -247,8 +186,9 @@ class SettingsWindow(QtCore.QObject):
         image_label.setPixmap(logo)
         return image_label
 
-    def set_rtt_instance(self, rtt):
-        self.rtt = rtt
+    def set_device(self, device, sessions):
+        self.device = device
+        self.sessions = sessions
 
     def average_settings(self):
         top_layout              = QtGui.QHBoxLayout()   # Container and dut switch in same layout
@@ -261,7 +201,7 @@ class SettingsWindow(QtCore.QObject):
         self.avg_window_slider = QtGui.QSlider(QtCore.Qt.Horizontal)
         self.avg_window_slider.setTracking = False
         self.avg_window_slider.setMinimum(1)
-        self.avg_window_slider.setMaximum(200)    # val*100ms, i.e max = 5000ms = 5s
+        self.avg_window_slider.setMaximum(3000)   # val*100ms, i.e max = 300s
         self.avg_window_slider.setValue(20)
         self.avg_window_slider.sliderReleased.connect(self.AverageWindowSliderReleased)
         self.avg_window_slider.valueChanged.connect(self.AverageWindowSliderMoved)
@@ -288,6 +228,12 @@ class SettingsWindow(QtCore.QObject):
         self.dut_power_button = QtGui.QPushButton('DUT Off')
         self.dut_power_button.clicked.connect(self.DUTPowerButtonPressed)
 
+        self.record_button = QtGui.QPushButton('Start recording')
+        self.record_button.clicked.connect(self.RecordButtonClicked)
+
+        self.session_label = QtGui.QLabel()
+        self.session_label.setFont(QtGui.QFont("Arial", 8))
+
         self.calibration_btn = QtGui.QPushButton('Offset calibration')
         self.calibration_btn.clicked.connect(self.offset_calibration)
 
@@ -302,6 +248,8 @@ class SettingsWindow(QtCore.QObject):
         gb_avg_layout.addLayout(gb_avg_layout_bottom2)
         gb_avg.setLayout(gb_avg_layout)
         dut_button_layout.addWidget(self.dut_power_button)
+        dut_button_layout.addWidget(self.record_button)
+        dut_button_layout.addWidget(self.session_label)
         # If you want to clutter the GUI with an offset button as well, uncomment
         # dut_button_layout.addWidget(self.calibration_btn)
         dut_button_layout.addWidget(gb_avg)
@@ -310,10 +258,7 @@ class SettingsWindow(QtCore.QObject):
         return top_layout
 
     def offset_calibration(self):
-        self.plot_window.global_offset = 0.0
-        # self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_DUT, 0])
-        self.plot_window.calibrating = True
-        self.plot_window.calibrating_done = False
+        self.device.calibrate_offset()
 
     def trigger_settings(self):
         gb_trigger_layout           = QtGui.QVBoxLayout()   # Container
@@ -381,6 +326,8 @@ class SettingsWindow(QtCore.QObject):
         range_drop_down.addItem("Auto")
         range_drop_down.setCurrentIndex(3)
         range_drop_down.currentIndexChanged.connect(self.rangeChanged)
+        self.range_drop_down = range_drop_down
+        self.meas_range = 3
 
         # Set up groupbox with layouts
         gb_range = QtGui.QGroupBox("Range")
@@ -409,6 +356,7 @@ class SettingsWindow(QtCore.QObject):
         self.curs_avg_enabled_checkb.stateChanged.connect(self.curs_avg_en_changed)
         self.curs_avg_rms_label = QtGui.QLabel("RMS: <b>0.00</b> [nA]")
         self.curs_avg_avg_label = QtGui.QLabel("AVG: <b>0.00</b> [nA]")
+        self.curs_avg_charge_label = QtGui.QLabel("Q: <b>0.00</b> [nAh]")
         self.curs_avg_cursx_label = QtGui.QLabel("X1: <b>1.00</b> [s] X2: <b>1.20</b> [s]")
         self.curs_avg_cursy_label = QtGui.QLabel("Y1: <b>0.00</b> [nA] Y2: <b>0.00</b> [nA]")
         self.curs_avg_cursy_label.setFixedWidth(180)
@@ -418,6 +366,7 @@ class SettingsWindow(QtCore.QObject):
         curs_avg_box_text_layout.addWidget(self.curs_avg_rms_label)
 
         curs_avg_box_text_layout.addWidget(self.curs_avg_avg_label)
+        curs_avg_box_text_layout.addWidget(self.curs_avg_charge_label)
         curs_avg_box_text_layout.addWidget(self.curs_avg_cursx_label)
         curs_avg_box_text_layout.addWidget(self.curs_avg_cursy_label)
 
@@ -474,14 +423,30 @@ class SettingsWindow(QtCore.QObject):
         status_font = QtGui.QFont("Arial", 10)
         self.rms_label.setFont(status_font)
         self.rms_label.setText("<b>max:</b> 0.00 <b>min:</b> 0.00 <b>rms:</b> 0.00 <b>avg:</b> 0.00 ")
+        self.render_label = QtGui.QLabel()
+        self.render_label.setFont(QtGui.QFont("Arial", 8))
 
         # Create the statusbar
         statusBar = QtGui.QStatusBar(self.settings_widget)
         statusBar.addPermanentWidget(self.rms_label)
+        statusBar.addWidget(self.render_label)
+        self.status_bar = statusBar
 
         # Return the groupbox object
         return statusBar
 
+    def send(self, command, *args):
+        ''' Call a device command, True if the PPK got it. A failure is shown
+            in the status bar and the caller leaves its widgets as they were.
+        '''
+        try:
+            command(*args)
+            return True
+        except CommandError as e:
+            print(str(e))
+            self.status_bar.showMessage(str(e), message_timeout)
+            return False
+
     def vrefs(self):
         adjustments_layout = QtGui.QVBoxLayout()    # main layout
 
@@ -521,6 +486,8 @@ class SettingsWindow(QtCore.QObject):
         self.vref_on_slider.setValue(40)
         self.vref_on_slider.sliderReleased.connect(self.vref_on_set)
         self.vref_on_slider.valueChanged.connect(self.vref_on_changed)
+        self.vref_on_value = self.vref_on_slider.value()     # As last sent
+        self.vref_off_value = self.vref_off_slider.value()
 
         self.vdd_slider = QtGui.QSlider(QtCore.Qt.Horizontal)
         self.vdd_slider.setMinimum(1850)
@@ -592,7 +559,12 @@ class SettingsWindow(QtCore.QObject):
         return cal_res_gb
 
     def update_cal_res(self):
-        self.write_new_res(float(self.r_lo_tb.text()), float(self.r_mid_tb.text()), float(self.r_high_tb.text()))
+        if not self.send(self.device.set_user_resistors, float(self.r_lo_tb.text()), float(self.r_mid_tb.text()),
+                         float(self.r_high_tb.text())):
+            self.r_lo_tb.setText(str(PlotData.MEAS_RES_LO))
+            self.r_mid_tb.setText(str(PlotData.MEAS_RES_MID))
+            self.r_high_tb.setText(str(PlotData.MEAS_RES_HI))
+            return
         # print(float(self.r_lo_tb.text()), float(self.r_mid_tb.text()), float(self.r_high_tb.text()))
 
         PlotData.MEAS_RES_HI    = float(self.r_high_tb.text())
@@ -600,11 +572,12 @@ class SettingsWindow(QtCore.QObject):
         PlotData.MEAS_RES_LO    = float(self.r_lo_tb.text())
 
     def reset_cal_res(self):
-        self.write_new_res(self.calibrated_res_lo, self.calibrated_res_mid, self.calibrated_res_hi)
+        if not self.send(self.device.set_user_resistors, self.calibrated_res_lo, self.calibrated_res_mid,
+                         self.calibrated_res_hi):
+            return
         self.r_lo_tb.setText(str(self.calibrated_res_lo))
         self.r_mid_tb.setText(str(self.calibrated_res_mid))
         self.r_high_tb.setText(str(self.calibrated_res_hi))
-        self.write_new_res(float(self.r_lo_tb.text()), float(self.r_mid_tb.text()), float(self.r_high_tb.text()))
 
         PlotData.MEAS_RES_HI    = float(self.r_high_tb.text())
         PlotData.MEAS_RES_MID   = float(self.r_mid_tb.text())
@@ -612,85 +585,79 @@ class SettingsWindow(QtCore.QObject):
 
     def calibrate_button_clicked(self):
         pass
-        # self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_CALIBRATE_OFFSET])
 
     def set_trigger(self, trigger):
-        PlotData.trigger_high = trigger >> 8
-        PlotData.trigger_low = trigger & 0xFF
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_TRIGGER_SET, PlotData.trigger_high, PlotData.trigger_low])
+        return self.send(self.device.set_trigger, trigger)
 
     def set_single(self, trigger):
-        PlotData.trigger_high = trigger >> 8
-        PlotData.trigger_low = trigger & 0xFF
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_SINGLE_TRIG, PlotData.trigger_high, PlotData.trigger_low])
+        return self.send(self.device.single_trigger, trigger)
 
     def TriggerStartButtonClicked(self):
         if self.trigger_start_button.text() == 'Start':
             self.TriggerLevelPressedReturn()
-        else:
+        elif self.send(self.device.trigger_stop):
             self.trigger_start_button.setText('Start')
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_TRIG_STOP])
 
     def AvgRunButtonClicked(self):
         if self.avg_run_button.text() == 'Stop':
+            if not self.send(self.device.stop):
+                return
             self.avg_run_button.setText('Start')
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_STOP])
             print("Stopped average graph.")
         elif self.avg_run_button.text() == 'Start':
+            if not self.send(self.device.run):
+                return
             self.avg_run_button.setText('Stop')
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_RUN])
             print("Started average graph.")
 
-	global measure_time
-
+    def RecordButtonClicked(self):
+        if self.recorder is None:
+            self.recorder = Recorder(self.device, time.strftime('capture_%Y%m%d_%H%M%S'))
+            self.recorder.start()
+            self.record_button.setText('Stop recording')
+            print("Recording to %s.*.ppkrec" % self.recorder.base)
+        else:
+            self.recorder.close()
+            self.record_button.setText('Start recording')
+            print("Recording stopped, wrote %s" % ', '.join(self.recorder.paths))
+            if self.recorder.dropped_blocks:
+                print("%d blocks dropped, the disk did not keep up" % self.recorder.dropped_blocks)
+            self.recorder = None
 
     def DUTPowerButtonPressed(self):
-    	global total_avg_consump
-    	global datafilename
-    	global measurestate
-    	global startmeastime
-
+        # The session engine ends the running session when the DUT is switched
         if self.dut_power_button.text() == 'DUT Off':
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_DUT, 0])
+            if not self.send(self.device.dut_power, False):
+                return
             self.dut_power_button.setText("DUT On")
-            self.measure_time = time.time()
-            measurestate = 1
             print("\nTurn OFF")
-            logdata("Turn OFF\n")
-            
-            
         else:
+            if not self.send(self.device.dut_power, True):
+                return
             self.dut_power_button.setText("DUT Off")
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_DUT, 1])
-
-            measurestate = 0
-            print("\nTurn ON\n")
-            logdata("Turn ON\n")
-
-        dt = time.time() - self.measure_time
-        print(self.get_mAh(), "Consumped mAh value", dt, "sec")        
-        self.clean_mAh()    
-        startmeastime = time.time()
-        tmp_time = time.strftime('%H:%M:%S', time.localtime())
-        logdata(tmp_time+'\n')
+            print("\nTurn ON")
+        if self.sessions is not None and self.sessions.sessions:
+            print(self.sessions.sessions[-1].log_line(), end='')
 
 
     def TriggerSingleButtonClicked(self):
+        trigger_level = int(self.triggerlevel_textbox.text())
+        if not self.set_single(trigger_level):
+            return
         self.trigger_start_button.setText('Start')
         self.trigger_start_button.setEnabled(False)
         self.trigger_single_button.setText('Waiting...')
-        trigger_level = int(self.triggerlevel_textbox.text())
-        self.set_single(trigger_level)
         print("Single run with trigger: %d%s" % (trigger_level, 'uA'))
 
     def TriggerLevelPressedReturn(self):
-        self.trigger_start_button.setText("Stop")
         try:
             trigger_level = int(self.triggerlevel_textbox.text())
-            self.set_trigger(trigger_level)
-            print("Triggering at %d%s" % (trigger_level, 'uA'))
-        except:
+        except ValueError:
             print("Invalid trigger value (not an integer)")
+            return
+        if self.set_trigger(trigger_level):
+            self.trigger_start_button.setText("Stop")
+            print("Triggering at %d%s" % (trigger_level, 'uA'))
 
     def show_calib_msg_box(self):
         # Start a threaded procedure to avoid invoking in on main thread
@@ -717,22 +684,26 @@ class SettingsWindow(QtCore.QObject):
 
     def TriggerWindowValueChanged(self):
         # Format the inserted text to float, cast to int and convert to bytes as required later
+        trig_window_val = self.trigger_window_slider.value()
         try:
-            self.trig_window_val = int(float(self.trig_window_label.text().split('ms')[0].replace(' ', '')) / (PlotData.trig_interval * 1000.0) + 1)
-            self.trigger_window_slider.setValue(self.trig_window_val)
+            trig_window_val = int(float(self.trig_window_label.text().split('ms')[0].replace(' ', '')) / (PlotData.trig_interval * 1000.0) + 1)
         except Exception as e:
             print(str(e))
             print(self.trig_window_label.text())
             sys.stdout.flush()
 
+        if not self.send(self.device.set_trigger_window, trig_window_val):
+            # Back to the window the PPK still uses
+            self.trigger_window_slider.setValue(int(round(PlotData.trig_timewindow / PlotData.trig_interval)))
+            self.trig_window_label.setText('%5.2f ms' % ((PlotData.trig_timewindow * 1000)))
+            return
+        self.trig_window_val = trig_window_val
+        self.trigger_window_slider.setValue(self.trig_window_val)
         PlotData.trig_timewindow = PlotData.trig_interval * self.trig_window_val
-        PlotData.trigger_high = self.trig_window_val >> 8
-        PlotData.trigger_low = self.trig_window_val & 0xFF
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_TRIG_WINDOW_SET, PlotData.trigger_high, PlotData.trigger_low])
 
         self.trig_bufsize = int(PlotData.trig_timewindow / PlotData.trig_interval)
         PlotData.trig_x = np.linspace(0.0, PlotData.trig_timewindow, self.trig_bufsize)
-        PlotData.trig_y = np.zeros(self.trig_bufsize, dtype=np.float)
+        PlotData.trig_y.resize(self.trig_bufsize)
 
         self.trig_window_label.setText('%5.2f ms' % ((PlotData.trig_timewindow * 1000)))
         sys.stdout.flush()
@@ -753,9 +724,10 @@ class SettingsWindow(QtCore.QObject):
 
         PlotData.avg_bufsize  = int(PlotData.avg_timewindow / PlotData.avg_interval)
         PlotData.avg_x = np.linspace(0.0, PlotData.avg_timewindow, PlotData.avg_bufsize)
-        PlotData.avg_y = np.zeros(PlotData.avg_bufsize, dtype=np.float)
+        PlotData.avg_y.resize(PlotData.avg_bufsize)  # Keeps the newest samples
 
         self.avg_window_label.setText('%.2f s' % (PlotData.avg_timewindow))
+        self.plot_window.avg_plot.setXRange(0, PlotData.avg_timewindow, padding=0)
         sys.stdout.flush()
 
     def AverageWindowSliderMoved(self, val):
@@ -764,14 +736,20 @@ class SettingsWindow(QtCore.QObject):
 
     def AverageIntervalSliderReleased(self):
         avg_samples_val = int(self.avg_sample_num_label.text())
-        samples_high = (avg_samples_val / 10) >> 8
-        samples_low  = (avg_samples_val / 10) & 0xFF
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_AVG_NUM_SET, samples_high, samples_low])
+        if not self.send(self.device.set_average_samples, avg_samples_val):
+            # Moving the slider back would send the command again
+            self.avg_interval_slider.blockSignals(True)
+            self.avg_interval_slider.setValue(self.device.avg_samples // 10)
+            self.avg_interval_slider.blockSignals(False)
+            self.avg_sample_num_label.setText('%d' % self.device.avg_samples)
+            return
 
         PlotData.avg_interval   = PlotData.sample_interval * avg_samples_val
         PlotData.avg_bufsize  = int(PlotData.avg_timewindow / PlotData.avg_interval)
         PlotData.avg_x = np.linspace(0.0, PlotData.avg_timewindow, PlotData.avg_bufsize)
-        PlotData.avg_y = np.zeros(PlotData.avg_bufsize, dtype=np.float)
+        # Old samples were taken with another interval, don't mix them in
+        PlotData.avg_y.resize(PlotData.avg_bufsize)
+        PlotData.avg_y.clear()
 
     def AverageIntervalSliderMoved(self, val):
         self.avg_sample_num_label.setText('%d' % (val * 10))
@@ -792,36 +770,41 @@ class SettingsWindow(QtCore.QObject):
             self.plot_window.trig_region.hide()
 
     def external_trig_changed(self, state):
+        if (bool(state) and not self.send(self.device.trigger_stop)) or \
+                not self.send(self.device.toggle_external_trigger):
+            self.enable_ext_trigg_chkb.blockSignals(True)
+            self.enable_ext_trigg_chkb.setChecked(self.external_trig_enabled)
+            self.enable_ext_trigg_chkb.blockSignals(False)
+            return
         self.external_trig_enabled = bool(state)
         self.trigger_start_button.setText('Start')
         if self.external_trig_enabled:
             self.triggerlevel_textbox.setEnabled(False)
             self.trigger_start_button.setEnabled(False)
             self.trigger_single_button.setEnabled(False)
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_TRIG_STOP])
         else:
             self.trigger_single_button.setEnabled(True)
             self.trigger_start_button.setEnabled(True)
             self.triggerlevel_textbox.setEnabled(True)
 
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_TOGGLE_EXT_TRIG])
-
     def rangeChanged(self, val):
-        if self.rtt is None:
+        if self.device is None:
             return
 
+        if not self.send(self.device.set_range, val):
+            self.range_drop_down.blockSignals(True)
+            self.range_drop_down.setCurrentIndex(self.meas_range)
+            self.range_drop_down.blockSignals(False)
+            return
+        self.meas_range = val
         if val == 0:
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_RANGE_SET, 0])
             print("10uA range")
         elif val == 1:
             print("1mA range")
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_RANGE_SET, 1])
         elif val == 2:
             print("100mA range")
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_RANGE_SET, 2])
         elif val == 3:
             print("Auto range")
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_RANGE_SET, 3])
 
         sys.stdout.flush()
 
@@ -835,6 +818,8 @@ class SettingsWindow(QtCore.QObject):
         if((ival >= 0) and (jval >= 0)):
             self.curs_avg_cursx_label.setText("X1: <b>%.2f</b> %s X2: <b>%.2f</b> %s" % (ival, iunit, jval, junit))
             self.curs_avg_delta_label.setText("Cursor %s: <b>%.2f</b> %s" % (str_delta, deltaval, deltaunit))
+        # Cheap enough to follow the cursors while they are dragged
+        self.update_avg_cursor_stats()
 
     def trig_region_changed(self):
         i = self.plot_window.trig_region.getRegion()[0]
@@ -846,36 +831,17 @@ class SettingsWindow(QtCore.QObject):
         if((ival >= 0) and (jval >= 0)):
             self.curs_trig_cursx_label.setText("X1: <b>%.2f</b> %s X2: <b>%.2f</b> %s" % (ival, iunit, jval, junit))
             self.curs_trig_delta_label.setText("Cursor %s: <b>%.2f</b> %s" % (str_delta, deltaval, deltaunit))
+        self.update_trig_cursor_stats()
 
     def vdd_changed(self):
         ''' Update label, but don't transfer command '''
         self.vdd_label.setText(str(self.vdd_slider.value()) + "mV")
 
     def vdd_set(self):
-
-        target_vdd = self.vdd_slider.value()
-
-        steps = abs(target_vdd - self.m_vdd)
-
-        if (steps > 350):
-            if (target_vdd > self.m_vdd):
-                for step in range(steps / 100):
-                    new_step = target_vdd - (steps - step * 100)
-                    vdd_high_byte = new_step >> 8
-                    vdd_low_byte = new_step & 0xFF
-                    self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_SETVDD, vdd_high_byte, vdd_low_byte])
-            elif (target_vdd < self.m_vdd):
-                for step in range(steps / 100):
-                    new_step = self.m_vdd - step * 100
-                    vdd_high_byte = new_step >> 8
-                    vdd_low_byte = new_step & 0xFF
-                    self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_SETVDD, vdd_high_byte, vdd_low_byte])
-        else:
-            vdd_high_byte = self.vdd_slider.value() >> 8
-            vdd_low_byte = self.vdd_slider.value() & 0xFF
-            self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_SETVDD, vdd_high_byte, vdd_low_byte])
-            # print("send %d" % self.vdd_slider.value())
-        self.m_vdd = target_vdd
+        if not self.send(self.device.set_vdd, self.vdd_slider.value()):
+            self.vdd_slider.setValue(self.m_vdd)
+            return
+        self.m_vdd = self.device.vdd
 
     def vref_on_changed(self):
         # print "vref_on_slider_value %f.2" % (self.vref_on_slider.value())
@@ -887,14 +853,10 @@ class SettingsWindow(QtCore.QObject):
         self.vref_off_changed()
 
     def vref_on_set(self):
-        pot = 27000.0 * ((10.98194 * self.vref_on_slider.value() / 1000) / 0.41 - 1)
-        # print(self.vref_on_slider.value())
-        # print(pot)
-
-        vref_on_msb = int(pot / 2) >> 8
-        vref_on_lsb = int(pot / 2) & 0xFF
-
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_SETVREFHI, vref_on_msb, vref_on_lsb])
+        if self.send(self.device.set_vref_hi, self.vref_on_slider.value()):
+            self.vref_on_value = self.vref_on_slider.value()
+        else:
+            self.vref_on_slider.setValue(self.vref_on_value)
 
     def vref_off_changed(self):
         hysteresis = (self.vref_off_slider.value() / 100.0)
@@ -907,14 +869,10 @@ class SettingsWindow(QtCore.QObject):
         self.vref_off_label_2.setText(str("LO: %.2fuA" % (i_sw_off_2)))
 
     def vref_off_set(self):
-        pot = 2000.0 * (16.3 * self.vref_off_slider.value() / 100.0 - 1) - 30000.0
-        vref_off_msb = int(pot / 2) >> 8
-        vref_off_lsb = int(pot / 2) & 0xFF
-
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_SETVREFLO, vref_off_msb, vref_off_lsb])
-
-        # print("Sent vref lo pot: " + str(pot))
-        # print("Sent vref lo: " + str(self.vref_off_slider.value()))
+        if self.send(self.device.set_vref_lo, self.vref_off_slider.value()):
+            self.vref_off_value = self.vref_off_slider.value()
+        else:
+            self.vref_off_slider.setValue(self.vref_off_value)
 
     def sec_unit_determine(self, timestamp):
         val = 0
@@ -957,46 +915,15 @@ class SettingsWindow(QtCore.QObject):
 
         return val, unit
 
-    total_avg_consump = 0       
-    avg_iteration_numb = 0
-
-    def get_mAh(self):
-    	""" Return consumped mAh value """
-    	global avg_timeout
-    	result = self.total_avg_consump*avg_timeout/1e+3/3600
-    	return result
-
-    def clean_mAh(self):
-    	""" Clean consumped mAh value"""
-    	self.total_avg_consump = 0
-    	self.avg_iteration_numb = 0	
-
-
     def update_status(self):
+        start = time.time()
+        _max, _min, _avg, _rms = PlotData.avg_y.stats()
 
-    	global measurestate
-    	global startmeastime
-
-        _max = max(PlotData.avg_y)
-        _min = min(PlotData.avg_y)
-        _rms = rms_flat(PlotData.avg_y)
-        _avg = np.average(PlotData.avg_y)
-
-        # print(_avg,    _min,    _max )
-        self.total_avg_consump += _avg
-        self.avg_iteration_numb += 1
-        mAh = self.get_mAh()
-
-        if self.avg_iteration_numb % 10 == 1:
-            #tmp_time = time.strftime('%H:%M:%S', time.localtime())
-            dt = time.time()-startmeastime
-            #print(mAh, "mAh", dt, " sec ", mAh*3600/self.avg_iteration_numb/avg_timeout*1e+6," ", mAh*3600/dt*1e+6, " avg_cur", end='\t\r')
-            calc_mA_current = mAh*3600/self.avg_iteration_numb/avg_timeout*1e+6
-            print("mAh=", mAh, " sec=", dt, " calc_mA=" , calc_mA_current, end='\r')
-            if measurestate:
-            	logmsg = str(mAh) + "  mAh   " + str(dt) + " sec\n" 
-            	logdata(logmsg)
-        
+        if self.sessions is not None:
+            summary = self.sessions.summary()
+            self.session_label.setText("DUT %s %d s: <b>%.4f</b> mAh <b>%.4f</b> mWh avg <b>%.3f</b> mA"
+                                       % ('on' if summary['dut_on'] else 'off', summary['elapsed'],
+                                          summary['mAh'], summary['mWh'], summary['current'] * 1e3))
 
         max_val, max_unit = self.unit_determine(_max)
         min_val, min_unit = self.unit_determine(_min)
@@ -1007,60 +934,76 @@ class SettingsWindow(QtCore.QObject):
         self.rms_label.setFont(status_font)
         self.rms_label.setText("max: <b>%.2f</b> %s min: <b>%.2f</b> %s rms: <b>%.2f</b> %s avg: <b>%.2f</b> %s"
                                % (max_val, max_unit, min_val, min_unit, rms_val, rms_unit, avg_val, avg_unit))
-        self.plot_window.trig_curve.setData(PlotData.trig_x, PlotData.trig_y)
 
-        if self.curs_avg_enabled:
-            samples_per_us = len(PlotData.avg_x) / PlotData.avg_timewindow  # us
-            curs1, curs2 = self.plot_window.avg_region.getRegion()
-            byte_position_curs1 = int(samples_per_us * curs1)
-            byte_position_curs2 = int(samples_per_us * curs2)
-
-            try:
-                if((byte_position_curs1 < 0) or (byte_position_curs2 < 0)):
-                    raise
-                curs_rms_val, curs_rms_unit = self.unit_determine(rms_flat(PlotData.avg_y[byte_position_curs1:byte_position_curs2]))
-                self.curs_avg_rms_label.setText("RMS: <b>%.2f</b> %s" % (curs_rms_val, curs_rms_unit))
-                curs_avg_val, curs_avg_unit = self.unit_determine(np.average(PlotData.avg_y[byte_position_curs1:byte_position_curs2]))
-                self.curs_avg_avg_label.setText("AVG: <b>%.2f</b> %s" % (curs_avg_val, curs_avg_unit))
-                curs1_y_val, curs1_y_unit = self.unit_determine(PlotData.avg_y[byte_position_curs1])
-                curs2_y_val, curs2_y_unit = self.unit_determine(PlotData.avg_y[byte_position_curs2])
-                self.curs_avg_cursy_label.setText("Y1: <b>%5.2f</b> %s Y2: <b>%5.2f</b> %s" % (curs1_y_val, curs1_y_unit, curs2_y_val, curs2_y_unit))
-            except:
-                self.curs_avg_rms_label.setText("RMS: <b>N/A (out of bounds)</b>")
-                self.curs_avg_avg_label.setText("AVG: <b>N/A (out of bounds)</b>")
+        render = self.plot_window.render
+        if render.cpu_load is None:
+            self.render_label.setText("GUI: %.0f fps" % render.frame_rate)
+        else:
+            self.render_label.setText("GUI: %.0f fps %.0f%% CPU" % (render.frame_rate, render.cpu_load * 100))
 
+        if self.curs_avg_enabled:
+            self.update_avg_cursor_stats()
         if self.curs_trig_enabled:
-            samples_per_us = len(PlotData.trig_x) / PlotData.trig_timewindow  # us
-            curs1, curs2 = self.plot_window.trig_region.getRegion()
-            byte_position_curs1 = int(samples_per_us * curs1)
-            byte_position_curs2 = int(samples_per_us * curs2)
+            self.update_trig_cursor_stats()
+        status_time.observe(time.time() - start)
+        sys.stdout.flush()
 
-            try:
-                if((byte_position_curs1 < 0) or (byte_position_curs2 < 0)):
-                    raise
+    def update_avg_cursor_stats(self):
+        # RMS and average between the cursors come from the running sums of avg_y
+        avg_y = PlotData.avg_y
+        samples_per_us = len(PlotData.avg_x) / PlotData.avg_timewindow  # us
+        curs1, curs2 = self.plot_window.avg_region.getRegion()
+        byte_position_curs1 = int(samples_per_us * curs1)
+        byte_position_curs2 = int(samples_per_us * curs2)
 
-                curs1_y_val, curs1_y_unit = self.unit_determine(PlotData.trig_y[byte_position_curs1])
-                curs2_y_val, curs2_y_unit = self.unit_determine(PlotData.trig_y[byte_position_curs2])
+        try:
+            if((byte_position_curs1 < 0) or (byte_position_curs2 < 0)):
+                raise
+            curs_avg, curs_rms, curs_sum = avg_y.region(byte_position_curs1, byte_position_curs2)
+            curs_rms_val, curs_rms_unit = self.unit_determine(curs_rms)
+            self.curs_avg_rms_label.setText("RMS: <b>%.2f</b> %s" % (curs_rms_val, curs_rms_unit))
+            curs_avg_val, curs_avg_unit = self.unit_determine(curs_avg)
+            self.curs_avg_avg_label.setText("AVG: <b>%.2f</b> %s" % (curs_avg_val, curs_avg_unit))
+            # Charge between the cursors, in Ah scaled like a current
+            curs_q_val, curs_q_unit = self.unit_determine(curs_sum * PlotData.avg_interval / 3600)
+            self.curs_avg_charge_label.setText("Q: <b>%.2f</b> %s" % (curs_q_val, curs_q_unit.replace('A', 'Ah')))
+            curs1_y_val, curs1_y_unit = self.unit_determine(avg_y[byte_position_curs1])
+            curs2_y_val, curs2_y_unit = self.unit_determine(avg_y[byte_position_curs2])
+            self.curs_avg_cursy_label.setText("Y1: <b>%5.2f</b> %s Y2: <b>%5.2f</b> %s" % (curs1_y_val, curs1_y_unit, curs2_y_val, curs2_y_unit))
+        except:
+            self.curs_avg_rms_label.setText("RMS: <b>N/A (out of bounds)</b>")
+            self.curs_avg_avg_label.setText("AVG: <b>N/A (out of bounds)</b>")
+            self.curs_avg_charge_label.setText("Q: <b>N/A (out of bounds)</b>")
 
-                curs_rms_val, curs_rms_unit = self.unit_determine(rms_flat(PlotData.trig_y[byte_position_curs1:byte_position_curs2]))
-                curs_avg_val, curs_avg_unit = self.unit_determine(np.average(PlotData.trig_y[byte_position_curs1:byte_position_curs2]))
+    def update_trig_cursor_stats(self):
+        trig_y = PlotData.trig_y
+        samples_per_us = len(PlotData.trig_x) / PlotData.trig_timewindow  # us
+        curs1, curs2 = self.plot_window.trig_region.getRegion()
+        byte_position_curs1 = int(samples_per_us * curs1)
+        byte_position_curs2 = int(samples_per_us * curs2)
 
-                self.curs_trig_rms_label.setText("RMS: <b>%.2f</b> %s" % (curs_rms_val, curs_rms_unit))
-                self.curs_trig_avg_label.setText("AVG: <b>%.2f</b> %s" % (curs_avg_val, curs_avg_unit))
-                self.curs_trig_cursy_label.setText("Y1: <b>%.2f</b> %s Y2: <b>%.2f</b> %s" % (curs1_y_val, curs1_y_unit, curs2_y_val, curs2_y_unit))
-            except:
-                self.curs_trig_rms_label.setText("RMS: <b>N/A (out of bounds)</b>")
-                self.curs_trig_avg_label.setText("AVG: <b>N/A (out of bounds)</b>")
+        try:
+            if((byte_position_curs1 < 0) or (byte_position_curs2 < 0)):
+                raise
 
-        self.plot_window.trig_curve.setData(PlotData.trig_x, PlotData.trig_y)
+            curs1_y_val, curs1_y_unit = self.unit_determine(trig_y[byte_position_curs1])
+            curs2_y_val, curs2_y_unit = self.unit_determine(trig_y[byte_position_curs2])
+
+            curs_avg, curs_rms, curs_sum = trig_y.region(byte_position_curs1, byte_position_curs2)
+            curs_rms_val, curs_rms_unit = self.unit_determine(curs_rms)
+            curs_avg_val, curs_avg_unit = self.unit_determine(curs_avg)
+
+            self.curs_trig_rms_label.setText("RMS: <b>%.2f</b> %s" % (curs_rms_val, curs_rms_unit))
+            self.curs_trig_avg_label.setText("AVG: <b>%.2f</b> %s" % (curs_avg_val, curs_avg_unit))
+            self.curs_trig_cursy_label.setText("Y1: <b>%.2f</b> %s Y2: <b>%.2f</b> %s" % (curs1_y_val, curs1_y_unit, curs2_y_val, curs2_y_unit))
+        except:
+            self.curs_trig_rms_label.setText("RMS: <b>N/A (out of bounds)</b>")
+            self.curs_trig_avg_label.setText("AVG: <b>N/A (out of bounds)</b>")
 
 
 class pms_plotter():
     def __init__(self):
         # This app instance must be constructed before all other elements are added
-        self.calibrating = False
-        self.calibrating_done = False
-        self.global_offset = 0.0
         self.setup_measurement_regions()
         pg.setConfigOption('background', 'k')  # Set white background
         self.gw = pg.GraphicsWindow()
@@ -1080,12 +1023,17 @@ class pms_plotter():
         self.avg_region.sigRegionChanged.connect(self.settings.avg_region_changed)
         self.trig_region.sigRegionChanged.connect(self.settings.trig_region_changed)
 
+        self.device = PPKDevice(offload=decode_process)
+        self.device.on_averages(self.average_handler)
+        self.device.on_trigger(self.trigger_handler)
+        self.device.on_calibration(self.calibration_handler)
         try:
-            self.rtt = rtt.rtt(self.rtt_handler)
+            self.device.connect()
         except:
             print("Unable to connect to the PPK, check debugger connection and make sure pynrfjprog is up to date.")
             exit()
-        self.settings.set_rtt_instance(self.rtt)
+        self.sessions = SessionEngine(self.device, checkpoint=session_checkpoint, log=session_log)
+        self.settings.set_device(self.device, self.sessions)
         self.setup_plot_window()
 
     def edit_colors(self):
@@ -1145,13 +1093,17 @@ class pms_plotter():
         self.avg_plot.addItem(self.avg_region, ignoreBounds=True)
         trig_plot.addItem(self.trig_region, ignoreBounds=True)
         # Create the curve for average data (top graph)
-        self.avg_curve = self.avg_plot.plot(PlotData.avg_x, PlotData.avg_y)
+        self.avg_curve = self.avg_plot.plot()
+        # The curve only holds the visible part, so the x range can't follow the data
+        self.avg_plot.setXRange(0, PlotData.avg_timewindow, padding=0)
+        self.avg_plot.sigXRangeChanged.connect(self.avg_range_changed)
         # Create the curve for trigger data (bottom graph)
-        self.trig_curve = trig_plot.plot(PlotData.trig_x, PlotData.trig_y)
+        self.trig_curve = trig_plot.plot(PlotData.trig_x, PlotData.trig_y.view())
 
-        # Bools for checking if we should update the curve when the update timer triggers
-        self.update_trig_curve = False
-        self.update_avg_curve = False
+        # Redraws the curves marked dirty, at most render_fps times a second
+        self.render = RenderScheduler(render_fps, self.plot_visible)
+        self.render.add('trig', self.redraw_trig)
+        self.render.add('avg', self.redraw_avg)
 
     def start(self, run=True):
         ''' Send trigger value and start to firmware.
@@ -1161,147 +1113,92 @@ class pms_plotter():
 
         # First we need to read out the calibrated measurmement R-values
         try:
-            data = self.rtt.nrfjprog.rtt_read(0, 200)
-            prod_data = data.split("USER SET ")[0]
-            PlotData.MEAS_RES_LO  = float(prod_data.split("R1:")[1].split(" R2")[0])
-            PlotData.MEAS_RES_MID = float(prod_data.split("R2:")[1].split(" R3")[0])
-            PlotData.MEAS_RES_HI = float(prod_data.split("R3:")[1].split("Board ID ")[0])
-            self.settings.board_id = str(prod_data.split("Board ID ")[1])
-            print("Board ID: " + self.settings.board_id)
-            self.settings.calibrated_res_lo = PlotData.MEAS_RES_LO
-            self.settings.calibrated_res_mid = PlotData.MEAS_RES_MID
-            self.settings.calibrated_res_hi = PlotData.MEAS_RES_HI
-        except:
-            print("Initialization failed, could not read calibration values.")
-            exit()
-
-        if('USER SET' in data):
-            user_data = data.split("USER SET ")[1].split("Refs")[0]
-            PlotData.MEAS_RES_LO  = float(user_data.split("R1:")[1].split(" R2")[0])
-            PlotData.MEAS_RES_MID = float(user_data.split("R2:")[1].split(" R3")[0])
-            PlotData.MEAS_RES_HI = float(user_data.split("R3:")[1].split("Board ID ")[0])
-
-        try:
-            refs_data = data.split("Refs ")[1]
-        except:
-            print("Corrupted data received from PPK, please reflash the PPK.")
+            self.device.start()
+        except ValueError as e:
+            print(str(e))
             exit()
-        PlotData.vref_hi = refs_data.split("HI: ")[1].split(" LO")[0]
-        PlotData.vref_lo = refs_data.split("LO: ")[1]
-        PlotData.vdd     = refs_data.split("VDD: ")[1].split(" HI")[0]
-        self.settings.m_vdd = int(PlotData.vdd)
-
-        self.settings.vdd_slider.setSliderPosition(int(PlotData.vdd))
-        self.settings.vref_on_slider.setSliderPosition(int(((int(PlotData.vref_hi) * 2 / 27000.0) + 1) * (0.41 / 10.98194) * 1000))
-        self.settings.vref_off_slider.setSliderPosition((((int(PlotData.vref_lo) * 2 + 30000) / 2000.0 + 1) / 16.3) * 100)
+        calibration = self.device.calibration
+
+        PlotData.MEAS_RES_LO  = calibration.res_lo
+        PlotData.MEAS_RES_MID = calibration.res_mid
+        PlotData.MEAS_RES_HI  = calibration.res_hi
+        self.settings.board_id = calibration.board_id
+        print("Board ID: " + self.settings.board_id)
+        self.settings.calibrated_res_lo  = calibration.calibrated_res_lo
+        self.settings.calibrated_res_mid = calibration.calibrated_res_mid
+        self.settings.calibrated_res_hi  = calibration.calibrated_res_hi
+
+        PlotData.vref_hi = calibration.vref_hi
+        PlotData.vref_lo = calibration.vref_lo
+        PlotData.vdd     = calibration.vdd
+        self.settings.m_vdd = PlotData.vdd
+
+        self.settings.vdd_slider.setSliderPosition(PlotData.vdd)
+        self.settings.vref_on_slider.setSliderPosition(int(((PlotData.vref_hi * 2 / 27000.0) + 1) * (0.41 / 10.98194) * 1000))
+        self.settings.vref_off_slider.setSliderPosition((((PlotData.vref_lo * 2 + 30000) / 2000.0 + 1) / 16.3) * 100)
+        self.settings.vref_on_value = self.settings.vref_on_slider.value()
+        self.settings.vref_off_value = self.settings.vref_off_slider.value()
 
         self.settings.r_high_tb.setText(str(PlotData.MEAS_RES_HI))
         self.settings.r_mid_tb.setText(str(PlotData.MEAS_RES_MID))
         self.settings.r_lo_tb.setText(str(PlotData.MEAS_RES_LO))
 
-        self.rtt.start()
         # Trigger trigger window update, since production firmware uses wrong window value
         self.settings.TriggerWindowValueChanged()
         # Write the initial trigger value, set in PlotData
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_TRIGGER_SET, PlotData.trigger_high, PlotData.trigger_low])
-        # Timer to update graphs, continous shot
-        self.calibrating = True
+        self.device.set_trigger(PlotData.trigger)
+        self.device.calibrate_offset()
 
+        # Timer to update graphs, continous shot
         timer = pg.QtCore.QTimer(self.gw)
-        timer.timeout.connect(self.update)
-        timer.start(1)  # 1ms
+        timer.timeout.connect(self.render.tick)
+        timer.start(self.render.interval_ms)
         # Timer to update rms value
         timer_rms = pg.QtCore.QTimer(self.gw)
         timer_rms.timeout.connect(self.settings.update_status)
         timer_rms.start(avg_timeout)  # 1s
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_RUN])
-        self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_AVG_NUM_SET, 0x00, 1])
-
-    def rtt_handler(self, data):
-        ''' All measurments arrive here. 4 bytes for avg window, 16 bytes for trigger window '''
-
-        if(not self.calibrating_done):
-            if not hasattr(self, "calibration_counter"):
-                self.calibration_counter = 10000  # it doesn't exist yet, so initialize it
-                self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_DUT, 0])
-                self.settings.show_calib_msg_box()
-
-            if(self.calibrating):
-                if(self.calibration_counter != 0):
-                    self.calibration_counter = self.calibration_counter - 1
-                    if (len(data) == 4):
-
-                        s = ''.join([chr(b) for b in data])
-                        f = struct.unpack('f', s)[0]        # Get the uA value
-
-                        PlotData.avg_y[:-1] = PlotData.avg_y[1:]  # shift data in the array one sample left
-                        PlotData.avg_y[-1] = f / 1e6
-
-                        self.update_avg_curve = True
-
-                else:
-                    # Got all the samples
-                    self.calibrating = False
-            else:
-                self.calibrating_done = True
-                self.settings.close_calib_msg_box()
-                self.global_offset = np.average(PlotData.avg_y[1000:8000])
-                self.rtt.write_stuffed([RTT_COMMANDS.RTT_CMD_DUT, 1])
-                del self.calibration_counter
-                PlotData.avg_y = np.zeros(PlotData.avg_bufsize, dtype=np.float)
-
-        if (len(data) == 4):
-
-            s = ''.join([chr(b) for b in data])
-            f = struct.unpack('f', s)[0]
-            PlotData.avg_y[:-1] = PlotData.avg_y[1:]  # shift data in the array one sample left
-            PlotData.avg_y[-1] = f / 1e6 - self.global_offset
-            #print(data[0])
-
-            self.update_avg_curve = True
-        else:  # Trigger data received
-            for i in range(0, len(data), 2):
-                if (i + 1) < len(data):
-                    tmp = np.uint16((data[i + 1] << 8) + data[i])
-                    PlotData.current_meas_range = (tmp & MEAS_RANGE_MSK) >> MEAS_RANGE_POS
-                    adc_val = (tmp & MEAS_ADC_MSK) >> MEAS_ADC_POS
-                    sample_A = 0.0
-
-                    if PlotData.current_meas_range == MEAS_RANGE_LO:
-                        sample_A = adc_val * (ADC_REF / (ADC_GAIN * ADC_MAX * PlotData.MEAS_RES_LO))
-                        sample_A = sample_A - self.global_offset
-
-                    elif PlotData.current_meas_range == MEAS_RANGE_MID:
-                        sample_A = adc_val * (ADC_REF / (ADC_GAIN * ADC_MAX * PlotData.MEAS_RES_MID))
-                    elif PlotData.current_meas_range == MEAS_RANGE_HI:
-                        sample_A = adc_val * (ADC_REF / (ADC_GAIN * ADC_MAX * PlotData.MEAS_RES_HI))
-                    elif PlotData.current_meas_range == MEAS_RANGE_INVALID:
-                        print("Range INVALID")
-                    elif PlotData.current_meas_range == MEAS_RANGE_NONE:
-                        print("Range not detected")
-
-                    PlotData.trig_y[:-1] = PlotData.trig_y[1:]  # shift data in the array one sample left
-                    # PlotData.trig_y[-1] = sample_A
-
-                    # if(sample_A < 50e-6):
-                    #     PlotData.trig_y[-1] = (0.9587*sample_A + 1.4395)/1e6 # We get the result in uA
-                    # else:
-                    PlotData.trig_y[-1] = sample_A
-            self.update_trig_curve = True
+        with self.device.batch():
+            self.device.run()
+            self.device.set_average_samples(10)
+        self.sessions.start()
+
+    def average_handler(self, samples):
+        PlotData.avg_y.extend(samples)
+        self.render.mark_dirty('avg')
+
+    def trigger_handler(self, amps, ranges):
+        if len(amps):
+            PlotData.current_meas_range = int(ranges[-1])
+            PlotData.trig_y.extend(amps)
+        self.render.mark_dirty('trig')
+
+    def calibration_handler(self, done):
+        if done:
+            self.settings.close_calib_msg_box()
+            PlotData.avg_y.clear()
+        else:
+            self.settings.show_calib_msg_box()
 
-    # update plots
-    def update(self):
-        sys.stdout.flush()
-        if self.update_trig_curve:
-            self.settings.trigger_single_button.setText("Single")
-            if (not self.settings.external_trig_enabled):
-                self.settings.trigger_start_button.setEnabled(True)
-            self.trig_curve.setData(PlotData.trig_x, PlotData.trig_y)
-            self.update_trig_curve = False
+    def avg_range_changed(self):
+        self.render.mark_dirty('avg')
+
+    def plot_visible(self):
+        return self.gw.isVisible() and not self.gw.isMinimized()
 
-        if self.update_avg_curve:
-            self.avg_curve.setData(PlotData.avg_x, PlotData.avg_y)
-            self.update_avg_curve = False
+    # update plots
+    def redraw_trig(self):
+        self.settings.trigger_single_button.setText("Single")
+        if (not self.settings.external_trig_enabled):
+            self.settings.trigger_start_button.setEnabled(True)
+        self.trig_curve.setData(PlotData.trig_x, PlotData.trig_y.view())
+
+    def redraw_avg(self):
+        # Only about two points per pixel of the visible range, min and max
+        PlotData.avg_pyramid.sync()
+        x0, x1 = self.avg_plot.viewRange()[0]
+        dx = PlotData.avg_timewindow / max(PlotData.avg_bufsize - 1, 1)
+        x, y = PlotData.avg_pyramid.plot(x0, x1, dx, self.avg_plot.getViewBox().width())
+        self.avg_curve.setData(x, y)
 
 # Start Qt event loop unless running in interactive mode or using pyside.
 if __name__ == '__main__':
@@ -1325,5 +1222,13 @@ if __name__ == '__main__':
     plotter = pms_plotter()
     plotter.start()
 
+    exporter = None
+    if metrics_file or metrics_port is not None:
+        exporter = MetricsExporter(path=metrics_file, port=metrics_port)
+        exporter.start()
+
     if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
         QtGui.QApplication.instance().exec_()
+    plotter.sessions.close()
+    if exporter:
+        exporter.close()
@@ -0,0 +1,152 @@
+from __future__ import print_function
+import argparse
+import csv
+import json
+import multiprocessing
+import sys
+
+from libs.analysis import PartialStats, chunk_stats, histogram_edges, CHUNK_SAMPLES, PERCENTILES, \
+    HIST_MIN, HIST_DECADES, HIST_PER_DECADE
+from libs.recording import CaptureReader
+
+
+def plan(reader, chunk, window):
+    ''' (task, window start, window end) for every chunk of a capture, in
+        order. Chunks never cross a window, the windows are window seconds
+        long, or the whole file if 0.
+    '''
+    n = len(reader)
+    span = max(int(round(window / reader.sample_interval)), 1) if window else max(n, 1)
+    chunks = []
+    for window_start in range(0, n, span):
+        window_end = min(window_start + span, n)
+        for start in range(window_start, window_end, chunk):
+            chunks.append(((reader.path, start, min(start + chunk, window_end)), window_start, window_end))
+    return chunks
+
+
+def result_row(reader, kind, start, end, stats, percentiles):
+    interval = reader.sample_interval
+    charge = stats.charge(interval)
+    row = {'file': reader.path,
+           'kind': kind,
+           'start_s': start * interval,
+           'end_s': end * interval,
+           'samples': stats.count,
+           'avg_A': stats.mean,
+           'rms_A': stats.rms,
+           'min_A': stats.min,
+           'max_A': stats.max,
+           'mAh': charge / 3.6,
+           'mWh': charge * reader.header.vdd / 1000.0 / 3.6}
+    for q in percentiles:
+        row['p%g_A' % q] = stats.percentile(q)
+    row['hist'] = stats.hist.tolist()
+    return row
+
+
+class RowWriter(object):
+    ''' Writes result rows as they come, as CSV with one column per
+        histogram bin or as JSON lines, flushing after each
+    '''
+    COLUMNS = ['file', 'kind', 'start_s', 'end_s', 'samples', 'avg_A', 'rms_A', 'min_A', 'max_A', 'mAh', 'mWh']
+
+    def __init__(self, out, fmt, percentiles, edges):
+        self.out = out
+        self.fmt = fmt
+        self.edges = edges
+        self.columns = self.COLUMNS + ['p%g_A' % q for q in percentiles]
+        if fmt == 'csv':
+            self._csv = csv.writer(out, lineterminator='\n')
+            self._csv.writerow(self.columns + ['h_%g_A' % edge for edge in edges[:-1]])
+
+    def write(self, row):
+        if self.fmt == 'csv':
+            self._csv.writerow([row[column] if row[column] is not None else '' for column in self.columns]
+                               + row['hist'])
+        else:
+            row = dict(row, hist_edges=self.edges.tolist())
+            self.out.write(json.dumps(row, sort_keys=True) + '\n')
+        self.out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Statistics of recorded PPK captures: avg, rms, min, max, "
+                                     "charge and energy as in the GUI status line, plus percentiles and a "
+                                     "histogram, computed in parallel")
+    parser.add_argument('files', nargs='+', metavar='CAPTURE', help="*.ppkrec files to analyze")
+    parser.add_argument('--jobs', '-j', type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes (default one per CPU)")
+    parser.add_argument('--chunk', type=int, default=CHUNK_SAMPLES,
+                        help="samples per task (default %d)" % CHUNK_SAMPLES)
+    parser.add_argument('--window', type=float, default=0, metavar='SECONDS',
+                        help="also give the statistics of every SECONDS of each capture")
+    parser.add_argument('--format', choices=('csv', 'json'), default='csv',
+                        help="CSV, or JSON with one object per line (default csv)")
+    parser.add_argument('--output', '-o', metavar='FILE', help="write to FILE instead of stdout")
+    parser.add_argument('--percentiles', default=','.join('%g' % q for q in PERCENTILES),
+                        help="comma separated percentiles to give (default %(default)s)")
+    parser.add_argument('--hist-min', type=float, default=HIST_MIN * 1e6, metavar='UA',
+                        help="lower edge of the histogram, anything below goes in the first bin "
+                        "(default %(default)g uA)")
+    parser.add_argument('--hist-decades', type=int, default=HIST_DECADES,
+                        help="decades in the histogram (default %(default)d)")
+    parser.add_argument('--hist-per-decade', type=int, default=HIST_PER_DECADE,
+                        help="log spaced bins per decade (default %(default)d)")
+    args = parser.parse_args()
+
+    try:
+        percentiles = [float(q) for q in args.percentiles.split(',') if q]
+        if any(q < 0 or q > 100 for q in percentiles) or args.chunk < 1 or args.jobs < 1 or \
+                args.hist_decades < 1 or args.hist_per_decade < 1:
+            raise ValueError
+    except ValueError:
+        print("Percentiles must be from 0 to 100, --chunk, --jobs and the histogram bins at least 1")
+        sys.exit(1)
+    edges = histogram_edges(args.hist_min * 1e-6, args.hist_decades, args.hist_per_decade)
+
+    readers = []
+    for path in args.files:
+        try:
+            readers.append(CaptureReader(path))
+        except (IOError, OSError, ValueError) as e:
+            print("%s: %s" % (path, e))
+            sys.exit(1)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    writer = RowWriter(out, args.format, percentiles, edges)
+    plans = [plan(reader, args.chunk, args.window) for reader in readers]
+    work = [task + (edges,) for chunks in plans for task, window_start, window_end in chunks]
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    try:
+        # Results come back in order, rows are written as soon as their last chunk is in
+        results = pool.imap(chunk_stats, work) if pool else (chunk_stats(task) for task in work)
+        for reader, chunks in zip(readers, plans):
+            total = PartialStats(edges)
+            window = None
+            for task, window_start, window_end in chunks:
+                stats = next(results)
+                if window is None or window[0] != window_start:
+                    if window is not None and args.window:
+                        writer.write(result_row(reader, 'window', window[0], window[1], window_stats, percentiles))
+                    window = (window_start, window_end)
+                    window_stats = PartialStats(edges)
+                window_stats.merge(stats)
+                total.merge(stats)
+            if window is not None and args.window:
+                writer.write(result_row(reader, 'window', window[0], window[1], window_stats, percentiles))
+            writer.write(result_row(reader, 'total', 0, len(reader), total, percentiles))
+    except KeyboardInterrupt:
+        if pool:
+            pool.terminate()
+        sys.exit(1)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
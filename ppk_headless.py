@@ -0,0 +1,203 @@
+from __future__ import print_function
+import argparse
+import sys
+import time
+
+from libs.device import PPKDevice
+from libs.recording import Recorder, FSYNC_POLICIES, FSYNC_INTERVAL
+from libs.session import SessionEngine, EMIT_INTERVAL
+from libs.metrics import MetricsExporter
+from libs.swtrigger import TriggerEngine, parse_condition, PRE_TRIGGER, POST_TRIGGER
+from libs import simulator
+
+
+def print_summary(summary):
+    print("session %d DUT %-3s %8.0f s %12.6f mAh %12.6f mWh %10.4f mA   total %12.6f mAh %12.6f mWh"
+          % (summary['session'], 'on' if summary['dut_on'] else 'off', summary['elapsed'], summary['mAh'],
+             summary['mWh'], summary['current'] * 1e3, summary['total_mAh'], summary['total_mWh']))
+    sys.stdout.flush()
+
+
+def print_event(event):
+    print("trigger %10.4f s  peak: %12.3f uA  mean: %12.3f uA  (%d samples)"
+          % (event.time, event.samples.max() * 1e6, event.samples.mean() * 1e6, len(event.samples)))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Power Profiler Kit without GUI, prints the average current")
+    parser.add_argument('--avg-samples', type=int, default=10,
+                        help="samples averaged per average sample, in steps of 10 (default 10)")
+    parser.add_argument('--period', type=float, default=1.0,
+                        help="seconds between printed results (default 1)")
+    parser.add_argument('--duration', type=float, default=0,
+                        help="seconds to run, 0 runs until Ctrl-C (default 0)")
+    parser.add_argument('--no-calibration', action='store_true',
+                        help="skip the offset calibration at start")
+    parser.add_argument('--record', metavar='BASE',
+                        help="record the samples to BASE.avg.ppkrec and BASE.trig.ppkrec")
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default=FSYNC_INTERVAL,
+                        help="when recordings are synced to disk (default %s)" % FSYNC_INTERVAL)
+    parser.add_argument('--session', metavar='FILE',
+                        help="checkpoint the DUT session totals to FILE every minute")
+    parser.add_argument('--resume', action='store_true',
+                        help="carry on with the totals in the --session file of an interrupted run")
+    parser.add_argument('--session-log', metavar='FILE',
+                        help="append a line for every ended DUT on/off session to FILE")
+    parser.add_argument('--emit', type=float, default=0, metavar='SECONDS',
+                        help="print the session totals every SECONDS (default %g when --session is given)"
+                        % EMIT_INTERVAL)
+    parser.add_argument('--simulate', metavar='WAVEFORM',
+                        help="run against a simulated PPK with a DUT drawing WAVEFORM uA, e.g. constant:100 or "
+                        "square:10,5000,0.1,0.01 (low, high, period s, duty)")
+    parser.add_argument('--snr', type=int, metavar='SERIAL',
+                        help="serial number of the emulator of the PPK to use when several are connected")
+    parser.add_argument('--decode-process', action='store_true',
+                        help="deframe and decode in a separate process")
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help="write a JSON snapshot of the internal metrics to FILE every second")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="serve the internal metrics in the Prometheus text format at "
+                        "http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--sw-trigger', metavar='SPEC',
+                        help="print the captures of a software trigger on the average samples, e.g. rising:1000 or "
+                        "pulse:1000,0.001,0.01 (uA, min s, max s), one of rising, falling, window, enter, pulse, "
+                        "dip, above, below")
+    parser.add_argument('--pre', type=float, default=PRE_TRIGGER,
+                        help="seconds captured before the software trigger (default %g)" % PRE_TRIGGER)
+    parser.add_argument('--post', type=float, default=POST_TRIGGER,
+                        help="seconds captured from the software trigger on (default %g)" % POST_TRIGGER)
+    parser.add_argument('--bursts', metavar='HIGH,LOW[,GAP]',
+                        help="with --record, index the bursts from HIGH uA on until below LOW uA, merging "
+                        "sleeps shorter than GAP s, next to the average recording")
+    args = parser.parse_args()
+
+    bursts = None
+    if args.bursts:
+        try:
+            values = [float(v) for v in args.bursts.split(',')]
+            if not args.record or len(values) not in (2, 3):
+                raise ValueError
+        except ValueError:
+            print("--bursts takes HIGH,LOW or HIGH,LOW,GAP and needs --record")
+            sys.exit(1)
+        bursts = (values[0] * 1e-6, values[1] * 1e-6, values[2] if len(values) > 2 else 0.0)
+
+    condition = None
+    if args.sw_trigger:
+        try:
+            condition = parse_condition(args.sw_trigger)
+        except ValueError as e:
+            print(str(e))
+            sys.exit(1)
+
+    if args.simulate:
+        try:
+            device = PPKDevice(api=simulator.api_factory(waveform=simulator.parse_waveform(args.simulate)),
+                               snr=args.snr, offload=args.decode_process)
+        except ValueError as e:
+            print(str(e))
+            sys.exit(1)
+    else:
+        device = PPKDevice(snr=args.snr, offload=args.decode_process)
+    try:
+        device.connect()
+        device.start()
+    except (ValueError, IOError) as e:
+        print(str(e))
+        sys.exit(1)
+    except Exception:
+        print("Unable to connect to the PPK, check debugger connection and make sure pynrfjprog is up to date.")
+        sys.exit(1)
+    print("Board ID: " + device.calibration.board_id)
+
+    device.on_calibration(lambda done: print("Offset calibration done" if done else "Calibrating..."))
+    if not args.no_calibration:
+        device.calibrate_offset()
+    with device.batch():
+        device.run()
+        device.set_average_samples(args.avg_samples)
+
+    recorder = None
+    if args.record:
+        recorder = Recorder(device, args.record, fsync=args.fsync, bursts=bursts)
+        recorder.start()
+
+    exporter = None
+    if args.metrics_file or args.metrics_port is not None:
+        try:
+            exporter = MetricsExporter(path=args.metrics_file, port=args.metrics_port)
+            exporter.start()
+        except (IOError, OSError) as e:
+            print("Unable to serve metrics on port %s: %s" % (args.metrics_port, e))
+            exporter = None
+
+    trigger = None
+    if condition:
+        trigger = TriggerEngine(condition, device.avg_interval, pre=args.pre, post=args.post)
+        trigger.on_event(print_event)
+        trigger.attach(device)
+
+    sessions = None
+    if args.session or args.session_log or args.emit:
+        sessions = SessionEngine(device, checkpoint=args.session, log=args.session_log,
+                                 resume=args.resume, emit_interval=args.emit or EMIT_INTERVAL)
+        sessions.on_emit(print_summary)
+        sessions.start()
+
+    start = time.time()
+    next_print = start + args.period
+    total = 0.0
+    count = 0
+    received = False
+    try:
+        for kind, data in device.samples(timeout=5.0):
+            received = True
+            if kind == 'average' and not device.calibrating:
+                total += data
+                count += 1
+            now = time.time()
+            if now >= next_print:
+                if count:
+                    print("%10.3f s  avg: %12.3f uA  (%d samples)" % (now - start, total / count * 1e6, count))
+                    sys.stdout.flush()
+                total = 0.0
+                count = 0
+                next_print += args.period
+            if args.duration and now - start >= args.duration:
+                break
+        if not received:
+            print("No data received from the PPK")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            device.stop()
+        except IOError as e:
+            print(str(e))
+        # Reader and decoders finish before anything they feed is closed
+        device.disconnect()
+        if trigger:
+            trigger.detach()
+            print("%d software triggers" % trigger.triggers)
+        if sessions:
+            sessions.close()
+        if recorder:
+            recorder.close()
+            print("Wrote " + ', '.join(recorder.paths))
+            if recorder.dropped_blocks:
+                print("%d blocks dropped, the disk did not keep up" % recorder.dropped_blocks)
+            if recorder.burst_index is not None:
+                summary = recorder.burst_index.summary()
+                print("%d bursts  mean %.3f uC  max %.3f uC  %.3f ms  peak %.3f mA  sleep %.3f uA  duty %.3f %%"
+                      % (summary['bursts'], summary['mean_burst_charge'] * 1e6, summary['max_burst_charge'] * 1e6,
+                         summary['mean_burst_duration'] * 1e3, summary['peak'] * 1e3,
+                         summary['sleep_current'] * 1e6, summary['duty_cycle'] * 100))
+        if exporter:
+            exporter.close()
+            if args.metrics_file:
+                print("Wrote " + args.metrics_file)
+
+
+if __name__ == "__main__":
+    main()